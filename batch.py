@@ -0,0 +1,240 @@
+import json
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+import schemas
+
+
+# Batch jobs trade latency for throughput and price: replies can take up to a day.
+LLM_BATCH_POLL_INTERVAL = float(os.getenv("LLM_BATCH_POLL_INTERVAL", "30") or 30)
+LLM_BATCH_TIMEOUT_HOURS = float(os.getenv("LLM_BATCH_TIMEOUT_HOURS", "24") or 24)
+
+OPENAI_BATCH_ENDPOINT = "/v1/chat/completions"
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _to_jsonl(lines):
+    return "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+
+
+def _openai_request_line(request, model_name):
+    body = {
+        "model": model_name,
+        "messages": request["messages"],
+        "temperature": request["temperature"],
+        "max_tokens": request["max_tokens"],
+    }
+    if request.get("schema"):
+        body["response_format"] = schemas.openai_response_format(request["schema"])
+    return {"custom_id": request["custom_id"], "method": "POST", "url": OPENAI_BATCH_ENDPOINT, "body": body}
+
+
+def parse_openai_output(jsonl_text):
+    """{custom_id: reply text, or None for requests that errored} from an OpenAI batch output file."""
+    replies = {}
+    for line in jsonl_text.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        response = entry.get("response") or {}
+        try:
+            if response.get("status_code") != 200:
+                raise KeyError("status_code")
+            replies[entry["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            replies[entry["custom_id"]] = None
+    return replies
+
+
+class BatchBackend(ABC):
+    """
+    A provider batch endpoint. Requests are dicts of custom_id, messages, temperature, max_tokens and an
+    optional JSON schema for the reply; replies come back as {custom_id: text or None}.
+    """
+    @abstractmethod
+    def submit(self, requests) -> str:
+        pass
+
+    @abstractmethod
+    def status(self, batch_id) -> dict:
+        """{"state": RUNNING/DONE/FAILED, "done": requests finished, "total": requests submitted}"""
+        pass
+
+    @abstractmethod
+    def results(self, batch_id) -> dict:
+        pass
+
+
+class OpenAIBatchBackend(BatchBackend):
+    def __init__(self, client, model_name):
+        self.client = client
+        self.model_name = model_name
+
+    def submit(self, requests):
+        payload = _to_jsonl(_openai_request_line(request, self.model_name) for request in requests)
+        input_file = self.client.files.create(file=("reviewaid-batch.jsonl", payload), purpose="batch")
+        job = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=OPENAI_BATCH_ENDPOINT,
+            completion_window="24h"
+        )
+        return job.id
+
+    def status(self, batch_id):
+        job = self.client.batches.retrieve(batch_id)
+        counts = job.request_counts
+        # Expired and cancelled jobs still return whatever finished before they stopped
+        if job.status in ("completed", "expired", "cancelled"):
+            state = DONE
+        elif job.status == "failed":
+            state = FAILED
+        else:
+            state = RUNNING
+        return {
+            "state": state,
+            "done": (counts.completed + counts.failed) if counts else 0,
+            "total": counts.total if counts else 0,
+        }
+
+    def results(self, batch_id):
+        job = self.client.batches.retrieve(batch_id)
+        if not job.output_file_id:
+            return {}
+        return parse_openai_output(self.client.files.content(job.output_file_id).text)
+
+
+class AnthropicBatchBackend(BatchBackend):
+    """system_blocks(text) turns a system message into the system parameter (e.g. with cache_control)."""
+    def __init__(self, client, model_name, system_blocks=None):
+        self.client = client
+        self.model_name = model_name
+        self.system_blocks = system_blocks or (lambda text: text)
+
+    def _params(self, request):
+        system = "".join(m["content"] for m in request["messages"] if m["role"] == "system")
+        params = {
+            "model": self.model_name,
+            "messages": [m for m in request["messages"] if m["role"] != "system"],
+            "temperature": request["temperature"],
+            "max_tokens": request["max_tokens"],
+        }
+        if system:
+            params["system"] = self.system_blocks(system)
+        if request.get("schema"):
+            params["tools"] = [schemas.anthropic_tool(request["schema"])]
+            params["tool_choice"] = {"type": "tool", "name": schemas.SCHEMA_NAME}
+        return params
+
+    def submit(self, requests):
+        job = self.client.messages.batches.create(requests=[
+            {"custom_id": request["custom_id"], "params": self._params(request)}
+            for request in requests
+        ])
+        return job.id
+
+    def status(self, batch_id):
+        job = self.client.messages.batches.retrieve(batch_id)
+        counts = job.request_counts
+        finished = counts.succeeded + counts.errored + counts.canceled + counts.expired
+        return {
+            "state": DONE if job.processing_status == "ended" else RUNNING,
+            "done": finished,
+            "total": finished + counts.processing,
+        }
+
+    def results(self, batch_id):
+        replies = {}
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded" and entry.result.message.content:
+                replies[entry.custom_id] = schemas.anthropic_reply_text(entry.result.message)
+            else:
+                replies[entry.custom_id] = None
+        return replies
+
+
+class LocalBatchBackend(BatchBackend):
+    """
+    File-based stand-in for a batch endpoint, using the OpenAI batch file formats. submit() writes
+    <batch_id>.input.jsonl to directory and the job is done once <batch_id>.output.jsonl appears.
+    With a responder(body) -> text the job is answered on the first status check; without one,
+    another process is expected to write the output file.
+    """
+    def __init__(self, directory, model_name, responder=None):
+        self.directory = directory
+        self.model_name = model_name
+        self.responder = responder
+
+    def _path(self, batch_id, kind):
+        return os.path.join(self.directory, f"{batch_id}.{kind}.jsonl")
+
+    def submit(self, requests):
+        os.makedirs(self.directory, exist_ok=True)
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        with open(self._path(batch_id, "input"), "wb") as f:
+            f.write(_to_jsonl(_openai_request_line(request, self.model_name) for request in requests))
+        return batch_id
+
+    def _read_lines(self, batch_id, kind):
+        with open(self._path(batch_id, kind), encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def process(self, batch_id, responder):
+        """Answers every request of a submitted job with responder and writes its output file."""
+        output = []
+        for line in self._read_lines(batch_id, "input"):
+            try:
+                text = responder(line["body"])
+            except Exception as e:
+                text, error = None, str(e)
+            else:
+                error = None if text is not None else "no response"
+            output.append({
+                "custom_id": line["custom_id"],
+                "response": None if text is None else {"status_code": 200, "body": {"choices": [{"message": {"content": text}}]}},
+                "error": error,
+            })
+        # Written under a temporary name so pollers never see a half-written file
+        tmp_path = self._path(batch_id, "output") + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_to_jsonl(output))
+        os.replace(tmp_path, self._path(batch_id, "output"))
+
+    def status(self, batch_id):
+        if not os.path.exists(self._path(batch_id, "input")):
+            return {"state": FAILED, "done": 0, "total": 0}
+        total = len(self._read_lines(batch_id, "input"))
+        if not os.path.exists(self._path(batch_id, "output")) and self.responder is not None:
+            self.process(batch_id, self.responder)
+        if os.path.exists(self._path(batch_id, "output")):
+            return {"state": DONE, "done": total, "total": total}
+        return {"state": RUNNING, "done": 0, "total": total}
+
+    def results(self, batch_id):
+        with open(self._path(batch_id, "output"), encoding="utf-8") as f:
+            return parse_openai_output(f.read())
+
+
+def wait_for_batch(backend, batch_id, poll_interval=None, timeout=None, on_status=None):
+    """
+    Polls a submitted job until it finishes. Returns its {custom_id: text} replies, or None when
+    the job failed or did not finish within timeout seconds (LLM_BATCH_TIMEOUT_HOURS by default).
+    on_status(status) is called after every poll.
+    """
+    poll_interval = LLM_BATCH_POLL_INTERVAL if poll_interval is None else poll_interval
+    timeout = LLM_BATCH_TIMEOUT_HOURS * 3600 if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+
+    while True:
+        status = backend.status(batch_id)
+        if on_status is not None:
+            on_status(status)
+        if status["state"] == DONE:
+            return backend.results(batch_id)
+        if status["state"] == FAILED or time.monotonic() >= deadline:
+            return None
+        time.sleep(poll_interval)
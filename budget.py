@@ -0,0 +1,227 @@
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from sections import select_sections
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# Context windows (tokens) by provider, matched on the longest model-name prefix.
+# "" is the provider default. LLM_CONTEXT_WINDOW overrides all of them.
+MODEL_CONTEXT_WINDOWS = {
+    "OpenAI": {
+        "": 128000,
+        "gpt-4o": 128000,
+        "gpt-4-turbo": 128000,
+        "gpt-4.1": 1047576,
+        "gpt-4": 8192,
+        "gpt-3.5": 16385,
+        "gpt-5": 400000,
+        "o1": 200000,
+        "o3": 200000,
+        "o4": 200000,
+    },
+    "Anthropic": {"": 200000},
+    "Cohere": {
+        "": 128000,
+        "command-a": 256000,
+        "command-r": 128000,
+    },
+    "DeepSeek": {"": 128000},
+    "GLM (Z.ai)": {
+        "": 128000,
+        "glm-4.6": 200000,
+        "glm-4.7": 200000,
+    },
+    "Ollama (Local)": {"": 32768},
+}
+
+# Starting characters-per-token estimates; refined from the token usage reported by each API.
+DEFAULT_CHARS_PER_TOKEN = {
+    "OpenAI": 4.0,
+    "DeepSeek": 4.0,
+    "Anthropic": 3.5,
+    "Cohere": 3.5,
+    "GLM (Z.ai)": 3.5,
+    "Ollama (Local)": 3.5,
+}
+
+# Sections dropped first when the paper does not fit; whatever is left is then cut from the end.
+# Front matter and the Abstract are never dropped.
+SECTION_TRIM_ORDER = ("References", "Appendix", "Acknowledgements", "Data Availability", "Introduction", "Discussion", "Results", "Methods")
+
+PAPER_TEXT_SLOT = "\x00PAPER_TEXT\x00"
+
+SAFETY_MARGIN_TOKENS = 256
+CALIBRATION_WEIGHT = 0.3
+
+_calibration = {}
+_calibration_lock = threading.Lock()
+
+# Context windows reported by the provider itself (e.g. from Ollama's model info)
+_reported_windows = {}
+
+
+def get_context_window(provider_name, model_name):
+    override = os.getenv("LLM_CONTEXT_WINDOW")
+    if override:
+        try:
+            return int(override)
+        except ValueError:
+            pass
+
+    reported = _reported_windows.get((provider_name, model_name))
+    if reported:
+        return reported
+
+    windows = MODEL_CONTEXT_WINDOWS.get(provider_name, {"": 128000})
+    model = (model_name or "").lower()
+    prefix = max((p for p in windows if model.startswith(p.lower())), key=len, default="")
+    return windows[prefix]
+
+
+def set_context_window(provider_name, model_name, tokens):
+    """Records the context window a provider reports for a model; it takes precedence over the table above."""
+    _reported_windows[(provider_name, model_name)] = tokens
+
+
+@lru_cache(maxsize=16)
+def _get_encoding(model_name):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("o200k_base")
+        except Exception:
+            return None
+
+
+# tiktoken counts by (model, sha256 of the text), so whole papers are not kept alive as cache keys
+TOKEN_COUNT_CACHE_SIZE = 256
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def _count_with_encoding(model_name, text):
+    key = (model_name, hashlib.sha256(text.encode("utf-8", "surrogatepass")).digest())
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    count = len(_get_encoding(model_name).encode(text, disallowed_special=()))
+    with _token_counts_lock:
+        _token_counts[key] = count
+        while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return count
+
+
+def chars_per_token(provider_name, model_name):
+    with _calibration_lock:
+        ratio = _calibration.get((provider_name, model_name))
+    return ratio or DEFAULT_CHARS_PER_TOKEN.get(provider_name, 3.5)
+
+
+def count_tokens(text, provider_name, model_name):
+    """
+    Estimated prompt tokens for text. OpenAI-compatible models use tiktoken when it is installed
+    (results are cached per text); everything else uses a per-model characters-per-token ratio.
+    """
+    if not text:
+        return 0
+    if provider_name in ("OpenAI", "DeepSeek") and _get_encoding(model_name) is not None:
+        return _count_with_encoding(model_name, text)
+    return math.ceil(len(text) / chars_per_token(provider_name, model_name))
+
+
+def calibrate(provider_name, model_name, prompt_chars, prompt_tokens):
+    """Feeds the prompt token count an API actually billed back into the chars-per-token estimate."""
+    if not prompt_tokens or prompt_chars < 1000:
+        return
+    observed = min(8.0, max(1.5, prompt_chars / prompt_tokens))
+    key = (provider_name, model_name)
+    with _calibration_lock:
+        current = _calibration.get(key)
+        if current is None:
+            _calibration[key] = observed
+        else:
+            _calibration[key] = current + CALIBRATION_WEIGHT * (observed - current)
+
+
+def _normalize(text):
+    return " ".join(text.split())
+
+
+def plan_prompt(prompt, paper_text, sections, provider_name, model_name, max_output_tokens, max_input_tokens=None, exclude=(), system_prompt=""):
+    """
+    Fits a paper into a prompt for the chosen model. prompt contains PAPER_TEXT_SLOT where the paper goes.
+    The input budget is the model's context window minus the rest of the prompt (and system_prompt), the output reservation
+    and a safety margin (and at most max_input_tokens of paper). Over budget, whole sections are dropped in
+    SECTION_TRIM_ORDER before the remaining text is cut. exclude lists sections that are always left out.
+
+    Returns a dict: prompt, max_output_tokens, paper_tokens, budget_tokens, dropped_sections, truncated.
+    """
+    context_window = get_context_window(provider_name, model_name)
+    max_output_tokens = min(max_output_tokens, max(1024, context_window // 4))
+
+    fixed_tokens = count_tokens(system_prompt + prompt.replace(PAPER_TEXT_SLOT, ""), provider_name, model_name)
+    budget = context_window - max_output_tokens - fixed_tokens - SAFETY_MARGIN_TOKENS
+    if max_input_tokens:
+        budget = min(budget, max_input_tokens)
+    budget = max(budget, 0)
+
+    dropped = [name for name in exclude if name in (sections or {})]
+    text = _normalize(select_sections(paper_text, sections, exclude=dropped))
+    tokens = count_tokens(text, provider_name, model_name)
+
+    for name in SECTION_TRIM_ORDER:
+        if tokens <= budget:
+            break
+        if name in (sections or {}) and name not in dropped:
+            dropped.append(name)
+            text = _normalize(select_sections(paper_text, sections, exclude=dropped))
+            tokens = count_tokens(text, provider_name, model_name)
+
+    truncated = False
+    for _ in range(5):
+        if tokens <= budget:
+            break
+        text = text[:int(len(text) * budget / tokens * 0.98)]
+        tokens = count_tokens(text, provider_name, model_name)
+        truncated = True
+
+    return {
+        "prompt": prompt.replace(PAPER_TEXT_SLOT, text),
+        "max_output_tokens": max_output_tokens,
+        "paper_tokens": tokens,
+        "budget_tokens": budget,
+        "dropped_sections": [name for name in dropped if name not in exclude],
+        "truncated": truncated,
+    }
+
+
+def pack_papers(token_counts, capacity, max_per_pack):
+    """
+    Groups items into packs whose token counts add up to at most capacity, with at most max_per_pack
+    items in each (first-fit decreasing). Returns lists of indices, each sorted, in order of their first item.
+    """
+    packs = []
+    for i in sorted(range(len(token_counts)), key=lambda i: -token_counts[i]):
+        for pack in packs:
+            if pack[0] + token_counts[i] <= capacity and len(pack[1]) < max_per_pack:
+                pack[0] += token_counts[i]
+                pack[1].append(i)
+                break
+        else:
+            packs.append([token_counts[i], [i]])
+    return sorted((sorted(indices) for _, indices in packs), key=lambda indices: indices[0])
@@ -0,0 +1,134 @@
+import os
+import json
+import sqlite3
+import time
+import zlib
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "reviewaid")
+
+
+def get_cache_dir():
+    """
+    Directory holding ReviewAid's on-disk caches.
+    Set REVIEWAID_CACHE_DIR to move it, or to an empty string to disable caching.
+    """
+    cache_dir = os.getenv("REVIEWAID_CACHE_DIR")
+    if cache_dir is None:
+        return DEFAULT_CACHE_DIR
+    return cache_dir.strip()
+
+
+class DiskCache:
+    """
+    Size-bounded, compressed key/value store backed by SQLite.
+    Values must be JSON serialisable. When the stored (compressed) size exceeds
+    max_bytes, least recently used entries are evicted first.
+    Safe to share between Streamlit sessions and worker processes on one host.
+    """
+    def __init__(self, name, max_bytes, ttl=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        cache_dir = get_cache_dir()
+        if not cache_dir:
+            return None
+        os.makedirs(cache_dir, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(cache_dir, f"{self.name}.sqlite3"), timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        return conn
+
+    def get(self, key):
+        try:
+            conn = self._connect()
+        except Exception:
+            return None
+        if conn is None:
+            return None
+        try:
+            with conn:
+                row = conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                value, created = row
+                now = time.time()
+                if self.ttl is not None and now - created > self.ttl:
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return json.loads(zlib.decompress(value).decode("utf-8"))
+        except Exception:
+            self.misses += 1
+            return None
+        finally:
+            conn.close()
+
+    def set(self, key, value):
+        try:
+            conn = self._connect()
+        except Exception:
+            return
+        if conn is None:
+            return
+        try:
+            blob = zlib.compress(json.dumps(value).encode("utf-8"), 6)
+            if len(blob) > self.max_bytes:
+                return
+            now = time.time()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, blob, len(blob), now, now)
+                )
+                self._evict(conn)
+        except Exception:
+            pass
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        if self.ttl is not None:
+            conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,))
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed ASC").fetchall():
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            return
+        if conn is None:
+            return
+        try:
+            with conn:
+                conn.execute("DELETE FROM entries")
+        finally:
+            conn.close()
+
+    def stats(self):
+        total_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total_lookups if total_lookups else 0.0
+        }
@@ -2,16 +2,30 @@ import streamlit as st
 import pandas as pd
 import time
 import gc
-import hashlib
 
 
 from utils import (
-    update_terminal_log, extract_pdf_content, preprocess_text_for_ai, 
+    update_terminal_log, extract_uploaded_pdfs, preprocess_text_for_ai, fit_prompt_to_model, 
     MAX_INPUT_TOKENS_EXTRACTOR, MAX_OUTPUT_TOKENS, update_processing_stats,
-    to_docx, to_csv, to_excel, display_citation_section, query_llm
+    to_docx, to_csv, to_excel, display_citation_section, query_llm_many,
+    query_llm_batch, batch_mode_available, LLM_BATCH_MAX_PAPERS, LLM_STRUCTURED_OUTPUT,
+    warm_up_ollama
 )
 from parser import parse_result, df_from_extracted_results
 from confidence import estimate_confidence
+from sections import select_sections
+from budget import PAPER_TEXT_SLOT
+from schemas import extraction_schema, max_output_tokens as schema_output_tokens
+
+def add_cached_result(pdf, pdf_hash):
+    """Files a copy of the result for an identical, already extracted file under this upload's name."""
+    update_terminal_log(f"Duplicate file detected (Hash match). Using cached result.", "INFO")
+    cached_result = dict(st.session_state.batch_file_hashes[pdf_hash])
+    cached_result["filename"] = pdf.name
+    
+    st.session_state.extracted_results.append(cached_result)
+    
+    update_processing_stats("extractor", 1)
 
 def run_extractor():
     st.markdown("## Full-text Data Extractor")
@@ -76,6 +90,14 @@ def run_extractor():
             st.session_state['model_name'] = model_name
             st.session_state['api_key'] = api_key
 
+        if batch_mode_available(st.session_state.get('provider_name')):
+            st.session_state['batch_mode'] = st.checkbox(
+                "Batch API mode (large overnight runs)", value=False,
+                help=f"Submits all papers as one provider batch job: about half the price and up to {LLM_BATCH_MAX_PAPERS} papers, but results can take up to 24 hours."
+            )
+        else:
+            st.session_state['batch_mode'] = False
+
         st.markdown("---")
         st.markdown("### ℹ️ Info")
         st.info("Select a provider and enter the corresponding API key. For Ollama, ensure that server is running locally. 'Default' uses ReviewAid's own environment variables.")
@@ -153,8 +175,12 @@ def run_extractor():
             update_terminal_log(f"Provider: {provider_for_call} | Model: {model_name}", "INFO")
             update_terminal_log(f"Files to process: {min(len(uploaded_pdfs), 2000)}", "INFO")
             update_terminal_log("Allocating resources...", "DEBUG")
+            if provider_for_call == "Ollama (Local)":
+                # Loads the local model while the PDFs are being read
+                warm_up_ollama(model_name, st.session_state.get('ollama_base_url', 'http://localhost:11434'))
 
-        max_papers = 21 
+        batch_mode = st.session_state.get('batch_mode', False) and batch_mode_available(provider_for_call)
+        max_papers = LLM_BATCH_MAX_PAPERS if batch_mode else 21 
         total_pdfs = min(len(uploaded_pdfs), max_papers)
         
         status_placeholder = st.empty()
@@ -167,6 +193,65 @@ def run_extractor():
         
        
         try:
+            if enable_ocr:
+                 update_terminal_log("OCR Mode Enabled. Scanning pages for images...", "INFO")
+
+            status_placeholder.markdown("<h4 style='text-align: center; color: #4189DC;'>Reading uploaded PDFs...</h4>", unsafe_allow_html=True)
+            pdf_hashes, pdf_contents = extract_uploaded_pdfs(uploaded_pdfs[:max_papers], enable_ocr=enable_ocr)
+
+            # Papers are prepared one by one, their prompts sent to the AI concurrently, then results filed in upload order
+            pending_papers = []
+            queued_hashes = set()
+
+            # The field list and instructions are the same for every paper, so they form one system prompt
+            # that providers can cache as a prefix; each paper's prompt carries only its text.
+            field_descriptions = {
+                "Paper Title": "The full title of the research paper",
+                "Author": "The main author(s) of the paper",
+                "Year": "The publication year of the paper",
+                "Journal": "The journal where the paper was published",
+                "DOI": "The Digital Object Identifier of the paper",
+                "Abstract": "A brief summary of the paper's content",
+                "Keywords": "Key terms associated with the paper",
+                "Study Design": "The methodology used in the study (e.g. randomized controlled trial, cohort study)",
+                "Sample Size": "The number of participants in the study",
+                "Intervention": "The treatment or intervention being studied",
+                "Comparison": "The control or comparison group",
+                "Outcome": "The main results or findings of the study",
+                "Conclusion": "The authors' conclusion based on the findings",
+                "Funding": "Information about who funded the research",
+                "Conflicts of Interest": "Any declared conflicts of interest by the authors"
+            }
+            
+            system_prompt = "Extract the following information from the research paper:\n\n"
+            for field in fields_list:
+                description = field_descriptions.get(field, f"Information about {field}")
+                system_prompt += f"- {field}: {description}\n"
+            
+            
+            system_prompt += f"""
+**CRITICAL INSTRUCTION:**
+Return your response as a SINGLE valid JSON object. Do not include markdown formatting. Ensure all keys are present.
+If a field is not found in the text, use the value "Not Found".
+**CONFIDENCE SCORE**: Rate your confidence (0.0 to 1.0).
+- 1.0 = All extracted fields are explicitly stated in the text.
+- 0.8 - 0.9 = Most fields are explicit, some inferred.
+- 0.5 - 0.7 = Some fields missing or ambiguous.
+- < 0.5 = Data largely missing or garbled.
+
+**JSON Format Required:**
+{{
+  "extracted": {{
+"""
+            for field in fields_list:
+                system_prompt += f'    "{field}": "",\n'
+            
+            system_prompt = system_prompt.rstrip(",\n") + "\n  },\n"
+            system_prompt += '  "confidence": 0.0\n}'
+            system_prompt += "\nEnsure that JSON is valid. Use 'Not Found' for missing data.\n"
+            # Providers that support it are held to this schema, and replies get max_tokens sized to it
+            response_schema = extraction_schema(fields_list) if LLM_STRUCTURED_OUTPUT else None
+
             for idx, pdf in enumerate(uploaded_pdfs[:max_papers], 1):
                 gc.collect()
                 
@@ -181,29 +266,19 @@ def run_extractor():
 
                 try:
                     start_time_file = time.time()
-                    
-            
-                    try:
-                        pdf.seek(0)
-                        pdf_bytes = pdf.read()
-                    except Exception as e:
-                        update_terminal_log(f"File read error for {pdf.name}: {str(e)}", "ERROR")
-                     
+
+                    pdf_hash = pdf_hashes[idx - 1]
+                    if pdf_hash is None:
                         progress_bar.progress(idx / total_pdfs)
                         continue
                     
-    
-                    pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
-                    
+                    if pdf_hash in queued_hashes:
+                        # Same file as a paper still waiting on the AI; its result is copied once that arrives
+                        pending_papers.append({"idx": idx, "pdf": pdf, "pdf_hash": pdf_hash, "duplicate": True})
+                        continue
+
                     if pdf_hash in st.session_state.batch_file_hashes:
-          
-                        update_terminal_log(f"Duplicate file detected (Hash match). Using cached result.", "INFO")
-                        cached_result = st.session_state.batch_file_hashes[pdf_hash]
-                        cached_result["filename"] = pdf.name
-                        
-                        st.session_state.extracted_results.append(cached_result)
-                        
-                        update_processing_stats("extractor", 1)
+                        add_cached_result(pdf, pdf_hash)
                         
                         papers_processed_in_batch += 1
                         
@@ -215,18 +290,10 @@ def run_extractor():
                             update_terminal_log("Skipped API call. Using cached data.", "SUCCESS")
                         except:
                             pass
-                        
-               
-                        del pdf_bytes 
                         continue
                     
        
-                    if enable_ocr:
-                         update_terminal_log("OCR Mode Enabled. Scanning pages for images...", "INFO")
-                    
-                    text, title, author, year = extract_pdf_content(pdf_bytes, enable_ocr=enable_ocr)
-                    
-                    del pdf_bytes 
+                    text, title, author, year, sections = pdf_contents.pop(pdf_hash, ("", "", "", "", {}))
 
                     if not text.strip():
                         update_terminal_log(f"PDF '{pdf.name}' appears empty or unreadable.", "WARN")
@@ -237,6 +304,8 @@ def run_extractor():
                         continue
                     
                     full_text_backup = text
+                    # Acknowledgements carry nothing the model needs
+                    text = select_sections(text, sections, exclude=("Acknowledgements",))
                     text = preprocess_text_for_ai(text, max_tokens=MAX_INPUT_TOKENS_EXTRACTOR)
 
          
@@ -258,97 +327,102 @@ def run_extractor():
                         update_terminal_log(f"Preparing extraction fields: {', '.join(fields_list)}", "INFO")
                     except:
                         pass
-                    field_descriptions = {
-                        "Paper Title": "The full title of the research paper",
-                        "Author": "The main author(s) of the paper",
-                        "Year": "The publication year of the paper",
-                        "Journal": "The journal where the paper was published",
-                        "DOI": "The Digital Object Identifier of the paper",
-                        "Abstract": "A brief summary of the paper's content",
-                        "Keywords": "Key terms associated with the paper",
-                        "Study Design": "The methodology used in the study (e.g. randomized controlled trial, cohort study)",
-                        "Sample Size": "The number of participants in the study",
-                        "Intervention": "The treatment or intervention being studied",
-                        "Comparison": "The control or comparison group",
-                        "Outcome": "The main results or findings of the study",
-                        "Conclusion": "The authors' conclusion based on the findings",
-                        "Funding": "Information about who funded the research",
-                        "Conflicts of Interest": "Any declared conflicts of interest by the authors"
-                    }
-                    
-                    prompt = "Extract the following information from the research paper:\n\n"
-                    for field in fields_list:
-                        description = field_descriptions.get(field, f"Information about {field}")
-                        prompt += f"- {field}: {description}\n"
-                    
-                    time.sleep(1)
-                    
-                    prompt += f"""
+                    prompt = f"""
 **Paper Text:**
 \"\"\"
-{text}
+{PAPER_TEXT_SLOT}
 \"\"\"
 
-**CRITICAL INSTRUCTION:**
-Return your response as a SINGLE valid JSON object. Do not include markdown formatting. Ensure all keys are present.
-If a field is not found in the text, use the value "Not Found".
-**CONFIDENCE SCORE**: Rate your confidence (0.0 to 1.0).
-- 1.0 = All extracted fields are explicitly stated in the text.
-- 0.8 - 0.9 = Most fields are explicit, some inferred.
-- 0.5 - 0.7 = Some fields missing or ambiguous.
-- < 0.5 = Data largely missing or garbled.
-
-**JSON Format Required:**
-{{
-  "extracted": {{
+Extract the fields listed above from this paper and return the JSON object.
 """
-                    for field in fields_list:
-                        prompt += f'    "{field}": "",\n'
-                    
-                    prompt = prompt.rstrip(",\n") + "\n  },\n"
-                    prompt += '  "confidence": 0.0\n}'
-                    prompt += "\nEnsure that JSON is valid. Use 'Not Found' for missing data.\n"
+                    prompt, max_output_tokens = fit_prompt_to_model(
+                        prompt, full_text_backup, sections, provider_for_call, model_name,
+                        max_output_tokens=schema_output_tokens(response_schema, model_name, MAX_OUTPUT_TOKENS),
+                        max_input_tokens=MAX_INPUT_TOKENS_EXTRACTOR,
+                        system_prompt=system_prompt
+                    )
                 
          
-                    max_api_attempts = 3 
-                    retries_per_api_attempt = 3
-                    
-                    for api_attempt in range(max_api_attempts):
-                        if api_attempt > 0:
-                            try:
-                                update_terminal_log("Previous attempt failed after retries. Initiating NEW API call for this paper...", "WARN")
-                            except:
-                                pass
-                        
-                        for retry_idx in range(retries_per_api_attempt):
-                            raw_result = query_llm(prompt, provider_for_call, api_key, model_name, temperature=0.1, max_tokens=MAX_OUTPUT_TOKENS)
-            
-                            if raw_result is None:
-                                try:
-                                    update_terminal_log("API returned None after exhaustive retries. Falling back to Regex.", "ERROR")
-                                except:
-                                    pass
-                                processing_successful = False
-                                break 
-                            
-                            if raw_result and raw_result.strip():
-                                processing_successful = True
-                                break 
-                            
-                            if retry_idx < retries_per_api_attempt - 1:
-                                 try:
-                                     update_terminal_log(f"API returned empty response. Retry {retry_idx + 2}/{retries_per_api_attempt}...", "ERROR")
-                                 except:
-                                     pass
-                                 time.sleep(2)
-                        
-                        if processing_successful:
-                            break
-                    
-                    
+                    queued_hashes.add(pdf_hash)
+                    pending_papers.append({
+                        "idx": idx, "pdf": pdf, "pdf_hash": pdf_hash, "start_time": start_time_file,
+                        "prompt": prompt, "max_output_tokens": max_output_tokens, "confidence": confidence,
+                        "title": title, "full_text_backup": full_text_backup
+                    })
                     del prompt 
                     del text
 
+                except Exception as e:               
+                    try:
+                        update_terminal_log(f"CRITICAL ERROR processing {pdf.name}: {str(e)}", "ERROR")
+                    except:
+                        pass
+                    try:
+                        import traceback
+                        update_terminal_log(f"Traceback: {traceback.format_exc()}", "ERROR")
+                    except:
+                        pass
+
+
+            llm_papers = [paper for paper in pending_papers if not paper.get("duplicate")]
+
+            def on_llm_result(i, raw_result):
+                llm_papers[i]["raw_result"] = raw_result
+                answered = sum(1 for paper in llm_papers if "raw_result" in paper)
+                status_placeholder.markdown(f"<h4 style='text-align: center; color: #4189DC;'>Waiting for AI responses... {answered}/{len(llm_papers)} received</h4>", unsafe_allow_html=True)
+                progress_bar.progress(answered / max(len(llm_papers), 1))
+
+            if llm_papers:
+                llm_requests = [
+                    {"prompt": paper["prompt"], "system_prompt": system_prompt, "provider_name": provider_for_call, "api_key": api_key,
+                     "model_name": model_name, "temperature": 0.1, "max_tokens": paper["max_output_tokens"], "response_schema": response_schema}
+                    for paper in llm_papers
+                ]
+                if batch_mode:
+                    def on_batch_status(status):
+                        status_placeholder.markdown(f"<h4 style='text-align: center; color: #4189DC;'>Batch job {status['state']}... {status['done']}/{status['total']} done</h4>", unsafe_allow_html=True)
+                        progress_bar.progress(status['done'] / max(status['total'], 1))
+
+                    try:
+                        update_terminal_log(f"Submitting {len(llm_papers)} papers to the {provider_for_call} batch API...", "INFO")
+                    except:
+                        pass
+                    status_placeholder.markdown("<h4 style='text-align: center; color: #4189DC;'>Submitting batch job...</h4>", unsafe_allow_html=True)
+                    raw_results = query_llm_batch(llm_requests, [paper["pdf_hash"] for paper in llm_papers], on_status=on_batch_status)
+                    for paper_index, raw_result in enumerate(raw_results):
+                        on_llm_result(paper_index, raw_result)
+                else:
+                    try:
+                        update_terminal_log(f"Sending {len(llm_papers)} papers to {provider_for_call} concurrently...", "INFO")
+                    except:
+                        pass
+                    status_placeholder.markdown(f"<h4 style='text-align: center; color: #4189DC;'>Waiting for AI responses... 0/{len(llm_papers)} received</h4>", unsafe_allow_html=True)
+                    query_llm_many(llm_requests, on_result=on_llm_result)
+                del llm_requests
+                for paper in llm_papers:
+                    del paper["prompt"]
+
+            for paper in pending_papers:
+                idx, pdf, pdf_hash = paper["idx"], paper["pdf"], paper["pdf_hash"]
+                result = None
+                print(f"\n--- [EXTRACTOR] Filing result {idx}/{total_pdfs}: {pdf.name} ---", flush=True)
+
+                try:
+                    if paper.get("duplicate"):
+                        if pdf_hash in st.session_state.batch_file_hashes:
+                            add_cached_result(pdf, pdf_hash)
+                            papers_processed_in_batch += 1
+                        progress_bar.progress(idx / total_pdfs)
+                        continue
+
+                    start_time_file = paper["start_time"]
+                    confidence = paper["confidence"]
+                    title = paper["title"]
+                    full_text_backup = paper.pop("full_text_backup")
+                    raw_result = paper.pop("raw_result", None)
+                    processing_successful = bool(raw_result and raw_result.strip())
+
+
                 
                     if not processing_successful:
                         try:
@@ -0,0 +1,112 @@
+import re
+from collections import Counter
+
+
+LIGATURES = {
+    "ﬀ": "ff",
+    "ﬁ": "fi",
+    "ﬂ": "fl",
+    "ﬃ": "ffi",
+    "ﬄ": "ffl",
+    "ﬅ": "st",
+    "ﬆ": "st",
+    "\u00ad": "",  # soft hyphen
+    "\u200b": "",  # zero-width space
+}
+LIGATURE_RE = re.compile("|".join(LIGATURES))
+
+# "treat-\nment" -> "treatment"; only when the next line carries on in lower case
+HYPHENATED_BREAK_RE = re.compile(r'(\w)[-‐‑][ \t]*\r?\n[ \t]*([a-z])')
+
+PAGE_NUMBER_RE = re.compile(
+    r'^\s*(?:page\s+)?[-–—]?\s*\d{1,4}\s*[-–—]?\s*(?:(?:of|/)\s*\d{1,4})?\s*$',
+    re.IGNORECASE
+)
+
+# Lines that never carry study content. Copyright and received/accepted dates are kept because the
+# year heuristic reads them, and DOIs/URLs because the extractor can be asked for them.
+BOILERPLATE_RES = [
+    re.compile(p, re.IGNORECASE) for p in (
+        r'^\s*downloaded (?:from|by)\b.*$',
+        r'^\D*\ball rights reserved\.?\D*$',
+        r'^\s*this (?:article|is an open access article)\b.*\b(?:licensed|distributed) under\b.*$',
+        r'^\s*(?:\*\s*)?(?:corresponding author|correspondence to)\b.*$',
+        r'^\s*e-?mail(?: address(?:es)?)?\s*:.*$',
+        # Author affiliation blocks: "1 Department of Surgery, University of X, City, Country",
+        # "Author affiliations: ...". An institution heading followed by an address comma, so a
+        # sentence that merely starts with "Department of Health guidance ..." is kept
+        r'^\s*(?:author\s+)?affiliations?\s*:.*$',
+        r'^\s*(?:[\d*†‡§]{1,3}|[a-z])?[\s,]*(?:department|dept\.|division|faculty|school|institute|centre|center|laboratory|unit|university)\s+of\b[^.,]*,.*$',
+    )
+]
+
+# How many lines at the top and bottom of a page are checked for running headers/footers
+EDGE_LINES = 3
+MIN_PAGES_FOR_REPEATS = 3
+
+
+def _line_key(line):
+    # Digits vary between pages ("Page 3", "2021;12:45-53") so they are ignored when matching
+    return re.sub(r'\d+', '#', line.strip().lower())
+
+
+def _edge_indices(lines):
+    non_empty = [i for i, line in enumerate(lines) if line.strip()]
+    return set(non_empty[:EDGE_LINES] + non_empty[-EDGE_LINES:])
+
+
+def find_repeated_lines(pages):
+    """
+    Keys of lines that sit in the top or bottom EDGE_LINES of at least half of the pages
+    (and at least MIN_PAGES_FOR_REPEATS pages): running headers, footers and journal banners.
+    """
+    if len(pages) < MIN_PAGES_FOR_REPEATS:
+        return set()
+
+    seen = Counter()
+    for page in pages:
+        lines = page.splitlines()
+        # On a page this short every line is an "edge" line, so it says nothing about headers
+        if sum(1 for line in lines if line.strip()) <= 2 * EDGE_LINES:
+            continue
+        seen.update({_line_key(lines[i]) for i in _edge_indices(lines)})
+
+    threshold = max(MIN_PAGES_FOR_REPEATS, (len(pages) + 1) // 2)
+    return {key for key, count in seen.items() if count >= threshold and key.strip("# ")}
+
+
+def normalize_pages(pages):
+    """
+    Cleans per-page PDF text before it is joined: strips repeated running headers/footers, page numbers
+    and boilerplate lines (download stamps, licence notices, correspondence, e-mail and affiliation lines),
+    replaces ligature characters and joins words hyphenated across line breaks.
+    Returns (pages, chars_saved). Line structure is kept so headings can still be found afterwards.
+    """
+    repeated = find_repeated_lines(pages)
+    cleaned = []
+    saved = 0
+
+    for page in pages:
+        original_length = len(page)
+        page = LIGATURE_RE.sub(lambda m: LIGATURES[m.group()], page)
+
+        lines = page.splitlines(keepends=True)
+        edges = _edge_indices(lines)
+        kept = []
+        for i, line in enumerate(lines):
+            if not line.strip():
+                kept.append(line)
+                continue
+            # Bare numbers inside the page are usually table cells, so only edge lines are treated as page numbers
+            if i in edges and (_line_key(line) in repeated or PAGE_NUMBER_RE.match(line)):
+                continue
+            if any(pattern.match(line) for pattern in BOILERPLATE_RES):
+                continue
+            kept.append(line)
+        page = "".join(kept)
+
+        page = HYPHENATED_BREAK_RE.sub(r'\1\2', page)
+        saved += original_length - len(page)
+        cleaned.append(page)
+
+    return cleaned, saved
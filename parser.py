@@ -3,19 +3,23 @@ import json5
 import re
 import time
 
+from schemas import screening_schema, extraction_schema
+
 
 try:
-    from utils import update_terminal_log, query_llm, MAX_INPUT_TOKENS_SCREENER
+    from utils import update_terminal_log, query_llm, MAX_INPUT_TOKENS_SCREENER, LLM_STRUCTURED_OUTPUT
 except ImportError:
 
     def update_terminal_log(msg, level): pass
     def query_llm(*args, **kwargs): return None
     MAX_INPUT_TOKENS_SCREENER = 128000
+    LLM_STRUCTURED_OUTPUT = False
 
-def clean_json_response(raw_str):
+def clean_json_response(raw_str, allow_array=False):
     """
     Bulletproof JSON cleaning pipeline.
     Handles Markdown, Trailing Commas, Comments, and Control Characters.
+    With allow_array a reply that is a bare [...] array is kept whole.
     """
     if not raw_str:
         return ""
@@ -31,6 +35,10 @@ def clean_json_response(raw_str):
     
     start = raw_str.find('{')
     end = raw_str.rfind('}')
+    if allow_array:
+        array_start = re.search(r'\[\s*\{', raw_str)
+        if array_start and (start == -1 or array_start.start() < start):
+            start, end = array_start.start(), raw_str.rfind(']')
     
     if start == -1 or end == -1 or end < start:
         return "" 
@@ -44,6 +52,12 @@ def clean_json_response(raw_str):
     
     return cleaned
 
+def _response_schema(mode, fields_list):
+    """The schema follow-up calls are held to, so their replies need no repair of their own."""
+    if not LLM_STRUCTURED_OUTPUT or (mode != "screener" and not fields_list):
+        return None
+    return screening_schema() if mode == "screener" else extraction_schema(fields_list)
+
 def _attempt_re_extraction(original_text, provider_name, api_key, model_name, mode, fields_list):
     """
     If first attempt failed (empty or bad structure), try once more with a very strict prompt.
@@ -95,7 +109,8 @@ Required JSON Format:
 Return ONLY JSON object.
 """
 
-    re_raw = query_llm(strict_prompt, provider_name, api_key, model_name, temperature=0.1, max_tokens=2048)
+    re_raw = query_llm(strict_prompt, provider_name, api_key, model_name, temperature=0.1, max_tokens=2048,
+                       response_schema=_response_schema(mode, fields_list))
     del strict_prompt
     del text_snippet 
     
@@ -290,7 +305,8 @@ Rules:
 Malformed JSON:
 {cleaned_json}
 """
-    fixed_raw = query_llm(repair_prompt, provider_name, api_key, model_name, temperature=0.1, max_tokens=1024)
+    fixed_raw = query_llm(repair_prompt, provider_name, api_key, model_name, temperature=0.1, max_tokens=1024,
+                          response_schema=_response_schema(mode, fields_list))
     del repair_prompt 
     
     if fixed_raw and fixed_raw != "RATE_LIMIT_ERROR":
@@ -325,6 +341,63 @@ Malformed JSON:
         pass
     return _regex_extract_fallback(raw_result, mode, fields_list)
 
+def _is_valid_packed_entry(entry):
+    if not isinstance(entry, dict):
+        return False
+    status = str(entry.get("status", "")).strip().lower()
+    if not any(decision in status for decision in ("include", "exclude", "maybe")):
+        return False
+    return bool(str(entry.get("reason", "")).strip())
+
+def parse_packed_result(raw_result, paper_ids):
+    """
+    Splits the answer to a packed screening call ({"results": [{"paper_id": ..., "status": ..., ...}, ...]})
+    into {paper_id: result}. Papers whose entry is missing, duplicated or lacks a status and reason map to
+    None so they can be screened on their own.
+    """
+    results = {paper_id: None for paper_id in paper_ids}
+    cleaned_json = clean_json_response(raw_result, allow_array=True)
+    if not cleaned_json:
+        return results
+
+    try:
+        data = json.loads(cleaned_json)
+    except json.JSONDecodeError:
+        try:
+            data = json5.loads(cleaned_json)
+        except Exception as e:
+            try:
+                update_terminal_log(f"Packed response could not be parsed: {str(e)}", "WARN")
+            except:
+                pass
+            return results
+
+    entries = data.get("results", []) if isinstance(data, dict) else data
+    if not isinstance(entries, list):
+        return results
+
+    seen = set()
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        paper_id = str(entry.get("paper_id", "")).strip()
+        if paper_id not in results:
+            continue
+        if paper_id in seen:
+            # Two answers for one paper: trust neither
+            results[paper_id] = None
+            continue
+        seen.add(paper_id)
+        if _is_valid_packed_entry(entry):
+            results[paper_id] = {key: value for key, value in entry.items() if key != "paper_id"}
+
+    try:
+        valid = sum(1 for result in results.values() if result is not None)
+        update_terminal_log(f"Packed response split into {valid}/{len(paper_ids)} valid paper results.", "INFO")
+    except:
+        pass
+    return results
+
 def df_from_results(results):
     rows = []
     for r in results:
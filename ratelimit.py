@@ -0,0 +1,350 @@
+import asyncio
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import deque
+from collections.abc import Mapping
+from email.utils import parsedate_to_datetime
+
+
+# Requests/tokens per minute to stay under, for every provider. Unset means the defaults below, until
+# the provider reports its real limits in the headers of its responses.
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "0") or 0)
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "0") or 0)
+
+# Starting (requests, tokens) per minute by provider, matched on the longest model-name prefix; ""
+# is the provider default and 0 means no limit. These are the lowest paid/trial tiers. Token limits
+# differ too much between accounts to guess, so they come from the headers of the first response.
+DEFAULT_RATE_LIMITS = {
+    "OpenAI": {"": (500, 0)},
+    "Anthropic": {"": (50, 0)},
+    "Cohere": {"": (20, 0)},
+}
+
+# Longest wait between rate-limited retries when the provider gives no Retry-After
+LLM_MAX_BACKOFF = float(os.getenv("LLM_MAX_BACKOFF", "60") or 60)
+
+# Per-minute limits the providers advertise on their responses
+LIMIT_HEADERS = {
+    "rpm": ("x-ratelimit-limit-requests", "anthropic-ratelimit-requests-limit"),
+    "tpm": ("x-ratelimit-limit-tokens", "anthropic-ratelimit-input-tokens-limit", "anthropic-ratelimit-tokens-limit"),
+}
+
+
+class TokenBucket:
+    """
+    Refills continuously at rate_per_minute up to one minute's worth. reserve() always takes the amount,
+    letting the level go negative, and returns how long the caller must wait for its share, so
+    concurrent callers queue up behind each other instead of all retrying at once.
+    """
+    def __init__(self, rate_per_minute):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = float(rate_per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate_per_minute / 60.0)
+        self.updated = now
+        # A single request bigger than the whole bucket is let through once the bucket is full
+        self.level -= min(amount, self.capacity)
+        if self.level >= 0:
+            return 0.0
+        return -self.level * 60.0 / self.rate_per_minute
+
+
+class RateLimiter:
+    """Request and token buckets for one provider/model, plus a shared pause after a 429."""
+    def __init__(self, rpm=0, tpm=0):
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+        self._paused_until = 0.0
+
+    @property
+    def rpm(self):
+        return self._requests.rate_per_minute if self._requests else 0
+
+    @property
+    def tpm(self):
+        return self._tokens.rate_per_minute if self._tokens else 0
+
+    def set_limits(self, rpm=None, tpm=None):
+        with self._lock:
+            if rpm and rpm != self.rpm:
+                self._requests = TokenBucket(rpm)
+            if tpm and tpm != self.tpm:
+                self._tokens = TokenBucket(tpm)
+
+    def reserve(self, tokens):
+        """Charges one request and `tokens` tokens; returns the seconds to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self._requests:
+                wait = max(wait, self._requests.reserve(1, now))
+            if self._tokens:
+                wait = max(wait, self._tokens.reserve(tokens, now))
+            return wait
+
+    def pause(self, seconds):
+        """Holds back every request through this limiter for `seconds` (e.g. a provider's Retry-After)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def default_limits(provider_name, model_name):
+    """(rpm, tpm) a provider/model starts with: LLM_RPM_LIMIT / LLM_TPM_LIMIT when set, else DEFAULT_RATE_LIMITS."""
+    limits = DEFAULT_RATE_LIMITS.get(provider_name, {})
+    prefix = max((p for p in limits if model_name.startswith(p)), key=len, default=None)
+    rpm, tpm = limits[prefix] if prefix is not None else (0, 0)
+    return LLM_RPM_LIMIT or rpm, LLM_TPM_LIMIT or tpm
+
+
+def _key_fingerprint(api_key):
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+
+
+def get_limiter(provider_name, model_name, api_key=""):
+    """
+    The process-wide limiter of a provider/model/key. Limits are per account, so sessions using another
+    key never wait on this one's pauses or learned limits. Keys are only kept as a hash.
+    """
+    key = (provider_name, model_name, _key_fingerprint(api_key))
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(*default_limits(provider_name, model_name))
+            _limiters[key] = limiter
+        return limiter
+
+
+def _response_headers(exc):
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    return headers if headers is not None else {}
+
+
+def _header_number(headers, *names):
+    for name in names:
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def retry_after_seconds(exc):
+    """Seconds the provider asked us to wait (retry-after-ms / retry-after headers), or None."""
+    headers = _response_headers(exc)
+    retry_after_ms = _header_number(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return max(0.0, retry_after_ms / 1000.0)
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def learn_limits(limiter, exc):
+    """Adopts the RPM/TPM limits a provider reports on a rate-limit error response."""
+    learn_limits_from_headers(limiter, _response_headers(exc))
+
+
+def learn_limits_from_headers(limiter, headers):
+    """Adopts the RPM/TPM limits in a response's headers (any response, not only a 429)."""
+    if not isinstance(headers, Mapping):
+        return
+    rpm = _header_number(headers, *LIMIT_HEADERS["rpm"])
+    tpm = _header_number(headers, *LIMIT_HEADERS["tpm"])
+    limiter.set_limits(rpm=int(rpm) if rpm else None, tpm=int(tpm) if tpm else None)
+
+
+def backoff_delay(limiter, exc, attempt):
+    """
+    How long to wait after a rate-limit error: the provider's Retry-After when given, otherwise
+    exponential backoff with jitter capped at LLM_MAX_BACKOFF. The whole limiter is paused for
+    that long so concurrent requests don't keep hitting the limit.
+    """
+    learn_limits(limiter, exc)
+    delay = retry_after_seconds(exc)
+    if delay is None:
+        delay = min(LLM_MAX_BACKOFF, 2.0 * (2 ** attempt))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+    limiter.pause(delay)
+    return delay
+
+
+# Adaptive concurrency: the window of in-flight calls grows by one per window's worth of healthy
+# responses and is cut multiplicatively on rate limits, overload errors or latency spikes.
+LLM_INITIAL_CONCURRENCY = int(os.getenv("LLM_INITIAL_CONCURRENCY", "2") or 2)
+AIMD_DECREASE_FACTOR = 0.5
+AIMD_LATENCY_DECREASE_FACTOR = 0.75
+LATENCY_SPIKE_FACTOR = 3.0
+LATENCY_BASELINE_WEIGHT = 0.2
+MIN_LATENCY_SAMPLES = 3
+# After a cut, further failures within this many seconds belong to the same congestion event
+DECREASE_COOLDOWN = 2.0
+
+
+class ConcurrencyController:
+    """
+    AIMD limit on in-flight LLM calls for one provider/model. Use acquire()/release() (or the async
+    aacquire()) around each call and report its outcome with record(). on_change(old, new, reason) is
+    called whenever the whole-number window changes; history keeps the last changes.
+    """
+    def __init__(self, maximum, initial=None, minimum=1, on_change=None):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.window = float(min(self.maximum, max(minimum, initial or LLM_INITIAL_CONCURRENCY)))
+        self.in_flight = 0
+        self.on_change = on_change
+        self.history = deque(maxlen=50)
+        self.baseline_latency = None
+        self._latency_samples = 0
+        self._last_decrease = 0.0
+        self._successes = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()
+
+    @property
+    def limit(self):
+        return int(self.window)
+
+    def _try_acquire(self):
+        if self.in_flight < self.limit:
+            self.in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if self._try_acquire():
+                    return
+                ready = threading.Event()
+                self._waiters.append(ready.set)
+            ready.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._try_acquire():
+                    return
+                ready = loop.create_future()
+                waiter = lambda: loop.call_soon_threadsafe(_resolve, ready)
+                self._waiters.append(waiter)
+            try:
+                await ready
+            except asyncio.CancelledError:
+                # A cancelled waiter (e.g. a hedge that lost) must not swallow a wake-up meant for another call
+                with self._lock:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                    else:
+                        self._wake_waiters()
+                raise
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._wake_waiters()
+
+    def _wake_waiters(self):
+        # Woken waiters re-check the window themselves, so waking a few too many is harmless
+        for _ in range(max(0, self.limit - self.in_flight)):
+            if not self._waiters:
+                break
+            self._waiters.popleft()()
+
+    def record(self, latency, ok=True, overloaded=False):
+        """Feeds back one call: its latency, whether it succeeded, and whether it hit a rate limit or overload."""
+        change = None
+        with self._lock:
+            old_limit = self.limit
+            now = time.monotonic()
+            if overloaded:
+                change = self._decrease(now, AIMD_DECREASE_FACTOR, "rate limited / overloaded")
+            elif ok:
+                spike = (
+                    self._latency_samples >= MIN_LATENCY_SAMPLES
+                    and latency > LATENCY_SPIKE_FACTOR * self.baseline_latency
+                )
+                if self.baseline_latency is None:
+                    self.baseline_latency = latency
+                else:
+                    self.baseline_latency += LATENCY_BASELINE_WEIGHT * (latency - self.baseline_latency)
+                self._latency_samples += 1
+
+                if spike:
+                    change = self._decrease(now, AIMD_LATENCY_DECREASE_FACTOR, f"latency spike ({latency:.1f}s)")
+                else:
+                    self._successes += 1
+                    if self._successes >= self.limit:
+                        self._successes = 0
+                        self.window = min(float(self.maximum), self.window + 1)
+                        change = "healthy responses"
+
+            if self.limit == old_limit:
+                change = None
+            else:
+                self.history.append((time.time(), self.limit, change))
+                self._wake_waiters()
+            new_limit = self.limit
+
+        if change and self.on_change is not None:
+            try:
+                self.on_change(old_limit, new_limit, change)
+            except Exception:
+                pass
+
+    def _decrease(self, now, factor, reason):
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return None
+        self._last_decrease = now
+        self._successes = 0
+        self.window = max(float(self.minimum), self.window * factor)
+        return reason
+
+    def describe(self):
+        """One line for the log: current window, in-flight calls and the recent window history."""
+        steps = " -> ".join(str(limit) for _, limit, _ in self.history)
+        return f"window {self.limit}/{self.maximum}, {self.in_flight} in flight" + (f", history: {steps}" if steps else "")
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(provider_name, model_name, maximum, on_change=None, initial=None, api_key=""):
+    """The process-wide concurrency window of a provider/model/key (keys are only kept as a hash)."""
+    key = (provider_name, model_name, _key_fingerprint(api_key))
+    with _controllers_lock:
+        controller = _controllers.get(key)
+        if controller is None:
+            controller = ConcurrencyController(maximum, initial=initial, on_change=on_change)
+            _controllers[key] = controller
+        return controller
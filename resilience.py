@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import deque
+
+
+# Latencies kept per provider/model, and how many are needed before percentiles are trusted
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+# Never hedge sooner than this, however fast the provider usually is
+MIN_HEDGE_DELAY = 1.0
+
+# A provider/model/key is skipped after LLM_BREAKER_FAILURES failed calls in a row, and probed
+# again with a single call every LLM_BREAKER_RESET_SECONDS.
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5") or 0)
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "60") or 60)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class LatencyHistogram:
+    """Rolling window of recent call latencies (seconds) for one provider/model."""
+    def __init__(self, size=LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, q):
+        """The q-th percentile (0-100) of recent latencies, or None until MIN_LATENCY_SAMPLES are known."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        rank = max(0, math.ceil(q / 100.0 * len(samples)) - 1)
+        return samples[min(rank, len(samples) - 1)]
+
+    def describe(self):
+        if len(self) < MIN_LATENCY_SAMPLES:
+            return f"{len(self)} calls"
+        return ", ".join(f"p{q} {self.percentile(q):.1f}s" for q in (50, 95, 99)) + f" over {len(self)} calls"
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def get_histogram(provider_name, model_name):
+    key = (provider_name, model_name)
+    with _histograms_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            _histograms[key] = histogram
+        return histogram
+
+
+def hedge_delay(provider_name, model_name, percentile):
+    """Seconds to wait before hedging a call: the provider/model's latency percentile, or None when unknown or disabled."""
+    if not percentile:
+        return None
+    latency = get_histogram(provider_name, model_name).percentile(percentile)
+    return None if latency is None else max(MIN_HEDGE_DELAY, latency)
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing endpoint. Opens after failure_threshold consecutive failures; once
+    reset_timeout has passed, allow() lets one probe call through (half-open) and its outcome closes
+    or re-opens the circuit. on_change(old_state, new_state) is called on every transition.
+    """
+    def __init__(self, failure_threshold=None, reset_timeout=None, on_change=None):
+        self.failure_threshold = LLM_BREAKER_FAILURES if failure_threshold is None else failure_threshold
+        self.reset_timeout = LLM_BREAKER_RESET_SECONDS if reset_timeout is None else reset_timeout
+        self.on_change = on_change
+        self.failures = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def _set_state(self, state):
+        old_state, self._state = self._state, state
+        if state != old_state and self.on_change is not None:
+            self.on_change(old_state, state)
+
+    def allow(self):
+        """Whether a call may go out now. In the half-open state only one probe at a time is let through."""
+        if not self.failure_threshold:
+            return True
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            now = time.monotonic()
+            # A probe whose outcome never came back (e.g. a cancelled call) is given up on after reset_timeout
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                return False
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            self._probe_started = now
+            self._set_state(HALF_OPEN)
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probe_started = None
+            if self._state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            probe_failed = self._probe_started is not None
+            self._probe_started = None
+            if probe_failed or (self.failure_threshold and self.failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider_name, model_name, api_key, on_change=None):
+    """
+    The process-wide circuit breaker of a provider/model/key, so every session using the same key
+    shares what the others have learnt. Keys are only kept as a hash.
+    """
+    key = (provider_name, model_name, hashlib.sha256((api_key or "").encode("utf-8")).hexdigest())
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(on_change=on_change)
+            _breakers[key] = breaker
+        return breaker
+
+
+def _consume_result(task):
+    # Losers are cancelled and never awaited; reading their outcome keeps asyncio from warning about it
+    if not task.cancelled():
+        task.exception()
+
+
+async def hedged_call(primary, hedge=None, hedge_after=None, timeout=None, failover_on_error=False, on_hedge=None):
+    """
+    Awaits primary(). If hedge is given and primary has not answered within hedge_after seconds (or, with
+    failover_on_error, has failed), hedge() is started as well. The first successful answer wins and the
+    other call is cancelled. Returns (result, hedged) where hedged says whether the hedge answered.
+    When every call fails the primary's error is raised; TimeoutError when nothing answers within timeout.
+    on_hedge(reason) is called when the hedge starts.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = None if not timeout else started + timeout
+    hedge_at = None if hedge is None or hedge_after is None else started + hedge_after
+
+    tasks = {asyncio.ensure_future(primary()): False}
+    errors = {}
+
+    def start_hedge(reason):
+        nonlocal hedge
+        if on_hedge is not None:
+            on_hedge(reason)
+        tasks[asyncio.ensure_future(hedge())] = True
+        hedge = None
+
+    try:
+        while tasks:
+            wake_at = min((t for t in (deadline, hedge_at if hedge is not None else None) if t is not None), default=None)
+            done, _ = await asyncio.wait(
+                tasks, timeout=None if wake_at is None else max(0.0, wake_at - loop.time()),
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                hedged = tasks.pop(task)
+                if task.exception() is None:
+                    return task.result(), hedged
+                errors.setdefault(hedged, task.exception())
+                if not hedged and hedge is not None and failover_on_error:
+                    start_hedge("failed")
+
+            now = loop.time()
+            if deadline is not None and now >= deadline and tasks:
+                raise TimeoutError(f"LLM call timed out after {timeout:.0f}s")
+            if hedge is not None and hedge_at is not None and now >= hedge_at and tasks:
+                start_hedge("slow")
+
+        raise errors.get(False) or errors[True]
+    finally:
+        for task in tasks:
+            task.cancel()
+            task.add_done_callback(_consume_result)
@@ -0,0 +1,109 @@
+import json
+
+
+# Reply size estimates, in tokens, used to size max_tokens to the answer instead of a flat 8192.
+# Only the known short fields (SHORT_TEXT_FIELDS) get the small allowance; every other string, e.g. the
+# reason or an extraction field such as Abstract or Conclusion, is free text and gets the large one.
+STRING_TOKENS = 160
+SHORT_TEXT_FIELDS = ("status", "title", "author", "year", "paper_id")
+LONG_STRING_TOKENS = 1024
+NUMBER_TOKENS = 8
+KEY_TOKENS = 8
+OUTPUT_TOKEN_MARGIN = 1.5
+MIN_OUTPUT_TOKENS = 1024
+
+# Reasoning models spend max_tokens on their thinking as well, so their replies are never sized down
+REASONING_MODEL_HINTS = ("reasoner", "r1", "o1", "o3", "o4", "gpt-5", "think", "qwq", "qwen3", "glm-z1", "glm-4.5", "glm-4.6")
+
+# Name of the tool / response format the answer is returned through
+SCHEMA_NAME = "record_result"
+
+SCREENING_STATUSES = ("Include", "Exclude", "Maybe")
+
+
+def _object(properties):
+    # Strict structured output wants every property required and nothing else allowed
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def _screening_properties():
+    return {
+        "status": {"type": "string", "enum": list(SCREENING_STATUSES)},
+        "reason": {"type": "string"},
+        "title": {"type": "string"},
+        "author": {"type": "string"},
+        "year": {"type": "string"},
+        "confidence": {"type": "number"},
+    }
+
+
+def screening_schema():
+    """The screener's answer: status, reason, title, author, year and confidence."""
+    return _object(_screening_properties())
+
+
+def packed_screening_schema():
+    """Answers for several papers screened in one call, one "results" entry per paper_id."""
+    entry = _object({"paper_id": {"type": "string"}, **_screening_properties()})
+    return _object({"results": {"type": "array", "items": entry}})
+
+
+def extraction_schema(fields_list):
+    """The extractor's answer: one string per requested field under "extracted", plus confidence."""
+    extracted = _object({field: {"type": "string"} for field in fields_list})
+    return _object({"extracted": extracted, "confidence": {"type": "number"}})
+
+
+def _estimate(schema, name, array_items):
+    kind = schema.get("type")
+    if kind == "object":
+        return sum(KEY_TOKENS + _estimate(value, key, array_items) for key, value in schema["properties"].items())
+    if kind == "array":
+        return array_items * _estimate(schema["items"], name, array_items)
+    if kind == "string":
+        return STRING_TOKENS if name in SHORT_TEXT_FIELDS else LONG_STRING_TOKENS
+    return NUMBER_TOKENS
+
+
+def max_output_tokens(schema, model_name, default, array_items=1):
+    """max_tokens for a reply following schema (array_items entries per array), at most default."""
+    if schema is None or any(hint in model_name.lower() for hint in REASONING_MODEL_HINTS):
+        return default
+    estimate = int(_estimate(schema, None, array_items) * OUTPUT_TOKEN_MARGIN)
+    return min(default, max(MIN_OUTPUT_TOKENS, estimate))
+
+
+def openai_response_format(schema):
+    return {"type": "json_schema", "json_schema": {"name": SCHEMA_NAME, "schema": schema, "strict": True}}
+
+
+def anthropic_tool(schema):
+    return {
+        "name": SCHEMA_NAME,
+        "description": "Record the answer. Always call this tool exactly once.",
+        "input_schema": schema,
+    }
+
+
+def anthropic_reply_text(message):
+    """Text of an Anthropic message: the tool input as JSON when the answer came through the tool."""
+    for block in message.content:
+        if getattr(block, "type", None) == "tool_use":
+            return json.dumps(block.input)
+    return message.content[0].text
+
+
+def schema_from_openai_body(body):
+    """The schema of an OpenAI-style request body, or None when it asks for free text."""
+    response_format = body.get("response_format") or {}
+    return (response_format.get("json_schema") or {}).get("schema")
+
+
+def schema_key(schema):
+    """Stable text form of a schema, for cache keys."""
+    return json.dumps(schema, sort_keys=True)
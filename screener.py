@@ -3,17 +3,66 @@ import pandas as pd
 import plotly.express as px
 import time
 import gc
-import hashlib
+import json
 import os
 
 
 from utils import (
-    update_terminal_log, extract_pdf_content, preprocess_text_for_ai, 
+    update_terminal_log, extract_uploaded_pdfs, preprocess_text_for_ai, fit_prompt_to_model, 
     MAX_INPUT_TOKENS_SCREENER, MAX_OUTPUT_TOKENS, update_processing_stats,
-    to_docx, to_csv, to_excel, display_citation_section, query_llm
+    to_docx, to_csv, to_excel, display_citation_section, query_llm_many,
+    query_llm_batch, batch_mode_available, LLM_BATCH_MAX_PAPERS,
+    LLM_PACK_PAPERS, LLM_PACK_MAX_PAPER_TOKENS, LLM_PACK_MAX_PAPERS, LLM_STRUCTURED_OUTPUT,
+    warm_up_ollama
 )
-from parser import parse_result, df_from_results
+from parser import parse_result, parse_packed_result, df_from_results
 from confidence import estimate_confidence
+from sections import select_sections
+from budget import PAPER_TEXT_SLOT, count_tokens, get_context_window, pack_papers
+from schemas import screening_schema, packed_screening_schema, max_output_tokens as schema_output_tokens
+
+def add_cached_result(pdf, pdf_hash):
+    """Files a copy of the result for an identical, already screened file under this upload's name."""
+    update_terminal_log(f"Duplicate detected (Hash match). Using cached result.", "INFO")
+    cached_result = dict(st.session_state.batch_file_hashes[pdf_hash])
+    cached_result["filename"] = pdf.name
+    
+    status = cached_result.get("status", "").lower()
+    if "include" in status:
+        st.session_state.included_results.append(cached_result)
+    elif "exclude" in status:
+        st.session_state.excluded_results.append(cached_result)
+    elif "maybe" in status:
+        st.session_state.maybe_results.append(cached_result)
+    else:
+        st.session_state.excluded_results.append(cached_result)
+    
+    update_processing_stats("screener", 1)
+
+def build_packed_prompt(papers):
+    """User prompt that screens several short papers in one call, answered per paper ID (P1, P2, ...)."""
+    prompt = f"Screen each of the {len(papers)} papers below independently against the criteria above.\n"
+    for n, paper in enumerate(papers, 1):
+        prompt += f'\n**Paper ID: P{n}**\n\"\"\"\n{paper["paper_text"]}\n\"\"\"\n'
+    prompt += """
+Return ONE JSON object whose "results" array holds one entry per paper: the JSON format above plus the paper's "paper_id".
+{"results": [{"paper_id": "P1", "status": "Include", "reason": "...", "title": "...", "author": "...", "year": "2023", "confidence": 0.95}]}
+"""
+    return prompt
+
+def plan_screening_calls(papers, provider_name, model_name):
+    """
+    Groups papers into LLM calls: papers short enough to pack share calls under the token budget,
+    the rest get one call each. Returns lists of papers in upload order.
+    """
+    packable = [paper for paper in papers if paper.get("paper_text") is not None]
+    calls = [[paper] for paper in papers if paper.get("paper_text") is None]
+    # Half the context window leaves room for the criteria, the answers and the model's own overhead
+    capacity = min(MAX_INPUT_TOKENS_SCREENER, get_context_window(provider_name, model_name) // 2)
+    for group in pack_papers([paper["paper_tokens"] for paper in packable], capacity, LLM_PACK_MAX_PAPERS):
+        calls.append([packable[i] for i in group])
+    calls.sort(key=lambda call: call[0]["idx"])
+    return calls
 
 def find_exclusion_matches(text, exclusion_lists):
     matches = []
@@ -100,6 +149,14 @@ def run_screener():
             st.session_state['model_name'] = model_name
             st.session_state['api_key'] = api_key
 
+        if batch_mode_available(st.session_state.get('provider_name')):
+            st.session_state['batch_mode'] = st.checkbox(
+                "Batch API mode (large overnight runs)", value=False,
+                help=f"Submits all papers as one provider batch job: about half the price and up to {LLM_BATCH_MAX_PAPERS} papers, but results can take up to 24 hours."
+            )
+        else:
+            st.session_state['batch_mode'] = False
+
         st.markdown("---")
         st.markdown("### ℹ️ Info")
         st.info("Select a provider and enter the corresponding API key. For Ollama, ensure that server is running locally. 'Default' uses ReviewAid's own environment variables.")
@@ -191,15 +248,72 @@ def run_screener():
             update_terminal_log(f"Provider: {provider_for_call} | Model: {model_name}", "INFO")
             update_terminal_log(f"Files to process: {min(len(uploaded_pdfs), 2000)}", "INFO")
             update_terminal_log("Allocating resources...", "DEBUG")
+            if provider_for_call == "Ollama (Local)":
+                # Loads the local model while the PDFs are being read
+                warm_up_ollama(model_name, st.session_state.get('ollama_base_url', 'http://localhost:11434'))
 
-        max_papers = 21 
+        batch_mode = st.session_state.get('batch_mode', False) and batch_mode_available(provider_for_call)
+        max_papers = LLM_BATCH_MAX_PAPERS if batch_mode else 21 
         total_pdfs = min(len(uploaded_pdfs), max_papers)
         
         status_placeholder = st.empty()
         progress_bar = st.progress(0)
         
         papers_processed_in_batch = 0
-        
+
+        status_placeholder.markdown("<h4 style='text-align: center; color: #4189DC;'>Reading uploaded PDFs...</h4>", unsafe_allow_html=True)
+        pdf_hashes, pdf_contents = extract_uploaded_pdfs(uploaded_pdfs[:max_papers])
+
+        # Papers are prepared one by one, their prompts sent to the AI concurrently, then results filed in upload order
+        pending_papers = []
+        queued_hashes = set()
+
+        # Instructions and criteria are the same for every paper, so they form one system prompt that
+        # providers can cache as a prefix; each paper's prompt carries only its text.
+        system_prompt = f"""
+You are an expert systematic reviewer. Your task is to screen a research paper based on specific PICO criteria.
+
+**CRITICAL INSTRUCTION:**
+Return your response as a SINGLE valid JSON object. Do not include markdown formatting (like ```json), do not add comments, and do not include conversational filler text.
+
+**Population**
+Inclusion: {population_inclusion}
+Exclusion: {population_exclusion}
+
+**Intervention**
+Inclusion: {intervention_inclusion}
+Exclusion: {intervention_exclusion}
+
+**Comparison**
+Inclusion: {comparison_inclusion}
+Exclusion: {comparison_exclusion}
+
+**Outcomes**: {outcome_criteria}
+
+**Task:**
+1. Classify paper as "Include", "Exclude", or "Maybe" based strictly on the criteria.
+2. Provide a detailed reason for the classification.
+3. Extract the Paper Title, Main Author, and Publication Year.
+4. If a value is not found, use "Not Found".
+5. **CONFIDENCE SCORE**: Rate your confidence (0.0 to 1.0). 
+   - 1.0 = The paper perfectly matches or perfectly violates the criteria with explicit evidence.
+   - 0.8 - 0.9 = High confidence based on strong evidence.
+   - 0.5 - 0.7 = Moderate confidence (Some ambiguity in criteria or text).
+   - < 0.5 = Low confidence (Guessing, criteria vague, or text unclear).
+
+**JSON Format Required:**
+{{
+  "status": "Include",
+  "reason": "Detailed classification reason explaining why it fits or fails the criteria.",
+  "title": "Full paper title extracted from text",
+  "author": "Main author name",
+  "year": "2023",
+  "confidence": 0.95
+}}
+"""
+        # Providers that support it are held to these schemas, and replies get max_tokens sized to them
+        response_schema = screening_schema() if LLM_STRUCTURED_OUTPUT else None
+        packed_schema = packed_screening_schema() if LLM_STRUCTURED_OUTPUT else None
 
         for idx, pdf in enumerate(uploaded_pdfs[:max_papers], 1):
             
@@ -217,50 +331,28 @@ def run_screener():
        
             try:
                 start_time_file = time.time()
-                
 
-                try:
-                    pdf.seek(0)
-                    pdf_bytes = pdf.read()
-                except Exception as e:
-                    update_terminal_log(f"File read error for {pdf.name}: {str(e)}", "ERROR")
-                  
+                pdf_hash = pdf_hashes[idx - 1]
+                if pdf_hash is None:
                     progress_bar.progress(idx / total_pdfs)
                     continue
-                
-        
-                pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
-                
+
+                if pdf_hash in queued_hashes:
+                    # Same file as a paper still waiting on the AI; its result is copied once that arrives
+                    pending_papers.append({"idx": idx, "pdf": pdf, "pdf_hash": pdf_hash, "duplicate": True})
+                    continue
+
                 if pdf_hash in st.session_state.batch_file_hashes:
-       
-                    update_terminal_log(f"Duplicate detected (Hash match). Using cached result.", "INFO")
-                    cached_result = st.session_state.batch_file_hashes[pdf_hash]
-                    cached_result["filename"] = pdf.name
-                    
-                    status = cached_result.get("status", "").lower()
-                    if "include" in status:
-                        st.session_state.included_results.append(cached_result)
-                    elif "exclude" in status:
-                        st.session_state.excluded_results.append(cached_result)
-                    elif "maybe" in status:
-                        st.session_state.maybe_results.append(cached_result)
-                    else:
-                        st.session_state.excluded_results.append(cached_result)
-                    
-                    update_processing_stats("screener", 1)
+                    add_cached_result(pdf, pdf_hash)
                     
   
                     percent = int((idx / total_pdfs) * 100)
                     status_placeholder.markdown(f"<h4 style='text-align: center; color: #4189DC;'>{percent}% Work Done... Processing <span style='color: white'>{pdf.name}</span> (Cached)</h4>", unsafe_allow_html=True)
                     progress_bar.progress(idx / total_pdfs)
-                    
-          
-                    del pdf_bytes 
                     continue
                 
       
-                text, title, author, year = extract_pdf_content(pdf_bytes)
-                del pdf_bytes 
+                text, title, author, year, sections = pdf_contents.pop(pdf_hash, ("", "", "", "", {}))
 
                 if not text.strip():
                     update_terminal_log(f"PDF '{pdf.name}' appears empty or unreadable.", "WARN")
@@ -268,6 +360,8 @@ def run_screener():
                     continue
                 
                 full_text_backup = text
+                # Acknowledgements carry nothing the model needs
+                text = select_sections(text, sections, exclude=("Acknowledgements",))
                 text = preprocess_text_for_ai(text, max_tokens=MAX_INPUT_TOKENS_SCREENER)
 
        
@@ -346,93 +440,152 @@ def run_screener():
                     continue
                 
 
-                time.sleep(1) 
                 
                 prompt = f"""
-You are an expert systematic reviewer. Your task is to screen a research paper based on specific PICO criteria.
+**Paper Text:**
+\"\"\"
+{PAPER_TEXT_SLOT}
+\"\"\"
 
-**CRITICAL INSTRUCTION:**
-Return your response as a SINGLE valid JSON object. Do not include markdown formatting (like ```json), do not add comments, and do not include conversational filler text.
+Screen this paper against the criteria above and return the JSON object.
+"""
+                prompt_template = prompt
+                prompt, max_output_tokens = fit_prompt_to_model(
+                    prompt_template, full_text_backup, sections, provider_for_call, model_name,
+                    max_output_tokens=schema_output_tokens(response_schema, model_name, MAX_OUTPUT_TOKENS),
+                    max_input_tokens=MAX_INPUT_TOKENS_SCREENER,
+                    system_prompt=system_prompt
+                )
 
-**Population**
-Inclusion: {population_inclusion}
-Exclusion: {population_exclusion}
+                # Short papers (abstracts, letters) keep their fitted text so they can share a call
+                paper_text, paper_tokens = None, None
+                if LLM_PACK_PAPERS and not batch_mode:
+                    prefix, suffix = prompt_template.split(PAPER_TEXT_SLOT)
+                    fitted_text = prompt[len(prefix):len(prompt) - len(suffix)]
+                    paper_tokens = count_tokens(fitted_text, provider_for_call, model_name)
+                    if paper_tokens <= LLM_PACK_MAX_PAPER_TOKENS:
+                        paper_text = fitted_text
+                    del fitted_text
+                
+       
+                queued_hashes.add(pdf_hash)
+                pending_papers.append({
+                    "idx": idx, "pdf": pdf, "pdf_hash": pdf_hash, "start_time": start_time_file,
+                    "prompt": prompt, "max_output_tokens": max_output_tokens, "confidence": confidence,
+                    "paper_text": paper_text, "paper_tokens": paper_tokens,
+                    "title": title, "author": author, "year": year, "full_text_backup": full_text_backup
+                })
+                del prompt, text
 
-**Intervention**
-Inclusion: {intervention_inclusion}
-Exclusion: {intervention_exclusion}
+            except Exception as e:               
+                try:
+                    update_terminal_log(f"CRITICAL ERROR processing {pdf.name}: {str(e)}", "ERROR")
+                except:
+                    pass
+                try:
+                    import traceback
+                    update_terminal_log(f"Traceback: {traceback.format_exc()}", "ERROR")
+                except:
+                    pass
 
-**Comparison**
-Inclusion: {comparison_inclusion}
-Exclusion: {comparison_exclusion}
 
-**Outcomes**: {outcome_criteria}
+        llm_papers = [paper for paper in pending_papers if not paper.get("duplicate")]
 
-**Paper Text:**
-\"\"\"
-{text}
-\"\"\"
+        def file_raw_result(paper, raw_result):
+            paper["raw_result"] = raw_result
+            answered = sum(1 for paper in llm_papers if "raw_result" in paper)
+            status_placeholder.markdown(f"<h4 style='text-align: center; color: #4189DC;'>Waiting for AI responses... {answered}/{len(llm_papers)} received</h4>", unsafe_allow_html=True)
+            progress_bar.progress(answered / max(len(llm_papers), 1))
 
-**Task:**
-1. Classify paper as "Include", "Exclude", or "Maybe" based strictly on the criteria.
-2. Provide a detailed reason for the classification.
-3. Extract the Paper Title, Main Author, and Publication Year.
-4. If a value is not found, use "Not Found".
-5. **CONFIDENCE SCORE**: Rate your confidence (0.0 to 1.0). 
-   - 1.0 = The paper perfectly matches or perfectly violates the criteria with explicit evidence.
-   - 0.8 - 0.9 = High confidence based on strong evidence.
-   - 0.5 - 0.7 = Moderate confidence (Some ambiguity in criteria or text).
-   - < 0.5 = Low confidence (Guessing, criteria vague, or text unclear).
+        def send_screening_calls(calls):
+            """Sends one request per call and files each paper's raw result. Returns packed papers left without a valid answer."""
+            requests = []
+            for call in calls:
+                if len(call) == 1:
+                    call_prompt, call_max_tokens, call_schema = call[0]["prompt"], call[0]["max_output_tokens"], response_schema
+                else:
+                    # Packs use at most half the context window, so the other half bounds the answers
+                    packed_room = min(MAX_OUTPUT_TOKENS, get_context_window(provider_for_call, model_name) // 2)
+                    call_prompt, call_schema = build_packed_prompt(call), packed_schema
+                    call_max_tokens = schema_output_tokens(packed_schema, model_name, packed_room, array_items=len(call))
+                requests.append({"prompt": call_prompt, "system_prompt": system_prompt, "provider_name": provider_for_call, "api_key": api_key,
+                                 "model_name": model_name, "temperature": 0.1, "max_tokens": call_max_tokens, "response_schema": call_schema})
+            unanswered = []
+
+            def on_call_result(i, raw_result):
+                call = calls[i]
+                if len(call) == 1:
+                    file_raw_result(call[0], raw_result)
+                    return
+                # Valid entries are re-serialised so they go through parse_result like any single answer
+                entries = parse_packed_result(raw_result, [f"P{n}" for n in range(1, len(call) + 1)])
+                for n, paper in enumerate(call, 1):
+                    if entries[f"P{n}"] is None:
+                        unanswered.append(paper)
+                    else:
+                        file_raw_result(paper, json.dumps(entries[f"P{n}"]))
 
-**JSON Format Required:**
-{{
-  "status": "Include",
-  "reason": "Detailed classification reason explaining why it fits or fails the criteria.",
-  "title": "Full paper title extracted from text",
-  "author": "Main author name",
-  "year": "2023",
-  "confidence": 0.95
-}}
-"""
-                
-       
-                max_api_attempts = 3 
-                retries_per_api_attempt = 3
-                
-                for api_attempt in range(max_api_attempts):
-                    if api_attempt > 0:
-                        try:
-                            update_terminal_log("Previous attempt failed after retries. Initiating NEW API call for this paper...", "WARN")
-                        except:
-                            pass
-                    
-                    for retry_idx in range(retries_per_api_attempt):
-                        raw_result = query_llm(prompt, provider_for_call, api_key, model_name, temperature=0.1, max_tokens=8192)
-        
-                        if raw_result is None:
-                            try:
-                                update_terminal_log("API returned None after exhaustive retries. Falling back to Regex.", "ERROR")
-                            except:
-                                pass
-                            processing_successful = False
-                            break 
-                        
-                        if raw_result and raw_result.strip():
-                            processing_successful = True
-                            break 
-                        
-                        if retry_idx < retries_per_api_attempt - 1:
-                             try:
-                                 update_terminal_log(f"API returned empty response. Retry {retry_idx + 2}/{retries_per_api_attempt}...", "ERROR")
-                             except:
-                                 pass
-                             time.sleep(2)
-                    
-                    if processing_successful:
-                        break
-                
-       
-                del prompt 
+            query_llm_many(requests, on_result=on_call_result)
+            return unanswered
+
+        if llm_papers:
+            if batch_mode:
+                llm_requests = [
+                    {"prompt": paper["prompt"], "system_prompt": system_prompt, "provider_name": provider_for_call, "api_key": api_key,
+                     "model_name": model_name, "temperature": 0.1, "max_tokens": paper["max_output_tokens"], "response_schema": response_schema}
+                    for paper in llm_papers
+                ]
+
+                def on_batch_status(status):
+                    status_placeholder.markdown(f"<h4 style='text-align: center; color: #4189DC;'>Batch job {status['state']}... {status['done']}/{status['total']} done</h4>", unsafe_allow_html=True)
+                    progress_bar.progress(status['done'] / max(status['total'], 1))
+
+                try:
+                    update_terminal_log(f"Submitting {len(llm_papers)} papers to the {provider_for_call} batch API...", "INFO")
+                except:
+                    pass
+                status_placeholder.markdown("<h4 style='text-align: center; color: #4189DC;'>Submitting batch job...</h4>", unsafe_allow_html=True)
+                raw_results = query_llm_batch(llm_requests, [paper["pdf_hash"] for paper in llm_papers], on_status=on_batch_status)
+                for paper, raw_result in zip(llm_papers, raw_results):
+                    file_raw_result(paper, raw_result)
+                del llm_requests
+            else:
+                llm_calls = plan_screening_calls(llm_papers, provider_for_call, model_name)
+                try:
+                    update_terminal_log(f"Sending {len(llm_papers)} papers to {provider_for_call} in {len(llm_calls)} concurrent calls...", "INFO")
+                except:
+                    pass
+                status_placeholder.markdown(f"<h4 style='text-align: center; color: #4189DC;'>Waiting for AI responses... 0/{len(llm_papers)} received</h4>", unsafe_allow_html=True)
+                unanswered = send_screening_calls(llm_calls)
+                if unanswered:
+                    try:
+                        update_terminal_log(f"{len(unanswered)} packed paper(s) got no valid answer. Screening them individually...", "WARN")
+                    except:
+                        pass
+                    send_screening_calls([[paper] for paper in unanswered])
+                del llm_calls
+            for paper in llm_papers:
+                del paper["prompt"]
+                paper.pop("paper_text", None)
+
+        for paper in pending_papers:
+            idx, pdf, pdf_hash = paper["idx"], paper["pdf"], paper["pdf_hash"]
+            result = None
+            print(f"\n--- [SCREENER] Filing result {idx}/{total_pdfs}: {pdf.name} ---", flush=True)
+
+            try:
+                if paper.get("duplicate"):
+                    if pdf_hash in st.session_state.batch_file_hashes:
+                        add_cached_result(pdf, pdf_hash)
+                    progress_bar.progress(idx / total_pdfs)
+                    continue
+
+                start_time_file = paper["start_time"]
+                confidence = paper["confidence"]
+                title, author, year = paper["title"], paper["author"], paper["year"]
+                full_text_backup = paper.pop("full_text_backup")
+                raw_result = paper.pop("raw_result", None)
+                processing_successful = bool(raw_result and raw_result.strip())
                 
                 
                 if not processing_successful:
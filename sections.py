@@ -0,0 +1,130 @@
+import re
+
+
+SECTION_NAMES = [
+    "Abstract", "Introduction", "Methods", "Results", "Discussion",
+    "Acknowledgements", "Funding", "Conflicts of Interest", "Data Availability", "References", "Appendix",
+]
+
+# Back matter comes in no fixed order (Funding before Acknowledgements, an Appendix before the
+# References...), so these sections share one rank and only have to follow the body
+BACK_MATTER = ("Acknowledgements", "Funding", "Conflicts of Interest", "Data Availability", "References", "Appendix")
+
+# Heading wording -> canonical section. Headings must sit on their own line (optionally numbered),
+# so "Methods: ..." inside a structured abstract is not mistaken for the Methods section.
+_SECTION_ALIASES = {
+    "abstract": "Abstract",
+    "summary": "Abstract",
+    "introduction": "Introduction",
+    "background": "Introduction",
+    "methods": "Methods",
+    "method": "Methods",
+    "methodology": "Methods",
+    "materials and methods": "Methods",
+    "patients and methods": "Methods",
+    "methods and materials": "Methods",
+    "results": "Results",
+    "findings": "Results",
+    "results and discussion": "Results",
+    "discussion": "Discussion",
+    "conclusion": "Discussion",
+    "conclusions": "Discussion",
+    "acknowledgements": "Acknowledgements",
+    "acknowledgments": "Acknowledgements",
+    "acknowledgement": "Acknowledgements",
+    "acknowledgment": "Acknowledgements",
+    "funding": "Funding",
+    "funding sources": "Funding",
+    "financial support": "Funding",
+    "role of the funding source": "Funding",
+    "conflicts of interest": "Conflicts of Interest",
+    "conflict of interest": "Conflicts of Interest",
+    "competing interests": "Conflicts of Interest",
+    "declaration of interests": "Conflicts of Interest",
+    "declaration of competing interest": "Conflicts of Interest",
+    "disclosures": "Conflicts of Interest",
+    "data availability": "Data Availability",
+    "data availability statement": "Data Availability",
+    "availability of data and materials": "Data Availability",
+    "appendix": "Appendix",
+    "appendices": "Appendix",
+    "references": "References",
+    "reference": "References",
+    "bibliography": "References",
+}
+
+SECTION_HEADING_RE = re.compile(
+    r'^[ \t]*(?:(?:\d+(?:\.\d+)*|[IVX]+)\.?[ \t]+)?'
+    r'(' + "|".join(sorted((re.escape(alias) for alias in _SECTION_ALIASES), key=len, reverse=True)) + r')'
+    r'[ \t]*:?[ \t]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Abstracts are often run in with their first sentence ("Abstract: Background ...", "ABSTRACT We ...")
+ABSTRACT_INLINE_RE = re.compile(r'^[ \t]*abstract\b[ \t]*[:.\-–—]?', re.IGNORECASE | re.MULTILINE)
+
+
+def _rank(section):
+    return SECTION_NAMES.index(BACK_MATTER[0] if section in BACK_MATTER else section)
+
+
+def segment_sections(text):
+    """
+    Builds a section index for a paper: {section name: [start, end]} character offsets into text.
+    Only the first heading of each section is used and sections must appear in document order,
+    so a table of contents or a repeated heading later in the paper is ignored.
+    Sections whose heading is not found are simply absent. Spans are lists so the index stays JSON-friendly.
+    """
+    if not text:
+        return {}
+
+    headings = []
+    abstract_match = ABSTRACT_INLINE_RE.search(text)
+    if abstract_match:
+        headings.append((abstract_match.start(), "Abstract"))
+
+    last_rank = _rank("Abstract") if abstract_match else -1
+    last_start = abstract_match.start() if abstract_match else -1
+    for match in SECTION_HEADING_RE.finditer(text):
+        section = _SECTION_ALIASES[match.group(1).lower()]
+        rank = _rank(section)
+        if rank < last_rank or match.start() <= last_start or any(name == section for _, name in headings):
+            continue
+        headings.append((match.start(), section))
+        last_rank = rank
+        last_start = match.start()
+
+    index = {}
+    for i, (start, section) in enumerate(headings):
+        end = headings[i + 1][0] if i + 1 < len(headings) else len(text)
+        index[section] = [start, end]
+    return index
+
+
+def select_sections(text, index, include=None, exclude=()):
+    """
+    Returns only the parts of text a prompt needs, using a segment_sections index.
+    include keeps just the named sections (in document order); exclude drops the named sections and
+    keeps everything else, including any front matter before the first heading.
+    Falls back to the full text when the index has none of the included sections.
+    """
+    if not index:
+        return text
+
+    if include is not None:
+        spans = sorted(index[name] for name in include if name in index)
+        if not spans:
+            return text
+        return "\n".join(text[start:end] for start, end in spans)
+
+    dropped = sorted(index[name] for name in exclude if name in index)
+    if not dropped:
+        return text
+
+    parts = []
+    position = 0
+    for start, end in dropped:
+        parts.append(text[position:start])
+        position = max(position, end)
+    parts.append(text[position:])
+    return "".join(parts)
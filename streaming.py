@@ -0,0 +1,107 @@
+import re
+
+
+# Reasoning models may think aloud (with braces) before answering; that part is never scanned.
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+# A real answer object opens with a key (or is empty); "{placeholder}" style prose is skipped.
+OBJECT_START_RE = re.compile(r'\{\s*(?:"|\})')
+# A bare array of answer objects (e.g. several papers answered at once); "[1]" style prose is skipped.
+ARRAY_START_RE = re.compile(r'\[\s*\{\s*"')
+# What an answer may have received so far when its opening can't be told apart from prose yet
+PARTIAL_START_RE = {"{": re.compile(r'\{\s*'), "[": re.compile(r'\[\s*(?:\{\s*)?')}
+OPENER_RE = re.compile(r'[\[{]')
+
+
+class JsonObjectScanner:
+    """
+    Watches a reply arrive chunk by chunk and notices when the first complete top-level JSON object
+    (or array of objects) has been received, tracking strings and escapes so brackets inside values
+    don't count. feed() returns True once it is complete and text() then returns just that value.
+    """
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._in_think = False
+        self.end = None
+
+    @property
+    def complete(self):
+        return self.end is not None
+
+    @property
+    def length(self):
+        return len(self._buffer)
+
+    def feed(self, chunk):
+        if self.complete or not chunk:
+            return self.complete
+        self._buffer += chunk
+        self._scan()
+        return self.complete
+
+    def _scan(self):
+        text = self._buffer
+        while self._pos < len(text):
+            if self._start is None and not self._find_start(text):
+                return
+
+            char = text[self._pos]
+            self._pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = self._pos
+                    return
+
+    def _find_start(self, text):
+        """Moves _pos to the opening bracket of the answer; False when more text is needed."""
+        while True:
+            if self._in_think:
+                close = text.find(THINK_CLOSE, self._pos)
+                if close == -1:
+                    # Keep a possibly split closing tag for the next chunk
+                    self._pos = max(self._pos, len(text) - len(THINK_CLOSE) + 1)
+                    return False
+                self._in_think = False
+                self._pos = close + len(THINK_CLOSE)
+
+            opener = OPENER_RE.search(text, self._pos)
+            brace = -1 if opener is None else opener.start()
+            think = text.find(THINK_OPEN, self._pos)
+            if think != -1 and (brace == -1 or think < brace):
+                self._in_think = True
+                self._pos = think + len(THINK_OPEN)
+                continue
+            if brace == -1:
+                self._pos = max(self._pos, len(text) - len(THINK_OPEN) + 1)
+                return False
+            start_re = OBJECT_START_RE if text[brace] == "{" else ARRAY_START_RE
+            if start_re.match(text, brace):
+                self._start = self._pos = brace
+                return True
+            if PARTIAL_START_RE[text[brace]].fullmatch(text, brace):
+                # Can't tell yet whether this bracket opens the answer
+                self._pos = brace
+                return False
+            self._pos = brace + 1
+
+    def text(self):
+        """The complete answer once there is one (without fences or preamble), else the reply received so far."""
+        return self._buffer[self._start:self.end] if self.complete else self._buffer
@@ -1,6 +1,19 @@
 import sys
+import pytest
 from unittest.mock import MagicMock
 
 # Mock PaddleOCR and PaddlePaddle globally so tests don't crash on import
 sys.modules['paddleocr'] = MagicMock()
-sys.modules['paddlepaddle'] = MagicMock()
\ No newline at end of file
+sys.modules['paddlepaddle'] = MagicMock()
+
+# Keep on-disk caches isolated per test so results never leak between tests or into ~/.cache
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("REVIEWAID_CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+# Circuit breakers are process-wide; start every test with all circuits closed
+@pytest.fixture(autouse=True)
+def reset_circuit_breakers():
+    import resilience
+    resilience._breakers.clear()
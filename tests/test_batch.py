@@ -0,0 +1,61 @@
+import json
+
+from batch import LocalBatchBackend, DONE, RUNNING, parse_openai_output, wait_for_batch
+
+
+def _requests(*prompts):
+    return [
+        {"custom_id": f"paper-{i}", "messages": [{"role": "user", "content": prompt}], "temperature": 0.1, "max_tokens": 100}
+        for i, prompt in enumerate(prompts)
+    ]
+
+# 1. Test Local Stand-in Endpoint
+def test_local_backend_round_trip(tmp_path):
+    def responder(body):
+        prompt = body["messages"][0]["content"]
+        if prompt == "fail":
+            raise RuntimeError("model error")
+        return f'{{"answer": "{prompt}"}}'
+
+    backend = LocalBatchBackend(str(tmp_path), "gpt-4o", responder=responder)
+    batch_id = backend.submit(_requests("first", "fail", "third"))
+
+    input_line = json.loads((tmp_path / f"{batch_id}.input.jsonl").read_text().splitlines()[0])
+    assert input_line["url"] == "/v1/chat/completions"
+    assert input_line["body"]["model"] == "gpt-4o"
+
+    replies = wait_for_batch(backend, batch_id, poll_interval=0)
+    assert replies == {"paper-0": '{"answer": "first"}', "paper-1": None, "paper-2": '{"answer": "third"}'}
+
+def test_local_backend_waits_for_external_output(tmp_path):
+    backend = LocalBatchBackend(str(tmp_path), "gpt-4o")
+    batch_id = backend.submit(_requests("only"))
+
+    assert backend.status(batch_id)["state"] == RUNNING
+    assert wait_for_batch(backend, batch_id, poll_interval=0, timeout=0) is None
+
+    # another process answers the job
+    backend.process(batch_id, lambda body: "done")
+    assert backend.status(batch_id) == {"state": DONE, "done": 1, "total": 1}
+    assert wait_for_batch(backend, batch_id, poll_interval=0) == {"paper-0": "done"}
+
+def test_parse_openai_output_marks_errors():
+    output = "\n".join(json.dumps(line) for line in [
+        {"custom_id": "a", "response": {"status_code": 200, "body": {"choices": [{"message": {"content": "ok"}}]}}},
+        {"custom_id": "b", "response": {"status_code": 500, "body": {}}},
+        {"custom_id": "c", "response": None, "error": {"message": "expired"}},
+    ])
+    assert parse_openai_output(output) == {"a": "ok", "b": None, "c": None}
+
+def test_batch_requests_carry_the_response_schema():
+    from batch import AnthropicBatchBackend, _openai_request_line
+    import schemas
+    schema = schemas.screening_schema()
+    request = {"custom_id": "a", "messages": [{"role": "system", "content": "rules"}, {"role": "user", "content": "paper"}],
+               "temperature": 0.1, "max_tokens": 100, "schema": schema}
+
+    assert _openai_request_line(request, "gpt-4o")["body"]["response_format"] == schemas.openai_response_format(schema)
+    params = AnthropicBatchBackend(None, "claude")._params(request)
+    assert params["tools"][0]["input_schema"] is schema
+    assert params["tool_choice"] == {"type": "tool", "name": schemas.SCHEMA_NAME}
+    assert "response_format" not in _openai_request_line(dict(request, schema=None), "gpt-4o")["body"]
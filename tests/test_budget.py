@@ -0,0 +1,108 @@
+from unittest.mock import patch
+
+import budget
+from budget import PAPER_TEXT_SLOT, plan_prompt, get_context_window, count_tokens, pack_papers
+from sections import segment_sections
+
+
+PAPER = (
+    "A Trial\nAbstract\n" + "abstract words " * 50 + "\n"
+    "Introduction\n" + "intro words " * 400 + "\n"
+    "Methods\n" + "method words " * 100 + "\n"
+    "Acknowledgements\nThanks.\n"
+)
+
+# 1. Test Context Windows and Counting
+def test_context_window_lookup(monkeypatch):
+    monkeypatch.delenv("LLM_CONTEXT_WINDOW", raising=False)
+    assert get_context_window("OpenAI", "gpt-4o-mini") == 128000
+    assert get_context_window("OpenAI", "gpt-4") == 8192
+    assert get_context_window("Anthropic", "claude-sonnet-4-20250514") == 200000
+    assert get_context_window("Unknown", "model") == 128000
+
+    monkeypatch.setenv("LLM_CONTEXT_WINDOW", "4096")
+    assert get_context_window("OpenAI", "gpt-4o") == 4096
+
+def test_reported_context_window_takes_precedence(monkeypatch):
+    monkeypatch.delenv("LLM_CONTEXT_WINDOW", raising=False)
+    with patch.dict(budget._reported_windows, clear=True):
+        assert get_context_window("Ollama (Local)", "llama3.1:8b") == 32768
+        budget.set_context_window("Ollama (Local)", "llama3.1:8b", 8192)
+        assert get_context_window("Ollama (Local)", "llama3.1:8b") == 8192
+        assert get_context_window("Ollama (Local)", "qwen3:14b") == 32768
+
+def test_calibration_moves_estimate_towards_billed_tokens():
+    with patch.dict(budget._calibration, clear=True):
+        before = count_tokens("x" * 7000, "Cohere", "command-a-03-2025")
+        budget.calibrate("Cohere", "command-a-03-2025", 7000, 1000)
+        after = count_tokens("x" * 7000, "Cohere", "command-a-03-2025")
+
+    assert before == 2000
+    assert after == 1000
+
+def test_encoded_counts_are_cached_by_hash_not_by_text(monkeypatch):
+    from unittest.mock import MagicMock
+    encoding = MagicMock()
+    encoding.encode.side_effect = lambda text, disallowed_special: text.split()
+    monkeypatch.setattr(budget, "_get_encoding", lambda model_name: encoding)
+    monkeypatch.setattr(budget, "_token_counts", budget.OrderedDict())
+    monkeypatch.setattr(budget, "TOKEN_COUNT_CACHE_SIZE", 2)
+
+    paper = "word " * 1000
+    assert count_tokens(paper, "OpenAI", "gpt-4o") == 1000
+    assert count_tokens(paper, "OpenAI", "gpt-4o") == 1000
+    assert encoding.encode.call_count == 1
+    assert all(paper not in key for key in budget._token_counts)
+
+    count_tokens("two words", "OpenAI", "gpt-4o")
+    count_tokens("three more words", "OpenAI", "gpt-4o")
+    assert len(budget._token_counts) == 2
+
+# 2. Test Planning
+def test_plan_prompt_fits_without_trimming():
+    sections = segment_sections(PAPER)
+    plan = plan_prompt(f"Screen this:\n{PAPER_TEXT_SLOT}\nDone", PAPER, sections, "Anthropic", "claude", 8192, exclude=("Acknowledgements",))
+
+    assert "intro words" in plan["prompt"]
+    assert "Thanks." not in plan["prompt"]
+    assert plan["dropped_sections"] == [] and not plan["truncated"]
+    assert plan["max_output_tokens"] == 8192
+
+def test_plan_prompt_drops_low_priority_sections_first(monkeypatch):
+    monkeypatch.setenv("LLM_CONTEXT_WINDOW", "2400")
+    sections = segment_sections(PAPER)
+    plan = plan_prompt(f"Screen this:\n{PAPER_TEXT_SLOT}", PAPER, sections, "Anthropic", "claude", 8192)
+
+    assert plan["max_output_tokens"] == 1024
+    assert plan["dropped_sections"][0] == "Acknowledgements"
+    assert "Introduction" in plan["dropped_sections"]
+    assert "intro words" not in plan["prompt"]
+    assert "method words" in plan["prompt"] and "abstract words" in plan["prompt"]
+    assert plan["paper_tokens"] <= plan["budget_tokens"]
+
+def test_plan_prompt_truncates_when_sections_are_not_enough(monkeypatch):
+    monkeypatch.setenv("LLM_CONTEXT_WINDOW", "1500")
+    plan = plan_prompt(PAPER_TEXT_SLOT, "word " * 5000, {}, "Anthropic", "claude", 8192)
+
+    assert plan["truncated"]
+    assert 0 < plan["paper_tokens"] <= plan["budget_tokens"]
+
+def test_plan_prompt_leaves_room_for_system_prompt(monkeypatch):
+    monkeypatch.setenv("LLM_CONTEXT_WINDOW", "20000")
+    without = plan_prompt(PAPER_TEXT_SLOT, PAPER, {}, "Anthropic", "claude", 1024)
+    with_system = plan_prompt(PAPER_TEXT_SLOT, PAPER, {}, "Anthropic", "claude", 1024, system_prompt="criteria " * 700)
+
+    assert without["budget_tokens"] - with_system["budget_tokens"] == count_tokens("criteria " * 700, "Anthropic", "claude")
+
+# 3. Test Packing
+def test_pack_papers_respects_capacity_and_count():
+    token_counts = [900, 200, 300, 5000, 100, 400, 150]
+    packs = pack_papers(token_counts, capacity=1000, max_per_pack=3)
+
+    assert sorted(i for pack in packs for i in pack) == list(range(len(token_counts)))
+    assert all(len(pack) <= 3 for pack in packs)
+    # an item bigger than the capacity still gets a call of its own
+    assert [3] in packs
+    assert all(sum(token_counts[i] for i in pack) <= 1000 for pack in packs if pack != [3])
+    assert len(packs) == 4
+    assert [pack[0] for pack in packs] == sorted(pack[0] for pack in packs)
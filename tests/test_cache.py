@@ -0,0 +1,30 @@
+import pytest
+from cache import DiskCache
+
+
+def test_disk_cache_round_trip():
+    cache = DiskCache("test_round_trip", max_bytes=1024 * 1024)
+    cache.set("paper", ["full text", "Title", "Author", "2024"])
+
+    assert cache.get("paper") == ["full text", "Title", "Author", "2024"]
+    assert cache.get("missing") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_disk_cache_evicts_least_recently_used():
+    import os
+    cache = DiskCache("test_lru", max_bytes=2800)
+    for key in ["a", "b", "c"]:
+        cache.set(key, os.urandom(1000).hex())
+        cache.get("a")  # keep "a" hot
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+def test_disk_cache_disabled_with_empty_dir(monkeypatch):
+    monkeypatch.setenv("REVIEWAID_CACHE_DIR", "")
+    cache = DiskCache("test_disabled", max_bytes=1024)
+    cache.set("key", "value")
+
+    assert cache.get("key") is None
@@ -0,0 +1,58 @@
+from normalize import normalize_pages, find_repeated_lines
+
+
+def _page(number, body):
+    return (
+        f"Journal of Trials 2021;12:{number}\n"
+        f"{body}\n"
+        "second line of body\nthird line of body\nfourth line of body\n"
+        f"Downloaded from example.org on 1 May 2022\n"
+        f"{number}\n"
+    )
+
+PAGES = [_page(n, f"Body of page {n} with the eﬃcacy results") for n in range(1, 6)]
+
+# 1. Test Header/Footer Detection
+def test_find_repeated_lines_ignores_page_numbers_in_key():
+    repeated = find_repeated_lines(PAGES)
+    assert "journal of trials #;#:#" in repeated
+    assert find_repeated_lines(PAGES[:2]) == set()
+
+def test_normalize_pages_strips_headers_footers_and_boilerplate():
+    cleaned, saved = normalize_pages(PAGES)
+
+    assert len(cleaned) == 5
+    for n, page in enumerate(cleaned, 1):
+        assert "Journal of Trials" not in page
+        assert "Downloaded from" not in page
+        assert not page.rstrip().endswith(str(n))
+        assert f"Body of page {n} with the efficacy results" in page
+    assert saved == sum(len(p) for p in PAGES) - sum(len(p) for p in cleaned)
+    assert saved > 0
+
+# 2. Test In-Page Cleanup
+def test_normalize_pages_joins_hyphenation_and_keeps_table_numbers():
+    page = "Randomised treat-\nment arms\nTable 1\nGroup A\n42\n17\nGroup B\n39\nNotes\nlong tail\nend of page\n"
+    cleaned, _ = normalize_pages([page])
+
+    assert "treatment arms" in cleaned[0]
+    assert "\n42\n17\n" in cleaned[0]
+    assert "Group B\n39\n" in cleaned[0]
+
+def test_normalize_pages_drops_affiliation_blocks():
+    page = (
+        "A Trial of Things\nJ. Doe1, A. Roe2\n"
+        "1 Department of Surgery, University of Somewhere, Town, Country\n"
+        "2Institute of Health Research, Big City, Country\n"
+        "Author affiliations: see end of article\n"
+        "Department of Health guidance was followed in all centres.\n"
+        "Results were consistent\n"
+    )
+    cleaned, saved = normalize_pages([page])
+
+    assert "Department of Surgery" not in cleaned[0]
+    assert "Institute of Health Research" not in cleaned[0]
+    assert "Author affiliations" not in cleaned[0]
+    assert "J. Doe1, A. Roe2" in cleaned[0]
+    assert "Department of Health guidance was followed in all centres." in cleaned[0]
+    assert saved > 0
@@ -1,6 +1,6 @@
 
 import pytest
-from parser import clean_json_response, _regex_extract_fallback, parse_result
+from parser import clean_json_response, _regex_extract_fallback, parse_result, parse_packed_result
 from unittest.mock import patch
 
 # 1. Test JSON Cleaning
@@ -45,4 +45,40 @@ def test_parse_result_success(mock_log, mock_query):
     
     assert result["status"] == "Include"
     assert result["confidence"] == 0.9
-    assert not mock_query.called 
\ No newline at end of file
+    assert not mock_query.called 
+
+# 4. Test Packed Screening Results
+@patch('parser.update_terminal_log')
+def test_parse_packed_result_splits_and_validates(mock_log):
+    raw = """```json
+{"results": [
+  {"paper_id": "P1", "status": "Include", "reason": "RCT in adults", "title": "A", "confidence": 0.9},
+  {"paper_id": "P2", "status": "", "reason": "no decision"},
+  {"paper_id": "P4", "status": "Exclude", "reason": "not asked for"},
+  {"paper_id": "P3", "status": "Exclude", "reason": "first answer"},
+  {"paper_id": "P3", "status": "Include", "reason": "second answer"},
+]}
+```"""
+    results = parse_packed_result(raw, ["P1", "P2", "P3"])
+
+    assert results["P1"] == {"status": "Include", "reason": "RCT in adults", "title": "A", "confidence": 0.9}
+    assert results["P2"] is None  # fails validation
+    assert results["P3"] is None  # answered twice
+    assert "P4" not in results
+    assert parse_packed_result(None, ["P1"]) == {"P1": None}
+
+@patch('parser.update_terminal_log')
+def test_streamed_bare_array_reply_keeps_every_entry(mock_log):
+    from unittest.mock import MagicMock
+    import utils
+    reply = 'Here are the results:\n```json\n[{"paper_id": "P1", "status": "Include", "reason": "RCT"}, {"paper_id": "P2", "status": "Exclude", "reason": "children [aged 5-12]"}]\n```'
+    provider = MagicMock()
+    provider.stream.return_value = iter(reply[i:i + 5] for i in range(0, len(reply), 5))
+
+    with patch('utils.update_terminal_log'):
+        streamed = utils._read_stream(provider, "OpenAI", [], 0.1, 100)
+    results = parse_packed_result(streamed, ["P1", "P2"])
+
+    assert results["P1"] == {"status": "Include", "reason": "RCT"}
+    assert results["P2"] == {"status": "Exclude", "reason": "children [aged 5-12]"}
+
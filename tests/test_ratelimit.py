@@ -0,0 +1,139 @@
+import asyncio
+import types
+from unittest.mock import patch
+
+import ratelimit
+from ratelimit import RateLimiter, TokenBucket, ConcurrencyController, retry_after_seconds, backoff_delay
+
+
+def _rate_limit_error(headers):
+    error = Exception("Error code: 429 - rate limit")
+    error.response = types.SimpleNamespace(headers=headers)
+    return error
+
+# 1. Test Buckets
+def test_token_bucket_queues_callers_once_empty():
+    bucket = TokenBucket(60)  # one per second
+    assert bucket.reserve(60, bucket.updated) == 0.0
+    assert bucket.reserve(1, bucket.updated) == 1.0
+    assert bucket.reserve(1, bucket.updated) == 2.0
+    # refills at the configured rate
+    assert bucket.reserve(1, bucket.updated + 3.0) == 0.0
+
+def test_rate_limiter_charges_requests_and_tokens():
+    limiter = RateLimiter(rpm=600, tpm=6000)
+    assert limiter.reserve(6000) == 0.0
+    wait = limiter.reserve(3000)
+    assert 29.0 < wait <= 30.0
+
+    unlimited = RateLimiter()
+    assert all(unlimited.reserve(10 ** 9) == 0.0 for _ in range(5))
+
+def test_limiters_start_from_provider_defaults():
+    assert ratelimit.default_limits("Anthropic", "claude-sonnet-4-20250514") == (50, 0)
+    assert ratelimit.default_limits("Ollama (Local)", "llama3") == (0, 0)
+    with patch('ratelimit.LLM_RPM_LIMIT', 30):
+        assert ratelimit.default_limits("OpenAI", "gpt-4o") == (30, 0)
+
+def test_limiters_and_windows_are_kept_per_api_key():
+    trial = ratelimit.get_limiter("OpenAI", "gpt-4o-keyed", "trial-key")
+    assert ratelimit.get_limiter("OpenAI", "gpt-4o-keyed", "trial-key") is trial
+    paid = ratelimit.get_limiter("OpenAI", "gpt-4o-keyed", "paid-key")
+    trial.pause(60)
+    assert paid.reserve(1) == 0.0  # one account's 429 pause never holds up another's calls
+
+    window = ratelimit.get_controller("OpenAI", "gpt-4o-keyed", 8, api_key="trial-key")
+    assert ratelimit.get_controller("OpenAI", "gpt-4o-keyed", 8, api_key="paid-key") is not window
+    assert all("trial-key" not in part for key in list(ratelimit._limiters) + list(ratelimit._controllers) for part in key)
+
+# 2. Test Provider Feedback
+def test_retry_after_headers():
+    assert retry_after_seconds(_rate_limit_error({"retry-after-ms": "1500"})) == 1.5
+    assert retry_after_seconds(_rate_limit_error({"retry-after": "7"})) == 7.0
+    assert retry_after_seconds(_rate_limit_error({})) is None
+    assert retry_after_seconds(Exception("no response")) is None
+
+def test_backoff_learns_limits_and_pauses_everyone():
+    limiter = RateLimiter()
+    error = _rate_limit_error({"retry-after": "4", "x-ratelimit-limit-requests": "500", "x-ratelimit-limit-tokens": "30000"})
+
+    assert backoff_delay(limiter, error, attempt=0) == 4.0
+    assert (limiter.rpm, limiter.tpm) == (500, 30000)
+    assert 3.5 < limiter.reserve(1) <= 4.0
+
+def test_limits_are_read_from_successful_responses():
+    limiter = RateLimiter()
+    ratelimit.learn_limits_from_headers(limiter, {"x-ratelimit-limit-requests": "5000", "x-ratelimit-limit-tokens": "800000"})
+    assert (limiter.rpm, limiter.tpm) == (5000, 800000)
+    ratelimit.learn_limits_from_headers(limiter, None)
+    assert (limiter.rpm, limiter.tpm) == (5000, 800000)
+
+def test_backoff_without_retry_after_is_capped():
+    with patch('ratelimit.LLM_MAX_BACKOFF', 60):
+        delays = [backoff_delay(RateLimiter(), _rate_limit_error({}), attempt) for attempt in range(10)]
+    assert max(delays) <= 60
+    assert delays[0] <= 2
+
+# 3. Test Adaptive Concurrency
+def test_concurrency_grows_additively_and_halves_on_overload():
+    changes = []
+    controller = ConcurrencyController(8, initial=2, on_change=lambda old, new, reason: changes.append((old, new)))
+
+    for _ in range(2):  # one window's worth of healthy responses adds one slot
+        controller.record(1.0)
+    assert controller.limit == 3
+    for _ in range(40):
+        controller.record(1.0)
+    assert controller.limit == 8  # never above the cap
+
+    controller.record(1.0, ok=False, overloaded=True)
+    assert controller.limit == 4
+    controller.record(1.0, ok=False, overloaded=True)  # same congestion event, no second cut
+    assert controller.limit == 4
+    controller.record(1.0, ok=False)  # ordinary errors leave the window alone
+    assert controller.limit == 4
+    assert changes[0] == (2, 3) and changes[-1] == (8, 4)
+    assert "history: 3 -> 4" in controller.describe()
+
+def test_concurrency_cut_on_latency_spike():
+    controller = ConcurrencyController(8, initial=4)
+    for _ in range(3):
+        controller.record(1.0)
+    before = controller.limit
+    controller.record(10.0)
+    assert controller.limit < before
+
+def test_concurrency_window_limits_async_callers():
+    state = {"active": 0, "peak": 0}
+    controller = ConcurrencyController(8, initial=2)
+
+    async def call():
+        await controller.aacquire()
+        try:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+            await asyncio.sleep(0.01)
+            state["active"] -= 1
+        finally:
+            controller.release()
+
+    async def main():
+        await asyncio.gather(*(call() for _ in range(6)))
+
+    asyncio.run(main())
+    assert state["peak"] == 2
+    assert controller.in_flight == 0
+
+def test_cancelled_waiter_passes_its_wake_up_on():
+    async def run():
+        controller = ConcurrencyController(1, initial=1)
+        await controller.aacquire()
+        cancelled = asyncio.ensure_future(controller.aacquire())
+        waiting = asyncio.ensure_future(controller.aacquire())
+        await asyncio.sleep(0)
+        controller.release()
+        cancelled.cancel()
+        await asyncio.wait_for(waiting, timeout=1.0)
+        return controller.in_flight
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,129 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+import pytest
+
+import resilience
+from resilience import LatencyHistogram, hedged_call
+
+
+async def _answer(value, delay, log=None):
+    try:
+        await asyncio.sleep(delay)
+    except asyncio.CancelledError:
+        if log is not None:
+            log.append(f"cancelled {value}")
+        raise
+    return value
+
+
+async def _fail(message, delay=0.0):
+    await asyncio.sleep(delay)
+    raise RuntimeError(message)
+
+# 1. Test Latency Histograms
+def test_histogram_percentiles_need_enough_samples():
+    histogram = LatencyHistogram()
+    for seconds in range(1, resilience.MIN_LATENCY_SAMPLES):
+        histogram.record(float(seconds))
+    assert histogram.percentile(95) is None
+
+    for seconds in range(resilience.MIN_LATENCY_SAMPLES, 101):
+        histogram.record(float(seconds))
+    assert histogram.percentile(50) == 50.0
+    assert histogram.percentile(95) == 95.0
+    assert histogram.percentile(100) == 100.0
+    assert "p99 99.0s" in histogram.describe()
+
+def test_hedge_delay_uses_the_provider_percentile():
+    histogram = resilience.get_histogram("OpenAI", "hedge-delay-test")
+    assert resilience.hedge_delay("OpenAI", "hedge-delay-test", 95) is None
+    for _ in range(resilience.MIN_LATENCY_SAMPLES):
+        histogram.record(4.0)
+    assert resilience.hedge_delay("OpenAI", "hedge-delay-test", 95) == 4.0
+    assert resilience.hedge_delay("OpenAI", "hedge-delay-test", 0) is None
+
+    fast = resilience.get_histogram("OpenAI", "hedge-delay-fast")
+    for _ in range(resilience.MIN_LATENCY_SAMPLES):
+        fast.record(0.01)
+    assert resilience.hedge_delay("OpenAI", "hedge-delay-fast", 95) == resilience.MIN_HEDGE_DELAY
+
+# 2. Test Hedged Calls
+def test_slow_call_is_hedged_and_loser_cancelled():
+    log = []
+
+    async def run():
+        result = await hedged_call(
+            lambda: _answer("primary", 5.0, log),
+            hedge=lambda: _answer("hedge", 0.01, log),
+            hedge_after=0.05,
+            on_hedge=log.append
+        )
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == ("hedge", True)
+    assert log == ["slow", "cancelled primary"]
+
+def test_fast_call_is_never_hedged():
+    hedges = []
+    result = asyncio.run(hedged_call(lambda: _answer("primary", 0.01), hedge=lambda: _answer("hedge", 0.0), hedge_after=1.0, on_hedge=hedges.append))
+    assert result == ("primary", False)
+    assert hedges == []
+
+def test_failover_starts_at_once_when_the_primary_fails():
+    log = []
+    result = asyncio.run(hedged_call(
+        lambda: _fail("503 overloaded"),
+        hedge=lambda: _answer("backup", 0.01),
+        hedge_after=None,
+        failover_on_error=True,
+        on_hedge=log.append
+    ))
+    assert result == ("backup", True)
+    assert log == ["failed"]
+
+    # without failover the primary's error comes straight back
+    with pytest.raises(RuntimeError, match="503"):
+        asyncio.run(hedged_call(lambda: _fail("503 overloaded"), hedge=lambda: _answer("backup", 0.0)))
+
+def test_primary_error_is_raised_when_every_call_fails_and_hung_calls_time_out():
+    with pytest.raises(RuntimeError, match="primary"):
+        asyncio.run(hedged_call(lambda: _fail("primary", 0.05), hedge=lambda: _fail("hedge"), hedge_after=0.01))
+
+    with pytest.raises(TimeoutError, match="timed out"):
+        asyncio.run(hedged_call(lambda: _answer("hung", 5.0), timeout=0.05))
+
+# 3. Test Circuit Breakers
+def test_breaker_opens_after_consecutive_failures_and_probes_half_open():
+    changes = []
+    breaker = resilience.CircuitBreaker(failure_threshold=3, reset_timeout=60, on_change=lambda old, new: changes.append(new))
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()  # a success resets the count
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == resilience.OPEN
+    assert not breaker.allow()
+
+    with patch('resilience.time.monotonic', return_value=time.monotonic() + 61):
+        assert breaker.state == resilience.HALF_OPEN
+        assert breaker.allow()
+        assert not breaker.allow()  # one probe at a time
+        breaker.record_failure()
+        assert not breaker.allow()  # a failed probe re-opens the circuit at once
+
+    with patch('resilience.time.monotonic', return_value=time.monotonic() + 122):
+        assert breaker.allow()
+        breaker.record_success()
+    assert breaker.state == resilience.CLOSED and breaker.allow()
+    assert changes == [resilience.OPEN, resilience.HALF_OPEN, resilience.OPEN, resilience.HALF_OPEN, resilience.CLOSED]
+
+def test_breakers_are_shared_per_provider_model_and_key():
+    breaker = resilience.get_breaker("OpenAI", "gpt-4o", "key-a")
+    assert resilience.get_breaker("OpenAI", "gpt-4o", "key-a") is breaker
+    assert resilience.get_breaker("OpenAI", "gpt-4o", "key-b") is not breaker
+    assert resilience.get_breaker("OpenAI", "gpt-4o-mini", "key-a") is not breaker
+    assert all("key-a" not in part for key in resilience._breakers for part in key)
@@ -0,0 +1,60 @@
+import json
+import types
+
+import schemas
+from schemas import screening_schema, packed_screening_schema, extraction_schema, max_output_tokens
+
+
+def _objects(schema):
+    if schema.get("type") == "object":
+        yield schema
+        for value in schema["properties"].values():
+            yield from _objects(value)
+    elif schema.get("type") == "array":
+        yield from _objects(schema["items"])
+
+# 1. Test Schemas
+def test_schemas_follow_the_prompt_formats_and_are_strict():
+    assert set(screening_schema()["properties"]) == {"status", "reason", "title", "author", "year", "confidence"}
+    assert screening_schema()["properties"]["status"]["enum"] == ["Include", "Exclude", "Maybe"]
+    assert "paper_id" in packed_screening_schema()["properties"]["results"]["items"]["properties"]
+
+    extraction = extraction_schema(["Paper Title", "Sample Size (n)"])
+    assert list(extraction["properties"]["extracted"]["properties"]) == ["Paper Title", "Sample Size (n)"]
+    for schema in (screening_schema(), packed_screening_schema(), extraction):
+        for obj in _objects(schema):
+            assert obj["additionalProperties"] is False
+            assert obj["required"] == list(obj["properties"])
+
+# 2. Test Output Sizing
+def test_max_output_tokens_is_sized_to_the_schema():
+    single = max_output_tokens(screening_schema(), "gpt-4o", 8192)
+    assert schemas.MIN_OUTPUT_TOKENS <= single < 8192
+    assert max_output_tokens(packed_screening_schema(), "gpt-4o", 8192, array_items=3) > single
+    assert max_output_tokens(packed_screening_schema(), "gpt-4o", 8192, array_items=50) == 8192
+    assert max_output_tokens(extraction_schema([f"Field {i}" for i in range(5)]), "gpt-4o", 8192) < \
+        max_output_tokens(extraction_schema([f"Field {i}" for i in range(20)]), "gpt-4o", 8192)
+    # no schema, or a model that thinks within max_tokens, keeps the default
+    assert max_output_tokens(None, "gpt-4o", 8192) == 8192
+    assert max_output_tokens(screening_schema(), "deepseek-reasoner", 8192) == 8192
+    assert max_output_tokens(screening_schema(), "qwen3:14b", 8192) == 8192
+    assert max_output_tokens(screening_schema(), "glm-z1-32b", 8192) == 8192
+
+def test_free_text_fields_get_a_long_allowance():
+    # Abstract- or Conclusion-sized answers must fit; only the known short fields are sized down
+    assert max_output_tokens(extraction_schema(["Abstract"]), "gpt-4o", 8192) >= schemas.LONG_STRING_TOKENS
+    assert schemas._estimate({"type": "string"}, "Conclusion", 1) == schemas.LONG_STRING_TOKENS
+    assert schemas._estimate({"type": "string"}, "year", 1) == schemas.STRING_TOKENS
+
+# 3. Test Provider Formats
+def test_provider_formats_and_anthropic_tool_replies():
+    schema = screening_schema()
+    response_format = schemas.openai_response_format(schema)
+    assert response_format["json_schema"]["schema"] is schema
+    assert schemas.schema_from_openai_body({"response_format": response_format}) is schema
+    assert schemas.schema_from_openai_body({"messages": []}) is None
+
+    tool_reply = types.SimpleNamespace(content=[types.SimpleNamespace(type="tool_use", input={"status": "Include"})])
+    text_reply = types.SimpleNamespace(content=[types.SimpleNamespace(type="text", text="plain")])
+    assert json.loads(schemas.anthropic_reply_text(tool_reply)) == {"status": "Include"}
+    assert schemas.anthropic_reply_text(text_reply) == "plain"
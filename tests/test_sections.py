@@ -0,0 +1,60 @@
+from sections import segment_sections, select_sections
+
+PAPER = (
+    "A Randomised Trial of Things\nJ. Doe\n"
+    "Abstract: Background: we asked. Methods: we did. Results: it worked.\n"
+    "1. Introduction\nWhy it matters.\n"
+    "2. Materials and Methods\nWhat we did.\n"
+    "3 Results\nWhat we found.\n"
+    "Discussion\nWhat it means.\n"
+    "Acknowledgements\nThanks to the funders.\n"
+    "References\n1. Cited work\n"
+)
+
+# 1. Test Segmentation
+def test_segment_sections_finds_headings_in_order():
+    index = segment_sections(PAPER)
+
+    assert list(index) == ["Abstract", "Introduction", "Methods", "Results", "Discussion", "Acknowledgements", "References"]
+    assert PAPER[slice(*index["Methods"])].startswith("2. Materials and Methods")
+    assert "What we found." in PAPER[slice(*index["Results"])]
+    assert index["References"][1] == len(PAPER)
+    # the structured abstract's inline "Methods:" is not a section heading
+    assert index["Abstract"][1] == index["Introduction"][0]
+
+def test_segment_sections_back_matter_in_any_order():
+    paper = (
+        "Discussion\nWhat it means.\n"
+        "Funding\nThe agency paid.\n"
+        "Acknowledgements\nThanks to colleagues.\n"
+        "Competing Interests\nNone declared.\n"
+        "Appendix\nExtra tables.\n"
+        "References\n1. Cited work\n"
+    )
+    index = segment_sections(paper)
+
+    assert list(index) == ["Discussion", "Funding", "Acknowledgements", "Conflicts of Interest", "Appendix", "References"]
+    # leaving out the Acknowledgements keeps the funding and competing-interest statements
+    trimmed = select_sections(paper, index, exclude=("Acknowledgements",))
+    assert "Thanks to colleagues" not in trimmed
+    assert "The agency paid." in trimmed and "None declared." in trimmed
+
+def test_segment_sections_without_headings():
+    assert segment_sections("Just a block of text with no headings.") == {}
+    assert segment_sections("") == {}
+
+# 2. Test Selection
+def test_select_sections_include_and_exclude():
+    index = segment_sections(PAPER)
+
+    trimmed = select_sections(PAPER, index, exclude=("Acknowledgements",))
+    assert "Thanks to the funders" not in trimmed
+    assert trimmed.startswith("A Randomised Trial of Things")
+    assert "What it means." in trimmed and "Cited work" in trimmed
+
+    focused = select_sections(PAPER, index, include=("Results", "Methods"))
+    assert focused.index("What we did.") < focused.index("What we found.")
+    assert "Why it matters." not in focused
+
+    assert select_sections(PAPER, {}, exclude=("Acknowledgements",)) == PAPER
+    assert select_sections(PAPER, index, include=("Appendix",)) == PAPER
@@ -0,0 +1,35 @@
+from streaming import JsonObjectScanner
+
+
+def _feed_all(chunks):
+    scanner = JsonObjectScanner()
+    for chunk in chunks:
+        if scanner.feed(chunk):
+            break
+    return scanner
+
+# 1. Test Object Detection
+def test_scanner_stops_after_first_complete_object():
+    reply = '```json\n{"decision": "Include", "reason": "RCT {adults}", "quote": "a \\"}\\" b", "nested": {"x": 1}}\n```\nI hope this helps! {"extra": 1}'
+    chunks = [reply[i:i + 7] for i in range(0, len(reply), 7)]
+
+    scanner = _feed_all(chunks)
+
+    assert scanner.complete
+    assert scanner.text() == reply[reply.index("{"):reply.index("```\nI")].strip()
+
+def test_scanner_ignores_prose_braces_and_thinking():
+    reply = '<think>maybe {"decision": "Exclude"} ... no</think>Use {placeholder} style. {"decision": "Include"} trailing'
+    scanner = _feed_all(reply[i:i + 3] for i in range(0, len(reply), 3))
+    assert scanner.text() == '{"decision": "Include"}'
+
+def test_scanner_without_json_keeps_everything():
+    scanner = _feed_all(["no json ", "here {", "  "])
+    assert not scanner.complete
+    assert scanner.text() == "no json here {  "
+
+def test_scanner_reads_a_bare_array_of_objects_whole():
+    reply = 'See [1] below. [ {"paper_id": "P1"}, {"paper_id": "P2", "note": "]"} ] done'
+    scanner = _feed_all(reply[i:i + 2] for i in range(0, len(reply), 2))
+    assert scanner.text() == '[ {"paper_id": "P1"}, {"paper_id": "P2", "note": "]"} ]'
+
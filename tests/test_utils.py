@@ -1,3 +1,5 @@
+import io
+import json
 import pytest
 from unittest.mock import patch, MagicMock
 from utils import preprocess_text_for_ai, extract_pdf_content
@@ -52,6 +54,10 @@ def test_extract_pdf_content_with_ocr(mock_fitz, mock_log, mock_pytesseract):
     mock_page = MagicMock()
     mock_page.get_text.return_value = "Normal Text"
     mock_page.get_images.return_value = [[1]] # Simulate 1 image found
+    # Letter-sized page whose only text is a short caption, i.e. a scanned page
+    mock_page.rect.width = 612
+    mock_page.rect.height = 792
+    mock_page.get_pixmap.return_value.tobytes.return_value = b"rendered_page_png"
     
     mock_doc.__iter__.return_value = iter([mock_page])
     mock_fitz.open.return_value = mock_doc
@@ -75,4 +81,679 @@ def test_extract_pdf_content_with_ocr(mock_fitz, mock_log, mock_pytesseract):
         
         # Verify text contains both normal and OCR text
         assert "Normal Text" in text
-        assert "OCR Result" in text
\ No newline at end of file
+        assert "OCR Result" in text
+
+def _make_pdf(*page_texts):
+    import fitz
+    doc = fitz.open()
+    for page_text in page_texts:
+        page = doc.new_page()
+        page.insert_text((72, 72), page_text)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+# 4. Test Batch Extraction (Process Pool)
+def test_extract_pdf_batch_preserves_input_order():
+    from utils import extract_pdf_batch
+    pdfs = [_make_pdf(f"Paper number {i} about natalizumab") for i in range(4)]
+
+    with patch('utils.update_terminal_log') as mock_log:
+        results = extract_pdf_batch(pdfs, max_workers=2)
+
+    assert len(results) == 4
+    for i, (text, title, author, year) in enumerate(results):
+        assert f"Paper number {i}" in text
+    # the workers' normalization reports reach the terminal through the parent
+    assert any("Text normalization removed" in call.args[0] and "across 4 PDFs" in call.args[0] for call in mock_log.call_args_list)
+
+def test_extract_uploaded_pdfs_parses_duplicates_once():
+    from utils import extract_uploaded_pdfs
+    pdf_a = io.BytesIO(_make_pdf("First paper"))
+    pdf_a.name = "a.pdf"
+    pdf_b = io.BytesIO(_make_pdf("Second paper"))
+    pdf_b.name = "b.pdf"
+    pdf_a_copy = io.BytesIO(pdf_a.getvalue())
+    pdf_a_copy.name = "a_copy.pdf"
+
+    with patch('utils.extract_pdf_batch', side_effect=lambda items, **kw: [("text", "", "", "")] * len(items)) as mock_batch:
+        hashes, contents = extract_uploaded_pdfs([pdf_a, pdf_b, pdf_a_copy])
+
+    assert hashes[0] == hashes[2]
+    assert hashes[0] != hashes[1]
+    assert len(mock_batch.call_args[0][0]) == 2
+    assert set(contents) == {hashes[0], hashes[1]}
+
+@patch('utils.PDF_PARALLEL_PAGE_THRESHOLD', 10)
+def test_extract_pdf_content_page_ranges_match_serial():
+    pages = [f"Body text of page {i}" for i in range(39)] + ["Discussion\n\nReferences\n1. Cited work"]
+    pdf_bytes = _make_pdf(*pages)
+
+    serial = extract_pdf_content(pdf_bytes, page_workers=1)
+    parallel = extract_pdf_content(pdf_bytes, page_workers=2)
+
+    assert parallel == serial
+    assert "Body text of page 38" in parallel[0]
+    assert "Cited work" not in parallel[0]
+
+@patch('utils.PDF_PARALLEL_PAGE_THRESHOLD', 10)
+def test_extract_pdf_content_reparses_ranges_of_a_broken_pool():
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+    pages = [f"Body text of page {i}" for i in range(40)]
+    pdf_bytes = _make_pdf(*pages)
+
+    def broken_future(*args, **kwargs):
+        future = Future()
+        future.set_exception(BrokenProcessPool("worker died"))
+        return future
+
+    pool = MagicMock()
+    pool.submit.side_effect = broken_future
+    with patch('utils._get_pdf_pool', return_value=pool):
+        parallel = extract_pdf_content(pdf_bytes, page_workers=2)
+
+    assert pool.submit.call_count == 2
+    assert parallel == extract_pdf_content(pdf_bytes, page_workers=1)
+    assert "Body text of page 39" in parallel[0]
+
+def test_extract_uploaded_pdfs_reuses_cached_text():
+    from utils import extract_uploaded_pdfs
+    pdf = io.BytesIO(_make_pdf("Cached paper"))
+    pdf.name = "cached.pdf"
+
+    with patch('utils.extract_pdf_batch', return_value=[("Cached paper text", "T", "A", "2024")]):
+        hashes, first = extract_uploaded_pdfs([pdf])
+
+    with patch('utils.extract_pdf_batch', return_value=[]) as mock_batch:
+        _, second = extract_uploaded_pdfs([pdf])
+
+    assert mock_batch.call_args[0][0] == []
+    assert second[hashes[0]] == first[hashes[0]]
+
+    # OCR output is cached separately from plain text extraction
+    with patch('utils.extract_pdf_batch', return_value=[("OCR text", "T", "A", "2024")]) as mock_batch:
+        extract_uploaded_pdfs([pdf], enable_ocr=True)
+    assert len(mock_batch.call_args[0][0]) == 1
+
+def test_extract_uploaded_pdfs_spools_large_uploads():
+    import hashlib
+    import os
+    from utils import extract_uploaded_pdfs
+    pdf = io.BytesIO(_make_pdf("Spooled paper body"))
+    pdf.name = "large.pdf"
+    seen_sources = []
+
+    def fake_batch(sources, **kw):
+        seen_sources.extend(sources)
+        return [extract_pdf_content(source) for source in sources]
+
+    with patch('utils.PDF_SPOOL_THRESHOLD_MB', 0), patch('utils.extract_pdf_batch', side_effect=fake_batch):
+        hashes, contents = extract_uploaded_pdfs([pdf])
+
+    assert hashes[0] == hashlib.sha256(pdf.getvalue()).hexdigest()
+    assert isinstance(seen_sources[0], str)
+    assert not os.path.exists(seen_sources[0])
+    assert "Spooled paper body" in contents[hashes[0]][0]
+    # the upload buffer is left usable after hashing and spooling
+    pdf.write(b"%")
+
+# 5. Test Scanned-Page OCR
+def _make_mixed_pdf():
+    import fitz
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (600, 800), "white").save(buffer, format="PNG")
+    scan = buffer.getvalue()
+
+    doc = fitz.open()
+    born_digital = doc.new_page()
+    born_digital.insert_textbox(fitz.Rect(72, 72, 540, 400), "Born digital methods section. " * 40)
+    born_digital.insert_image(fitz.Rect(72, 420, 372, 720), stream=scan)
+    for _ in range(2):
+        scanned = doc.new_page()
+        scanned.insert_image(scanned.rect, stream=scan)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+def test_extract_pdf_content_ocrs_only_scanned_pages():
+    with patch('utils.run_tesseract_ocr', return_value=["Scanned results table"]) as mock_ocr:
+        text, _, _, _ = extract_pdf_content(_make_mixed_pdf(), enable_ocr=True, page_workers=1)
+
+    # Two identical scanned pages are rendered but OCR'd once; the born-digital page is not OCR'd
+    assert len(mock_ocr.call_args[0][0]) == 1
+    assert text.count("Scanned results table") == 2
+    assert text.index("Born digital") < text.index("Scanned results table")
+
+def test_extract_pdf_content_skips_ocr_for_text_layer_pages():
+    pdf_bytes = _make_pdf("Born digital page with a proper text layer. " * 20)
+
+    with patch('utils.run_tesseract_ocr') as mock_ocr:
+        text, _, _, _ = extract_pdf_content(pdf_bytes, enable_ocr=True, page_workers=1)
+
+    assert not mock_ocr.called
+    assert "Born digital" in text
+
+def test_run_tesseract_ocr_pool_preserves_order():
+    import types
+    import utils
+    from PIL import Image
+
+    def png(width):
+        buffer = io.BytesIO()
+        Image.new("RGB", (width, 10), "white").save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    fake_tesseract = types.SimpleNamespace(image_to_string=lambda image, config="": f"width={image.size[0]}")
+    utils.shutdown_ocr_pool()
+    try:
+        with patch('utils.pytesseract', fake_tesseract), patch('utils.OCR_WORKERS', 2):
+            texts = utils.run_tesseract_ocr([png(w) for w in (10, 20, 30, 40)])
+    finally:
+        utils.shutdown_ocr_pool()
+
+    assert texts == ["width=10", "width=20", "width=30", "width=40"]
+
+def test_run_tesseract_ocr_reuses_cached_text():
+    import utils
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (10, 10), "white").save(buffer, format="PNG")
+    images = [buffer.getvalue()]
+
+    with patch('utils.pytesseract') as mock_tesseract:
+        mock_tesseract.image_to_string.return_value = "Scanned words"
+        assert utils.run_tesseract_ocr(images) == ["Scanned words"]
+        assert utils.run_tesseract_ocr(images) == ["Scanned words"]
+
+    assert mock_tesseract.image_to_string.call_count == 1
+
+    with patch('utils.pytesseract') as mock_tesseract, patch('utils.TESSERACT_CONFIG', "--psm 6"):
+        mock_tesseract.image_to_string.return_value = "Different config"
+        assert utils.run_tesseract_ocr(images) == ["Different config"]
+
+def test_run_tesseract_ocr_does_not_cache_failures():
+    import utils
+
+    with patch('utils.pytesseract') as mock_tesseract:
+        mock_tesseract.image_to_string.side_effect = RuntimeError("tesseract missing")
+        assert utils.run_tesseract_ocr([b"not an image"]) == [""]
+        assert utils.run_tesseract_ocr([b"not an image"]) == [""]
+
+    assert utils.ocr_cache.get(utils._ocr_cache_key(utils.hashlib.sha256(b"not an image").hexdigest())) is None
+
+# 6. Test LLM Client Registry
+def test_shared_clients_are_reused_per_key_and_evicted_when_idle():
+    import utils
+    utils.shutdown_llm_clients()
+    created = []
+
+    def factory():
+        client = MagicMock()
+        created.append(client)
+        return client
+
+    first = utils.get_shared_client("openai", "key-a", None, factory)
+    assert utils.get_shared_client("openai", "key-a", None, factory) is first
+    assert utils.get_shared_client("openai", "key-b", None, factory) is not first
+    assert utils.get_shared_client("openai", "key-a", "https://api.deepseek.com", factory) is not first
+    assert len(created) == 3
+    assert all("key-a" not in str(key) for key in utils._client_registry)
+
+    with patch('utils.LLM_CLIENT_IDLE_TIMEOUT', -1):
+        utils.get_shared_client("ollama", "", "http://localhost:11434", factory)
+    # idle clients leave the registry but are not closed under a caller that may still hold them
+    assert all(entry[0] is not first for entry in utils._client_registry.values())
+    first.close.assert_not_called()
+
+    utils.shutdown_llm_clients()
+    assert utils._client_registry == {}
+
+def _reply_stream(*chunks):
+    return (chunk for chunk in chunks)
+
+@patch('utils.time.sleep')
+@patch('utils.update_terminal_log')
+def test_query_llm_builds_provider_once_across_retries(mock_log, mock_sleep):
+    import utils
+    provider = MagicMock()
+    provider.last_prompt_tokens = None
+    provider.stream.side_effect = [Exception("429 rate limit"), _reply_stream("ok")]
+
+    with patch('utils.get_provider_instance', return_value=provider) as mock_factory:
+        assert utils.query_llm("prompt", "OpenAI", "key", "gpt-4o") == "ok"
+
+    assert mock_factory.call_count == 1
+    assert provider.stream.call_count == 2
+
+@patch('utils.time.sleep')
+@patch('utils.update_terminal_log')
+def test_query_llm_fails_fast_once_the_circuit_opens(mock_log, mock_sleep):
+    import resilience
+    import utils
+    provider = MagicMock()
+    provider.stream.side_effect = Exception("500 internal server error")
+
+    with patch('utils.get_provider_instance', return_value=provider), \
+         patch('resilience.LLM_BREAKER_FAILURES', 3):
+        assert utils.query_llm("prompt", "OpenAI", "key", "gpt-4o") is None
+        assert provider.stream.call_count == 3  # the ladder stops as soon as the circuit opens
+        assert utils.query_llm("another prompt", "OpenAI", "key", "gpt-4o") is None
+        assert provider.stream.call_count == 3
+
+    assert utils.get_circuit_breaker("OpenAI", "gpt-4o", "key").state == resilience.OPEN
+    assert any("pausing calls" in call.args[0] for call in mock_log.call_args_list)
+
+@patch('utils.time.sleep')
+@patch('utils.update_terminal_log')
+def test_rate_limit_bursts_do_not_open_the_circuit(mock_log, mock_sleep):
+    import resilience
+    import utils
+    provider = MagicMock()
+    provider.last_prompt_tokens = None
+    provider.stream.side_effect = [Exception("Error code: 429 - rate limit")] * 5 + [_reply_stream("ok")]
+
+    with patch('utils.get_provider_instance', return_value=provider), \
+         patch('resilience.LLM_BREAKER_FAILURES', 3):
+        assert utils.query_llm("prompt", "OpenAI", "key", "gpt-4o-burst") == "ok"
+
+    assert provider.stream.call_count == 6
+    assert utils.get_circuit_breaker("OpenAI", "gpt-4o-burst", "key").state == resilience.CLOSED
+    assert utils._is_breaker_failure(Exception("Error code: 429 - You exceeded your current quota"))
+
+def test_breaker_counts_only_provider_side_failures():
+    import utils
+
+    class StatusError(Exception):
+        def __init__(self, status_code, message):
+            super().__init__(message)
+            self.status_code = status_code
+
+    assert utils._is_breaker_failure(StatusError(500, "Internal server error"))
+    assert utils._is_breaker_failure(StatusError(401, "Invalid API key"))
+    assert utils._is_breaker_failure(Exception("Error code: 403 - Forbidden"))
+    assert utils._is_breaker_failure(TimeoutError("Request timed out"))
+    assert utils._is_breaker_failure(ConnectionError("Connection refused"))
+    assert not utils._is_breaker_failure(StatusError(400, "This model's maximum context length is 8192 tokens"))
+    assert not utils._is_breaker_failure(Exception("Error code: 400 - flagged by content policy"))
+    assert not utils._is_breaker_failure(StatusError(404, "Not found"))
+    assert not utils._is_breaker_failure(Exception("context_length_exceeded"))
+
+@patch('utils.update_terminal_log')
+def test_query_llm_serves_repeated_prompts_from_cache(mock_log):
+    import utils
+    provider = MagicMock()
+    provider.last_prompt_tokens = None
+    provider.stream.side_effect = [_reply_stream(text) for text in ('{"n": 1}', '{"n": 2}', '{"n": 3}')]
+
+    with patch('utils.get_provider_instance', return_value=provider):
+        assert utils.query_llm("same prompt", "OpenAI", "key", "gpt-4o") == '{"n": 1}'
+        assert utils.query_llm("same prompt", "OpenAI", "key", "gpt-4o") == '{"n": 1}'
+        # a different output budget or a sampling temperature is a different call
+        assert utils.query_llm("same prompt", "OpenAI", "key", "gpt-4o", max_tokens=100) == '{"n": 2}'
+        assert utils.query_llm("same prompt", "OpenAI", "key", "gpt-4o", temperature=0.9) == '{"n": 3}'
+
+    assert provider.stream.call_count == 3
+
+@patch('utils.update_terminal_log')
+def test_query_llm_does_not_cache_cut_off_or_prose_replies(mock_log):
+    import utils
+    provider = MagicMock()
+    provider.last_prompt_tokens = None
+    replies = ['{"decision": "Incl', "I cannot answer that.", '{"decision": "Include"}', "unused"]
+    provider.stream.side_effect = [_reply_stream(text) for text in replies]
+
+    with patch('utils.get_provider_instance', return_value=provider):
+        assert utils.query_llm("prompt", "OpenAI", "key", "gpt-4o-cache") == '{"decision": "Incl'
+        assert utils.query_llm("prompt", "OpenAI", "key", "gpt-4o-cache") == "I cannot answer that."
+        assert utils.query_llm("prompt", "OpenAI", "key", "gpt-4o-cache") == '{"decision": "Include"}'
+        assert utils.query_llm("prompt", "OpenAI", "key", "gpt-4o-cache") == '{"decision": "Include"}'
+
+    assert provider.stream.call_count == 3
+
+@patch('utils.update_terminal_log')
+def test_query_llm_stops_streaming_at_complete_json(mock_log):
+    import utils
+    state = {"closed": False, "chunks": 0}
+
+    def rambling_reply(messages, temperature, max_tokens, schema=None):
+        try:
+            for chunk in ['{"decision": ', '"Include"}', "\nLet me explain"]:
+                state["chunks"] += 1
+                yield chunk
+            while True:
+                state["chunks"] += 1
+                yield " at length"
+        finally:
+            state["closed"] = True
+
+    provider = MagicMock()
+    provider.last_prompt_tokens = None
+    provider.stream.side_effect = rambling_reply
+
+    with patch('utils.get_provider_instance', return_value=provider):
+        assert utils.query_llm("prompt", "OpenAI", "key", "gpt-4o") == '{"decision": "Include"}'
+
+    assert state["chunks"] == 2
+    assert state["closed"]
+
+@patch('utils.update_terminal_log')
+def test_query_llm_batch_maps_replies_by_custom_id(mock_log, tmp_path):
+    import utils
+    requests = [
+        {"prompt": f"screen paper {i}", "provider_name": "Ollama (Local)", "api_key": "", "model_name": "llama3", "max_tokens": 100}
+        for i in range(3)
+    ]
+
+    def fake_query(prompt, *args, **kwargs):
+        return None if prompt.endswith("1") else f'{{"reply": "{prompt}"}}'
+
+    with patch('utils.LLM_BATCH_LOCAL_DIR', str(tmp_path)), \
+         patch('utils.query_llm', side_effect=fake_query) as mock_query, \
+         patch('utils.query_llm_many', return_value=[None]) as mock_many:
+        results = utils.query_llm_batch(requests, ["hash-a", "hash-b", "hash-c"])
+        assert results == ['{"reply": "screen paper 0"}', None, '{"reply": "screen paper 2"}']
+        assert len(list(tmp_path.glob("*.input.jsonl"))) == 1
+        # the line the job left unanswered is sent on its own instead of going to the regex fallback
+        assert [r["prompt"] for r in mock_many.call_args.args[0]] == ["screen paper 1"]
+
+        # answered papers come from the response cache; only the failed one is submitted again
+        results = utils.query_llm_batch(requests, ["hash-a", "hash-b", "hash-c"])
+        assert results == ['{"reply": "screen paper 0"}', None, '{"reply": "screen paper 2"}']
+        assert len(list(tmp_path.glob("*.input.jsonl"))) == 2
+        assert mock_query.call_count == 4
+
+@patch('utils.update_terminal_log')
+def test_failed_batch_job_falls_back_to_individual_calls(mock_log, tmp_path):
+    import utils
+    requests = [
+        {"prompt": f"screen paper {i}", "provider_name": "Ollama (Local)", "api_key": "", "model_name": "llama3", "max_tokens": 100}
+        for i in range(3)
+    ]
+    with patch('utils.LLM_BATCH_LOCAL_DIR', str(tmp_path)), \
+         patch('utils.batch.wait_for_batch', return_value=None), \
+         patch('utils.query_llm_many', side_effect=lambda reqs: [f"live {r['prompt']}" for r in reqs]) as mock_many:
+        results = utils.query_llm_batch(requests, ["hash-a", "hash-b", "hash-a"])
+
+    # the duplicate paper is sent once and its answer shared
+    assert [r["prompt"] for r in mock_many.call_args.args[0]] == ["screen paper 0", "screen paper 1"]
+    assert results == ["live screen paper 0", "live screen paper 1", "live screen paper 0"]
+
+@patch('utils.update_terminal_log')
+def test_batch_api_errors_fall_back_to_individual_calls(mock_log, tmp_path):
+    import utils
+    requests = [{"prompt": "screen paper 0", "provider_name": "OpenAI", "api_key": "key", "model_name": "gpt-4o", "max_tokens": 100}]
+    backend = MagicMock()
+    backend.submit.side_effect = Exception("Error code: 401 - invalid api key")
+    with patch('utils.get_batch_backend', return_value=backend), \
+         patch('utils.query_llm_many', return_value=["live answer"]) as mock_many:
+        assert utils.query_llm_batch(requests, ["hash-a"]) == ["live answer"]
+    assert mock_many.call_count == 1
+
+@patch('utils.update_terminal_log')
+def test_anthropic_caches_system_prompt_and_reports_cache_usage(mock_log):
+    import types
+    import ratelimit
+    import utils
+    client = MagicMock()
+    message = types.SimpleNamespace(
+        content=[types.SimpleNamespace(text='{"status": "Include"}')],
+        usage=types.SimpleNamespace(input_tokens=40, cache_read_input_tokens=1200, cache_creation_input_tokens=0)
+    )
+    headers = {"anthropic-ratelimit-requests-limit": "4000", "anthropic-ratelimit-input-tokens-limit": "2000000"}
+    client.messages.with_raw_response.create.return_value = types.SimpleNamespace(headers=headers, parse=lambda: message)
+
+    with patch('utils.get_shared_client', return_value=client):
+        provider = utils.AnthropicProvider("key", "claude-sonnet-4-20250514")
+        with patch('utils.get_provider_instance', return_value=provider), patch('utils.LLM_STREAMING', False):
+            result = utils.query_llm("paper text", "Anthropic", "key", provider.model_name, system_prompt="shared criteria")
+
+    assert result == '{"status": "Include"}'
+    kwargs = client.messages.with_raw_response.create.call_args.kwargs
+    assert kwargs["system"] == [{"type": "text", "text": "shared criteria", "cache_control": {"type": "ephemeral"}}]
+    assert kwargs["messages"] == [{"role": "user", "content": "paper text"}]
+    # cached prompt tokens still count as prompt tokens for the budget
+    assert provider.last_prompt_tokens == 1240
+    assert any("1200 tokens read" in call.args[0] for call in mock_log.call_args_list)
+    # the limits on a successful response are adopted before any 429 is seen
+    limiter = ratelimit.get_limiter("Anthropic", provider.model_name, "key")
+    assert (limiter.rpm, limiter.tpm) == (4000, 2000000)
+
+def test_cohere_sends_the_paper_as_message_and_the_system_prompt_as_preamble():
+    import utils
+    with patch('utils.get_shared_client', return_value=MagicMock()):
+        provider = utils.CohereProvider("key")
+    args = provider._chat_args(utils.build_messages("PAPER TEXT HERE", "SYSTEM INSTRUCTIONS"), 0.1, 1000)
+    assert args["message"] == "PAPER TEXT HERE"
+    assert args["preamble"] == "SYSTEM INSTRUCTIONS"
+    assert "preamble" not in provider._chat_args(utils.build_messages("PAPER TEXT HERE"), 0.1, 1000)
+
+@patch('utils.update_terminal_log')
+def test_query_llm_requests_structured_output_and_drops_rejected_schemas(mock_log):
+    import types
+    import schemas
+    import utils
+    schema = schemas.screening_schema()
+
+    client = MagicMock()
+    message = types.SimpleNamespace(
+        content=[types.SimpleNamespace(type="tool_use", input={"status": "Include", "reason": "fits"})],
+        usage=types.SimpleNamespace(input_tokens=40, cache_read_input_tokens=0, cache_creation_input_tokens=0)
+    )
+    client.messages.with_raw_response.create.return_value = types.SimpleNamespace(headers={}, parse=lambda: message)
+    with patch('utils.get_shared_client', return_value=client):
+        provider = utils.AnthropicProvider("key", "claude-sonnet-4-20250514")
+        with patch('utils.get_provider_instance', return_value=provider), patch('utils.LLM_STREAMING', False):
+            result = utils.query_llm("paper text", "Anthropic", "key", provider.model_name, response_schema=schema)
+    assert json.loads(result) == {"status": "Include", "reason": "fits"}
+    kwargs = client.messages.with_raw_response.create.call_args.kwargs
+    assert kwargs["tools"][0]["input_schema"] is schema
+    assert kwargs["tool_choice"]["name"] == schemas.SCHEMA_NAME
+
+    # A model without schema support is asked once, then only through the prompt
+    provider = MagicMock()
+    provider.last_prompt_tokens = None
+    provider.generate.side_effect = [Exception("Error code: 400 - 'response_format' json_schema is not supported with this model"), '{"status": "Exclude"}', '{"status": "Maybe"}']
+    with patch('utils.get_provider_instance', return_value=provider), patch('utils.LLM_STREAMING', False):
+        assert utils.query_llm("paper one", "OpenAI", "key", "gpt-4", response_schema=schema) == '{"status": "Exclude"}'
+        assert utils.query_llm("paper two", "OpenAI", "key", "gpt-4", response_schema=schema) == '{"status": "Maybe"}'
+    assert [call.args[3] for call in provider.generate.call_args_list] == [schema, None, None]
+
+def test_ollama_requests_pin_the_model_and_size_num_ctx():
+    import types
+    import budget
+    import utils
+    client = MagicMock()
+    client.show.return_value = types.SimpleNamespace(modelinfo={"general.architecture": "llama", "llama.context_length": 131072})
+
+    with patch('utils.get_shared_client', return_value=client), \
+         patch('utils.threading.Thread') as mock_thread, \
+         patch('utils.update_terminal_log'), \
+         patch.dict(budget._reported_windows, clear=True), \
+         patch.dict(utils._ollama_num_ctx, clear=True):
+        utils.warm_up_ollama("llama3.1:8b", "http://ollama:11434")
+        # the window is the model's own, capped for memory; the load itself runs in the background
+        assert budget.get_context_window("Ollama (Local)", "llama3.1:8b") == utils.OLLAMA_MAX_NUM_CTX
+        mock_thread.call_args.kwargs["target"]()
+        assert client.generate.call_args.kwargs["keep_alive"] == utils.OLLAMA_KEEP_ALIVE
+        assert client.generate.call_args.kwargs["options"] == {"num_ctx": utils.OLLAMA_MAX_NUM_CTX}
+
+        provider = utils.OllamaProvider("", "qwen3:14b", base_url="http://ollama:11434")
+        short = provider._chat_args([{"role": "user", "content": "x" * 7000}], 0.1, 1000)
+        assert short["keep_alive"] == utils.OLLAMA_KEEP_ALIVE
+        assert short["options"]["num_ctx"] == utils.OLLAMA_NUM_CTX_STEP
+        long = provider._chat_args([{"role": "user", "content": "x" * 70000}], 0.1, 1000)
+        assert long["options"]["num_ctx"] == 6 * utils.OLLAMA_NUM_CTX_STEP
+        # num_ctx never shrinks again, so the model isn't reloaded for the next short paper
+        assert provider._chat_args([{"role": "user", "content": "x"}], 0.1, 1000)["options"]["num_ctx"] == 6 * utils.OLLAMA_NUM_CTX_STEP
+
+    controller = utils.get_concurrency_controller("Ollama (Local)", "qwen3:14b")
+    assert controller.limit == controller.maximum == utils.OLLAMA_NUM_PARALLEL
+
+# 7. Test Concurrent LLM Dispatch
+def test_query_llm_many_runs_concurrently_in_request_order():
+    import asyncio
+    import ratelimit
+    import utils
+
+    state = {"active": 0, "peak": 0}
+
+    class FakeProvider(utils.BaseLLMProvider):
+        def generate(self, messages, temperature, max_tokens, schema=None):
+            raise AssertionError("the async path should be used")
+
+        async def agenerate(self, messages, temperature, max_tokens, schema=None):
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+            prompt = messages[0]["content"]
+            await asyncio.sleep(0.3 if prompt == "p0" else 0.01)
+            state["active"] -= 1
+            utils.update_terminal_log(f"answered {prompt}", "INFO")
+            return f"answer to {prompt}"
+
+    requests = [
+        {"prompt": f"p{i}", "provider_name": "OpenAI", "api_key": "key", "model_name": "gpt-4o", "max_tokens": 100}
+        for i in range(6)
+    ]
+    finished = []
+    # A wide adaptive window so only max_concurrency limits the calls in flight
+    controller = ratelimit.ConcurrencyController(8, initial=8)
+    with patch('utils.get_provider_instance', return_value=FakeProvider("key", "gpt-4o")), \
+         patch('utils.get_concurrency_controller', return_value=controller), \
+         patch('utils.update_terminal_log', wraps=utils.update_terminal_log) as mock_log:
+        results = utils.query_llm_many(requests, max_concurrency=3, on_result=lambda i, r: finished.append(i))
+
+    assert results == [f"answer to p{i}" for i in range(6)]
+    assert state["peak"] == 3
+    assert sorted(finished) == list(range(6))
+    assert finished[-1] == 0  # the slowest request does not hold up the others
+    # logs written on the LLM loop are replayed on the calling thread
+    assert any(call.args[0] == "answered p3" for call in mock_log.call_args_list)
+
+def test_query_llm_many_replays_logs_only_in_the_calling_session():
+    import asyncio
+    import threading
+    import utils
+
+    class FakeProvider(utils.BaseLLMProvider):
+        def generate(self, messages, temperature, max_tokens, schema=None):
+            raise AssertionError("the async path should be used")
+
+        async def agenerate(self, messages, temperature, max_tokens, schema=None):
+            await asyncio.sleep(0.05)
+            utils.update_terminal_log(f"answered {messages[0]['content']}", "INFO")
+            return "ok"
+
+    replayed = {}
+    original = utils.update_terminal_log
+
+    def log(msg, level="INFO"):
+        if threading.current_thread() is utils._llm_loop_thread:
+            return original(msg, level)
+        replayed.setdefault(threading.current_thread().name, []).append(msg)
+
+    def session(name):
+        requests = [{"prompt": f"{name}-{i}", "provider_name": "OpenAI", "api_key": "key", "model_name": "gpt-4o", "max_tokens": 100} for i in range(3)]
+        utils.query_llm_many(requests)
+
+    with patch('utils.get_provider_instance', return_value=FakeProvider("key", "gpt-4o")), \
+         patch('utils.LLM_STREAMING', False), \
+         patch('utils.update_terminal_log', side_effect=log):
+        sessions = [threading.Thread(target=session, args=(name,), name=name) for name in ("alice", "bob")]
+        for thread in sessions:
+            thread.start()
+        for thread in sessions:
+            thread.join()
+
+    for name in ("alice", "bob"):
+        answered = sorted(msg for msg in replayed[name] if msg.startswith("answered"))
+        assert answered == [f"answered {name}-{i}" for i in range(3)]
+
+def test_same_provider_hedges_take_a_slot_and_stop_when_the_window_shrinks():
+    import asyncio
+    import ratelimit
+    import utils
+
+    controller = ratelimit.ConcurrencyController(2, initial=2)
+    seen = []
+
+    class FakeProvider(utils.BaseLLMProvider):
+        def generate(self, messages, temperature, max_tokens, schema=None):
+            raise AssertionError("the async path should be used")
+
+        async def agenerate(self, messages, temperature, max_tokens, schema=None):
+            seen.append(controller.in_flight)
+            return "hedge answer"
+
+    messages = [{"role": "user", "content": "p"}]
+    with patch('utils.get_concurrency_controller', return_value=controller), \
+         patch('utils.get_provider_instance', return_value=FakeProvider("key", "gpt-4o")), \
+         patch('utils.LLM_STREAMING', False):
+        hedge, _, _ = utils._hedge_call("OpenAI", "key", "gpt-4o", {}, messages, 0.1, 100, 10)
+        result = asyncio.run(hedge())
+        assert result[0] == "hedge answer"
+        assert seen == [1] and controller.in_flight == 0
+
+        controller.window = 1.0
+        assert utils._hedge_call("OpenAI", "key", "gpt-4o", {}, messages, 0.1, 100, 10)[0] is None
+
+def test_request_timeout_only_fires_when_the_stream_goes_quiet():
+    import asyncio
+    import pytest
+    import utils
+
+    class FakeProvider(utils.BaseLLMProvider):
+        def __init__(self, pause):
+            super().__init__("key", "gpt-4o")
+            self.pause = pause
+
+        def generate(self, messages, temperature, max_tokens, schema=None):
+            raise AssertionError("the async path should be used")
+
+        async def astream(self, messages, temperature, max_tokens, schema=None):
+            for chunk in ('{"status": ', '"Include", ', '"reason": "slow but steady"}'):
+                await asyncio.sleep(self.pause)
+                yield chunk
+
+    with patch('utils.update_terminal_log'):
+        # 0.15s of streaming in total, but never 0.1s without a chunk
+        reply = asyncio.run(utils._aread_stream(FakeProvider(0.05), "OpenAI", [], 0.1, 100, idle_timeout=0.1))
+        assert reply == '{"status": "Include", "reason": "slow but steady"}'
+        with pytest.raises(TimeoutError, match="No data"):
+            asyncio.run(utils._aread_stream(FakeProvider(0.3), "OpenAI", [], 0.1, 100, idle_timeout=0.1))
+
+    assert utils._request_timeout("OpenAI") == utils.LLM_REQUEST_TIMEOUT
+    assert utils._request_timeout("Ollama (Local)") is None
+
+def test_query_llm_many_hedges_slow_calls_to_the_failover_provider():
+    import asyncio
+    import resilience
+    import utils
+
+    class FakeProvider(utils.BaseLLMProvider):
+        def generate(self, messages, temperature, max_tokens, schema=None):
+            raise AssertionError("the async path should be used")
+
+        async def agenerate(self, messages, temperature, max_tokens, schema=None):
+            # the primary hangs; the failover provider answers straight away
+            await asyncio.sleep(5.0 if self.model_name == "slow-model" else 0.01)
+            return f"answer from {self.model_name}"
+
+    histogram = resilience.get_histogram("OpenAI", "slow-model")
+    for _ in range(resilience.MIN_LATENCY_SAMPLES):
+        histogram.record(0.1)
+
+    request = {"prompt": "p", "provider_name": "OpenAI", "api_key": "key", "model_name": "slow-model", "max_tokens": 100}
+    with patch('utils.get_provider_instance', side_effect=lambda name, key, model, **kwargs: FakeProvider(key, model)), \
+         patch('utils.LLM_STREAMING', False), \
+         patch('utils.LLM_FAILOVER_PROVIDER', "DeepSeek"), \
+         patch('utils.LLM_FAILOVER_MODEL', "backup-model"), \
+         patch('resilience.MIN_HEDGE_DELAY', 0.05), \
+         patch('utils.update_terminal_log') as mock_log:
+        results = utils.query_llm_many([request])
+
+    assert results == ["answer from backup-model"]
+    assert any("hedged request to DeepSeek" in call.args[0] for call in mock_log.call_args_list)
@@ -10,6 +10,15 @@ import io
 import html
 import hashlib
 import gc
+import atexit
+import threading
+import asyncio
+import queue
+import contextvars
+import concurrent.futures
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from abc import ABC, abstractmethod
 from typing import List, Dict, Any
 from datetime import datetime
@@ -24,15 +33,27 @@ import base64
 import pytesseract
 from PIL import Image
 
+from cache import DiskCache
+from sections import segment_sections
+from normalize import normalize_pages
+from streaming import JsonObjectScanner
+import batch
+import budget
+import ratelimit
+import resilience
+import schemas
+
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
 except ImportError:
     OpenAI = None
+    AsyncOpenAI = None
 
 try:
-    from anthropic import Anthropic
+    from anthropic import Anthropic, AsyncAnthropic
 except ImportError:
     Anthropic = None
+    AsyncAnthropic = None
 
 try:
     import cohere
@@ -76,6 +97,43 @@ MAX_INPUT_TOKENS_SCREENER = 128000
 MAX_INPUT_TOKENS_EXTRACTOR = 128000 
 MAX_OUTPUT_TOKENS = 8192
 
+# Number of worker processes used to parse an upload batch. 0 means one per CPU core.
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", "0") or 0) or (os.cpu_count() or 1)
+
+# Documents with at least this many pages are split into page ranges and parsed in parallel.
+PDF_PARALLEL_PAGE_THRESHOLD = int(os.getenv("PDF_PARALLEL_PAGE_THRESHOLD", "100") or 100)
+PDF_PAGE_RANGE_MIN = 16
+
+PDF_TEXT_CACHE_MAX_MB = int(os.getenv("PDF_TEXT_CACHE_MAX_MB", "512") or 512)
+
+pdf_text_cache = DiskCache("pdf_text", max_bytes=PDF_TEXT_CACHE_MAX_MB * 1024 * 1024)
+
+OCR_CACHE_MAX_MB = int(os.getenv("OCR_CACHE_MAX_MB", "256") or 256)
+
+ocr_cache = DiskCache("ocr", max_bytes=OCR_CACHE_MAX_MB * 1024 * 1024)
+
+# Strip running headers/footers, page numbers and boilerplate from extracted text (see normalize.py)
+PDF_NORMALIZE_TEXT = os.getenv("PDF_NORMALIZE_TEXT", "1").strip().lower() not in ("0", "false", "no")
+
+# Uploads at least this large are spooled to a temp file and opened from disk instead of held as bytes
+PDF_SPOOL_THRESHOLD_MB = float(os.getenv("PDF_SPOOL_THRESHOLD_MB", "4") or 4)
+UPLOAD_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Tesseract worker processes for OCR mode, and the smallest embedded image (in pixels) worth OCRing.
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "0") or 0) or min(4, os.cpu_count() or 1)
+OCR_MIN_IMAGE_PIXELS = int(os.getenv("OCR_MIN_IMAGE_PIXELS", "10000") or 10000)
+# Pages with fewer extractable characters per square inch than this are treated as scanned and OCR'd.
+OCR_MIN_TEXT_DENSITY = float(os.getenv("OCR_MIN_TEXT_DENSITY", "1.0") or 1.0)
+OCR_RENDER_DPI = 300
+OCR_MAX_RENDER_PIXELS = 4000
+TESSERACT_CONFIG = os.getenv("TESSERACT_CONFIG", "")
+
+_pdf_pool = None
+_pdf_pool_workers = 0
+_pdf_pool_lock = threading.Lock()
+_ocr_pool = None
+_in_worker_process = False
+
 
 def get_firebase_stats():
     if db is None:
@@ -244,6 +302,14 @@ def update_processing_stats(mode, count=1):
         for _ in range(count): increment_firebase_counter("papers_extracted")
 
 def update_terminal_log(msg, level="INFO"):
+    if _in_worker_process:
+        return
+    if _llm_loop_thread is not None and threading.current_thread() is _llm_loop_thread:
+        # Session state belongs to the script thread; query_llm_many replays these there, in the calling session only
+        sink = _llm_log_sink.get()
+        if sink is not None:
+            sink.put((msg, level))
+        return
     if "terminal_logs" not in st.session_state or "terminal_placeholder" not in st.session_state:
         return
 
@@ -290,7 +356,204 @@ def update_terminal_log(msg, level="INFO"):
             pass
         st.session_state.last_log_update_time = current_time
 
-def extract_pdf_content(pdf_bytes, enable_ocr=False):
+def _open_pdf(source):
+    """Opens a PDF given either its bytes or a path on disk. Paths are read lazily by PyMuPDF."""
+    if isinstance(source, (str, os.PathLike)):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+REFERENCES_HEADING_RE = re.compile(r'(?:\n|\r\n){1,2}(References|Reference|Bibliography)(?:\s|\r?\n|$)', re.IGNORECASE)
+
+def _find_references_heading(page_text, prev_tail=""):
+    """
+    Returns the offset in page_text where the References/Bibliography section starts, or None.
+    prev_tail is the end of the previous page, so a heading at the top of a page is still found.
+    """
+    match = REFERENCES_HEADING_RE.search(prev_tail + page_text)
+    if not match:
+        return None
+    return max(0, match.start() - len(prev_tail))
+
+def _has_text_layer(page, page_text):
+    """True when the page carries real extractable text (at least OCR_MIN_TEXT_DENSITY characters per square inch)."""
+    area_sq_in = (page.rect.width / 72.0) * (page.rect.height / 72.0)
+    return len(page_text.strip()) / max(area_sq_in, 1.0) >= OCR_MIN_TEXT_DENSITY
+
+def _ocr_render_dpi(page):
+    """Renders at OCR_RENDER_DPI, scaled down for oversized pages so the image stays within OCR_MAX_RENDER_PIXELS per side."""
+    longest_side_in = max(page.rect.width, page.rect.height) / 72.0
+    return int(max(72, min(OCR_RENDER_DPI, OCR_MAX_RENDER_PIXELS / max(longest_side_in, 1.0))))
+
+def _read_page(doc, page, i, enable_ocr):
+    """
+    Returns (page_text, ocr_jobs) for a single page.
+    Pages with a text layer are never OCR'd. A page without one that holds at least one image of
+    OCR_MIN_IMAGE_PIXELS or more is treated as scanned: it is rendered once and returned as a
+    single (image_hash, png_bytes) OCR job.
+    """
+    page_text = page.get_text()
+    ocr_jobs = []
+
+    if enable_ocr:
+        try:
+            if not _has_text_layer(page, page_text):
+                image_list = page.get_images(full=True)
+                # get_images(full=True) entries carry the pixel size at positions 2 and 3
+                large_images = [img for img in image_list if len(img) <= 3 or img[2] * img[3] >= OCR_MIN_IMAGE_PIXELS]
+                if large_images:
+                    dpi = _ocr_render_dpi(page)
+                    update_terminal_log(f"Page {i+1}: No text layer found. Rendering at {dpi} DPI for OCR...", "INFO")
+                    pix = page.get_pixmap(dpi=dpi)
+                    image_bytes = pix.tobytes("png")
+                    del pix
+                    ocr_jobs.append((hashlib.sha256(image_bytes).hexdigest(), image_bytes))
+        except Exception as e:
+            update_terminal_log(f"Page {i+1}: Error preparing page for OCR - {str(e)}", "ERROR")
+
+    return page_text, ocr_jobs
+
+def _extract_page_range_worker(pdf_source, start, stop, enable_ocr):
+    doc = _open_pdf(pdf_source)
+    try:
+        return [_read_page(doc, doc[i], i, enable_ocr) for i in range(start, stop)]
+    finally:
+        doc.close()
+
+def _init_ocr_worker():
+    """Runs once in every OCR worker. Tesseract gets one thread per worker so workers don't oversubscribe cores."""
+    global _in_worker_process
+    _in_worker_process = True
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+def _ocr_image(image_bytes):
+    """Returns the recognised text, or None if Tesseract failed on this image."""
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        extracted_text = pytesseract.image_to_string(image, config=TESSERACT_CONFIG)
+        del image
+        return extracted_text
+    except Exception:
+        return None
+
+def _get_ocr_pool():
+    global _ocr_pool
+    if _ocr_pool is None:
+        _ocr_pool = ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=_init_ocr_worker)
+    return _ocr_pool
+
+def shutdown_ocr_pool():
+    global _ocr_pool
+    if _ocr_pool is not None:
+        _ocr_pool.shutdown(wait=False, cancel_futures=True)
+    _ocr_pool = None
+
+atexit.register(shutdown_ocr_pool)
+
+def _ocr_cache_key(image_hash):
+    config_hash = hashlib.sha256(TESSERACT_CONFIG.encode("utf-8")).hexdigest()[:16]
+    return f"{image_hash}:{config_hash}"
+
+def _run_tesseract_pool(images):
+    if len(images) == 1 or OCR_WORKERS <= 1 or _in_worker_process:
+        return [_ocr_image(image_bytes) for image_bytes in images]
+
+    try:
+        pool = _get_ocr_pool()
+        futures = [pool.submit(_ocr_image, image_bytes) for image_bytes in images]
+    except Exception:
+        return [_ocr_image(image_bytes) for image_bytes in images]
+
+    texts = []
+    for image_bytes, future in zip(images, futures):
+        try:
+            texts.append(future.result())
+        except BrokenProcessPool:
+            shutdown_ocr_pool()
+            texts.append(_ocr_image(image_bytes))
+        except Exception:
+            texts.append(None)
+    return texts
+
+def run_tesseract_ocr(images, image_hashes=None):
+    """
+    OCRs a list of encoded images and returns the recognised text for each, in input order.
+    Results are looked up in the on-disk OCR cache first (keyed by image hash and Tesseract config);
+    the rest run in a bounded process pool of OCR_WORKERS. Single images and calls made from
+    inside a worker process run inline.
+    """
+    if not images:
+        return []
+
+    if image_hashes is None:
+        image_hashes = [hashlib.sha256(image_bytes).hexdigest() for image_bytes in images]
+    cache_keys = [_ocr_cache_key(image_hash) for image_hash in image_hashes]
+
+    texts = [ocr_cache.get(key) for key in cache_keys]
+    missing = [i for i, extracted_text in enumerate(texts) if extracted_text is None]
+
+    if len(missing) < len(images):
+        try:
+            update_terminal_log(f"OCR cache: {len(images) - len(missing)} image(s) reused, {len(missing)} to OCR.", "INFO")
+        except:
+            pass
+
+    if missing:
+        fresh_texts = _run_tesseract_pool([images[i] for i in missing])
+        for i, extracted_text in zip(missing, fresh_texts):
+            if extracted_text is not None:
+                ocr_cache.set(cache_keys[i], extracted_text)
+            texts[i] = extracted_text
+
+    return [extracted_text or "" for extracted_text in texts]
+
+def _iter_pages_parallel(pdf_source, page_count, enable_ocr, page_workers):
+    """
+    Splits a long document into contiguous page ranges, parses them in the extraction pool
+    and yields page results back in document order. Closing the generator early cancels
+    ranges that have not started yet. A range whose worker crashed is parsed again in-process.
+    """
+    chunk_size = max(PDF_PAGE_RANGE_MIN, -(-page_count // page_workers))
+    ranges = [(start, min(start + chunk_size, page_count)) for start in range(0, page_count, chunk_size)]
+    pool = _get_pdf_pool(page_workers)
+    futures = [pool.submit(_extract_page_range_worker, pdf_source, start, stop, enable_ocr) for start, stop in ranges]
+    try:
+        for (start, stop), future in zip(ranges, futures):
+            try:
+                pages = future.result()
+            except BrokenProcessPool:
+                shutdown_pdf_pool()
+                try:
+                    update_terminal_log(f"Extraction worker crashed. Parsing pages {start + 1}-{stop} in-process.", "WARN")
+                except:
+                    pass
+                pages = _extract_page_range_worker(pdf_source, start, stop, enable_ocr)
+            yield from pages
+    finally:
+        for future in futures:
+            future.cancel()
+
+def _log_normalization(chars_saved, raw_length, papers=1):
+    scope = f" across {papers} PDFs" if papers > 1 else ""
+    try:
+        update_terminal_log(f"Text normalization removed {chars_saved} characters{scope} ({chars_saved / max(raw_length, 1):.1%}): running headers/footers, page numbers, boilerplate, hyphenation.", "INFO")
+    except:
+        pass
+
+def extract_pdf_content(pdf_source, enable_ocr=False, page_workers=None):
+    """
+    Extracts (text, title, author, year) from a PDF given as bytes or as a path on disk.
+    """
+    content, normalization = _extract_pdf(pdf_source, enable_ocr, page_workers)
+    if normalization is not None:
+        _log_normalization(*normalization)
+    return content
+
+def _extract_pdf(pdf_source, enable_ocr=False, page_workers=None):
+    """
+    extract_pdf_content without the normalization report: returns ((text, title, author, year), normalization)
+    where normalization is (chars_saved, raw_length), or None when the text was not normalized. Worker
+    processes cannot log, so the report is made by whoever collects the result.
+    """
     try:
         update_terminal_log("Initializing PDF extraction engine (PyMuPDF)...", "DEBUG")
     except:
@@ -298,7 +561,7 @@ def extract_pdf_content(pdf_bytes, enable_ocr=False):
         
     doc = None
     try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        doc = _open_pdf(pdf_source)
         page_count = doc.page_count
         try:
             update_terminal_log(f"Document opened successfully. Total pages: {page_count}", "INFO")
@@ -309,12 +572,29 @@ def extract_pdf_content(pdf_bytes, enable_ocr=False):
         full_text_parts = []
         current_length = 0
         references_found = False
+        prev_tail = ""
         
   
-        ocr_text_parts = []
-        total_images_found = 0
-        
-        for i, page in enumerate(doc):
+        ocr_jobs = {}
+        scanned_pages = []
+        ocr_pages_with_text = 0
+        normalization = None
+
+        if page_workers is None:
+            page_workers = PDF_EXTRACT_WORKERS
+        if _in_worker_process:
+            page_workers = 1
+
+        if page_workers > 1 and page_count >= PDF_PARALLEL_PAGE_THRESHOLD:
+            try:
+                update_terminal_log(f"Large document detected. Parsing page ranges across {page_workers} worker processes...", "INFO")
+            except:
+                pass
+            page_results = _iter_pages_parallel(pdf_source, page_count, enable_ocr, page_workers)
+        else:
+            page_results = (_read_page(doc, page, i, enable_ocr) for i, page in enumerate(doc))
+
+        for i, (page_text, page_ocr_jobs) in enumerate(page_results):
             if current_length > MAX_CHAR_LIMIT and not references_found:
                  try:
                      update_terminal_log(f"Token limit reached at Page {i+1}. Stopping PDF read.", "INFO")
@@ -322,69 +602,57 @@ def extract_pdf_content(pdf_bytes, enable_ocr=False):
                      pass
                  break
             
-            page_text = page.get_text()
-            
-            if re.search(r'(?:\n|\r\n){1,2}(References|Reference|Bibliography)(?:\s|\r?\n|$)', page_text, re.IGNORECASE):
+            if _find_references_heading(page_text, prev_tail) is not None:
                 references_found = True 
 
             full_text_parts.append(page_text)
             current_length += len(page_text)
             
-            
-            if enable_ocr:
-                try:
-                    image_list = page.get_images(full=True)
-                    if image_list:
-                        num_images_on_page = len(image_list)
-                        update_terminal_log(f"Page {i+1}: Found {num_images_on_page} image(s). Running Tesseract OCR...", "INFO")
-                        
-                        page_ocr_success = False
-                        
-                        for img in image_list:
-                            try:
-                                xref = img[0]
-                                base_image = doc.extract_image(xref)
-                                image_bytes = base_image["image"]
-                                image = Image.open(io.BytesIO(image_bytes))
-                                
-                          
-                                extracted_text = pytesseract.image_to_string(image)
-                                
-                                if extracted_text.strip():
-                                    ocr_text_parts.append(extracted_text)
-                                    page_ocr_success = True
-                                
-                                
-                                del image, image_bytes
-                                        
-                            except Exception:
-                             pass 
-                        
-                        if page_ocr_success:
-                            update_terminal_log(f"Page {i+1}: OCR complete.", "SUCCESS")
-                        
-                        total_images_found += num_images_on_page
-                except Exception as e:
-                    update_terminal_log(f"Page {i+1}: Error scanning for images - {str(e)}", "ERROR")
-   
+            for image_hash, image_bytes in page_ocr_jobs:
+                ocr_jobs.setdefault(image_hash, image_bytes)
+                scanned_pages.append((len(full_text_parts) - 1, image_hash))
+            prev_tail = page_text[-2:]
             
             del page_text 
+
+            # Everything from the references heading onwards is cut below, so later pages are never needed.
+            if references_found:
+                break
+
+        page_results.close()
+
+        if ocr_jobs:
+            try:
+                update_terminal_log(f"Running Tesseract OCR on {len(ocr_jobs)} scanned page(s) ({len(scanned_pages) - len(ocr_jobs)} duplicate page(s) skipped)...", "INFO")
+            except:
+                pass
+            ocr_texts = dict(zip(ocr_jobs, run_tesseract_ocr(list(ocr_jobs.values()), image_hashes=list(ocr_jobs))))
+            ocr_jobs.clear()
+
+            # OCR text takes the place of the missing text layer, so it keeps its position in the paper
+            for part_index, image_hash in scanned_pages:
+                extracted_text = ocr_texts.get(image_hash, "")
+                if extracted_text.strip():
+                    full_text_parts[part_index] = full_text_parts[part_index] + "\n" + extracted_text + "\n"
+                    ocr_pages_with_text += 1
+            del ocr_texts
             
+        if PDF_NORMALIZE_TEXT and full_text_parts:
+            raw_length = sum(len(part) for part in full_text_parts)
+            full_text_parts, chars_saved = normalize_pages(full_text_parts)
+            normalization = (chars_saved, raw_length)
+
         full_text = "".join(full_text_parts)
         del full_text_parts
         
-
-                
         if enable_ocr:
-            if total_images_found > 0:
-                ocr_content = "\n\n".join(ocr_text_parts)
-                full_text += "\n\n[OCR EXTRACTED CONTENT]:\n" + ocr_content
-                update_terminal_log(f"Finished. Total images OCR'd: {total_images_found} (Data Extracted from Images)", "SUCCESS")
+            if scanned_pages:
+                update_terminal_log(f"Finished. Total scanned pages OCR'd: {ocr_pages_with_text} (Data Extracted from Images)", "SUCCESS")
             else:
-                update_terminal_log("OCR Enabled, but no images were found in this document.", "WARN")
+                update_terminal_log("OCR Enabled, but every page already has a text layer. OCR skipped.", "INFO")
 
 
-        ref_match = re.search(r'(?:\n|\r\n){1,2}(References|Reference|Bibliography)(?:\s|\r?\n|$)', full_text, re.IGNORECASE)
+        ref_match = REFERENCES_HEADING_RE.search(full_text)
         
         if ref_match:
             main_text_end = ref_match.start()
@@ -395,80 +663,21 @@ def extract_pdf_content(pdf_bytes, enable_ocr=False):
                 pass
             del ref_match
 
-        metadata = doc.metadata
-        title = metadata.get('title', '')
-        author = metadata.get('author', '')
-        del metadata 
-        
-        try:
-            update_terminal_log(f"Metadata read -> Title: '{title}', Author: '{author}'", "DEBUG")
-        except:
-            pass
-    
-        if not title or len(title) < 5 or "microsoft" in title.lower() or ".doc" in title.lower() or title.isdigit():
-            try:
-                update_terminal_log("Metadata title appears empty or invalid. Scanning first page text for title...", "DEBUG")
-            except:
-                pass
-            
-            first_page_text = full_text[:3000]
-            lines = first_page_text.split('\n')
-            
-            for line in lines:
-                clean_line = line.strip()
-
-                if len(clean_line) > 10 and len(clean_line) < 200:
-                    if not re.match(r'^[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,}$', clean_line, re.IGNORECASE) and \
-                       not clean_line.startswith("http") and \
-                       "abstract" not in clean_line.lower() and \
-                       "introduction" not in clean_line.lower() and \
-                       "keywords" not in clean_line.lower() and \
-                       "page" not in clean_line.lower() and \
-                       "vol." not in clean_line.lower():
-                        
-
-                        title = clean_line
-                        try:
-                            update_terminal_log(f"Found candidate title in text: '{title[:50]}...'", "INFO")
-                        except:
-                            pass
-                        break
-        
-        year = ''
-        if not year:
-            if page_count > 0:
-                year_match = re.search(r'\b(19|20)\d{2}\b', full_text[:5000]) 
-                if year_match:
-                    year = year_match.group()
-                    try:
-                        update_terminal_log(f"Year found on Page 1: {year}", "DEBUG")
-                    except:
-                        pass
-        
-        if not year:
-            creation_date = doc.metadata.get('creationDate', '')
-            if creation_date:
-                year_match = re.search(r'\b(19|20)\d{2}\b', creation_date)
-                if year_match:
-                    year = year_match.group()
-                    try:
-                        update_terminal_log(f"Year derived from creationDate: {year}", "DEBUG")
-                    except:
-                        pass
+        title, author, year = _guess_bibliographic_fields(doc.metadata, full_text, page_count)
         
         # Perform garbage collection if OCR was used to make space to save RAM
-        if enable_ocr and total_images_found > 0:
+        if enable_ocr and scanned_pages:
             gc.collect()
             update_terminal_log("OCR'd images will be cleared to save space.", "SYSTEM")
 
-        return full_text, title, author, year
+        return (full_text, title, author, year), normalization
         
     except Exception as e:
         try:
             update_terminal_log(f"Error during PDF extraction: {str(e)}", "ERROR")
         except:
             pass
-        return "", "", "", ""
+        return ("", "", "", ""), None
     finally:
         if doc:
             doc.close()
@@ -485,9 +694,336 @@ def preprocess_text_for_ai(text, max_tokens=MAX_INPUT_TOKENS_SCREENER):
         except:
             pass
         text = text[:char_limit]
-    
+
     return text
 
+def fit_prompt_to_model(prompt, paper_text, sections, provider_name, model_name, max_output_tokens, max_input_tokens=None, system_prompt=""):
+    """
+    Places the paper into prompt (at budget.PAPER_TEXT_SLOT) trimmed to the chosen model's context window,
+    leaving room for system_prompt. Acknowledgements are always left out. Returns (prompt, max_output_tokens).
+    """
+    plan = budget.plan_prompt(
+        prompt, paper_text, sections, provider_name, model_name,
+        max_output_tokens=max_output_tokens,
+        max_input_tokens=max_input_tokens,
+        exclude=("Acknowledgements",),
+        system_prompt=system_prompt
+    )
+    try:
+        update_terminal_log(f"Prompt budget: paper {plan['paper_tokens']}/{plan['budget_tokens']} tokens, {plan['max_output_tokens']} reserved for output.", "DEBUG")
+        if plan["dropped_sections"]:
+            update_terminal_log(f"Paper too long for {model_name}. Left out: {', '.join(plan['dropped_sections'])}.", "WARN")
+        if plan["truncated"]:
+            update_terminal_log(f"Paper text cut to fit the {model_name} context window.", "WARN")
+    except:
+        pass
+    return plan["prompt"], plan["max_output_tokens"]
+
+def _init_pdf_worker():
+    """Runs once in every extraction worker: preloads PyMuPDF and silences terminal logging."""
+    global _in_worker_process
+    _in_worker_process = True
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    fitz.TOOLS.mupdf_display_errors(False)
+
+def _extract_pdf_worker(pdf_source, enable_ocr):
+    return _extract_pdf(pdf_source, enable_ocr=enable_ocr)
+
+def _get_pdf_pool(max_workers):
+    global _pdf_pool, _pdf_pool_workers
+    # Sessions run on their own threads; without the lock two of them could each start a pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None or _pdf_pool_workers < max_workers:
+            if _pdf_pool is not None:
+                _pdf_pool.shutdown(wait=False, cancel_futures=True)
+            _pdf_pool = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_pdf_worker)
+            _pdf_pool_workers = max_workers
+        return _pdf_pool
+
+def shutdown_pdf_pool():
+    global _pdf_pool, _pdf_pool_workers
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+        _pdf_pool_workers = 0
+
+atexit.register(shutdown_pdf_pool)
+
+def _count_pages(pdf_source):
+    try:
+        with _open_pdf(pdf_source) as doc:
+            return doc.page_count
+    except Exception:
+        return 0
+
+def extract_pdf_batch(pdf_sources, enable_ocr=False, max_workers=None):
+    """
+    Runs extract_pdf_content over a whole upload batch (bytes or file paths) in a process pool.
+    Returns one (text, title, author, year) tuple per input, in input order.
+    """
+    if not pdf_sources:
+        return []
+
+    max_workers = max_workers or PDF_EXTRACT_WORKERS
+    workers = min(max_workers, len(pdf_sources))
+
+    if workers <= 1:
+        return [extract_pdf_content(pdf_source, enable_ocr=enable_ocr, page_workers=max_workers) for pdf_source in pdf_sources]
+
+    try:
+        update_terminal_log(f"Parsing {len(pdf_sources)} PDFs across {workers} worker processes...", "INFO")
+    except:
+        pass
+
+    # Long documents are split into page ranges on the same pool instead of occupying one worker.
+    long_docs = {i for i, pdf_source in enumerate(pdf_sources) if _count_pages(pdf_source) >= PDF_PARALLEL_PAGE_THRESHOLD}
+
+    try:
+        pool = _get_pdf_pool(max_workers)
+        futures = {
+            i: pool.submit(_extract_pdf_worker, pdf_source, enable_ocr)
+            for i, pdf_source in enumerate(pdf_sources) if i not in long_docs
+        }
+    except Exception as e:
+        try:
+            update_terminal_log(f"Extraction pool unavailable ({str(e)}). Parsing serially.", "WARN")
+        except:
+            pass
+        return [extract_pdf_content(pdf_source, enable_ocr=enable_ocr, page_workers=1) for pdf_source in pdf_sources]
+
+    long_results = {
+        i: extract_pdf_content(pdf_sources[i], enable_ocr=enable_ocr, page_workers=max_workers)
+        for i in sorted(long_docs)
+    }
+
+    results = []
+    # Workers can't write to the terminal, so their normalization reports are summed up here
+    normalized = []
+    for i, pdf_source in enumerate(pdf_sources):
+        if i in long_results:
+            results.append(long_results.pop(i))
+            continue
+        future = futures[i]
+        try:
+            content, normalization = future.result()
+            results.append(content)
+            if normalization is not None:
+                normalized.append(normalization)
+        except BrokenProcessPool:
+            shutdown_pdf_pool()
+            try:
+                update_terminal_log("Extraction worker crashed. Retrying this paper in-process.", "WARN")
+            except:
+                pass
+            results.append(extract_pdf_content(pdf_source, enable_ocr=enable_ocr, page_workers=1))
+        except Exception as e:
+            try:
+                update_terminal_log(f"Error during PDF extraction: {str(e)}", "ERROR")
+            except:
+                pass
+            results.append(("", "", "", ""))
+
+    if normalized:
+        _log_normalization(sum(n[0] for n in normalized), sum(n[1] for n in normalized), papers=len(normalized))
+    return results
+
+def _pdf_cache_key(pdf_hash, enable_ocr):
+    return f"{pdf_hash}:ocr={int(bool(enable_ocr))}:norm={int(PDF_NORMALIZE_TEXT)}"
+
+def _guess_bibliographic_fields(metadata, head_text, page_count):
+    """
+    Title, author and year from PDF metadata, falling back to the opening text of the paper:
+    the title is searched for in the first 3000 characters and the year in the first 5000.
+    """
+    metadata = metadata or {}
+    title = metadata.get('title', '') or ''
+    author = metadata.get('author', '') or ''
+    
+    try:
+        update_terminal_log(f"Metadata read -> Title: '{title}', Author: '{author}'", "DEBUG")
+    except:
+        pass
+
+    if not title or len(title) < 5 or "microsoft" in title.lower() or ".doc" in title.lower() or title.isdigit():
+        try:
+            update_terminal_log("Metadata title appears empty or invalid. Scanning first page text for title...", "DEBUG")
+        except:
+            pass
+        
+        first_page_text = head_text[:3000]
+        lines = first_page_text.split('\n')
+        
+        for line in lines:
+            clean_line = line.strip()
+
+            if len(clean_line) > 10 and len(clean_line) < 200:
+                if not re.match(r'^[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,}$', clean_line, re.IGNORECASE) and \
+                   not clean_line.startswith("http") and \
+                   "abstract" not in clean_line.lower() and \
+                   "introduction" not in clean_line.lower() and \
+                   "keywords" not in clean_line.lower() and \
+                   "page" not in clean_line.lower() and \
+                   "vol." not in clean_line.lower():
+                    
+
+                    title = clean_line
+                    try:
+                        update_terminal_log(f"Found candidate title in text: '{title[:50]}...'", "INFO")
+                    except:
+                        pass
+                    break
+    
+    year = ''
+    if page_count > 0:
+        year_match = re.search(r'\b(19|20)\d{2}\b', head_text[:5000]) 
+        if year_match:
+            year = year_match.group()
+            try:
+                update_terminal_log(f"Year found on Page 1: {year}", "DEBUG")
+            except:
+                pass
+    
+    if not year:
+        creation_date = metadata.get('creationDate', '')
+        if creation_date:
+            year_match = re.search(r'\b(19|20)\d{2}\b', creation_date)
+            if year_match:
+                year = year_match.group()
+                try:
+                    update_terminal_log(f"Year derived from creationDate: {year}", "DEBUG")
+                except:
+                    pass
+
+    return title, author, year
+
+def _upload_view(pdf):
+    """Zero-copy view of an upload's buffer when it exposes one (BytesIO / Streamlit UploadedFile), else None."""
+    getbuffer = getattr(pdf, "getbuffer", None)
+    if getbuffer is None:
+        return None
+    try:
+        return getbuffer()
+    except Exception:
+        return None
+
+def _iter_upload_chunks(pdf, view):
+    if view is not None:
+        for offset in range(0, len(view), UPLOAD_HASH_CHUNK_SIZE):
+            yield view[offset:offset + UPLOAD_HASH_CHUNK_SIZE]
+        return
+    pdf.seek(0)
+    while True:
+        chunk = pdf.read(UPLOAD_HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+def _hash_upload(pdf):
+    """sha256 of an uploaded file, computed in chunks straight from its buffer without copying it."""
+    digest = hashlib.sha256()
+    view = _upload_view(pdf)
+    try:
+        for chunk in _iter_upload_chunks(pdf, view):
+            digest.update(chunk)
+    finally:
+        if view is not None:
+            view.release()
+    return digest.hexdigest()
+
+def _spool_upload(pdf):
+    """
+    Returns something extract_pdf_content can open: the upload's bytes when small, or the path
+    of a temp file it was streamed to when at least PDF_SPOOL_THRESHOLD_MB. The caller deletes the file.
+    """
+    view = _upload_view(pdf)
+    try:
+        size = len(view) if view is not None else None
+        if size is None:
+            pdf.seek(0, io.SEEK_END)
+            size = pdf.tell()
+
+        if size < PDF_SPOOL_THRESHOLD_MB * 1024 * 1024:
+            if view is not None:
+                return bytes(view)
+            pdf.seek(0)
+            return pdf.read()
+
+        fd, path = tempfile.mkstemp(prefix="reviewaid-", suffix=".pdf")
+        try:
+            with os.fdopen(fd, "wb") as spool:
+                for chunk in _iter_upload_chunks(pdf, view):
+                    spool.write(chunk)
+        except Exception:
+            os.remove(path)
+            raise
+        return path
+    finally:
+        if view is not None:
+            view.release()
+
+def extract_uploaded_pdfs(uploaded_pdfs, enable_ocr=False, max_workers=None):
+    """
+    Hashes every uploaded file, then parses each distinct PDF once via extract_pdf_batch.
+    Papers parsed in any earlier session are served from the on-disk text cache instead.
+    Large uploads are spooled to temp files so PyMuPDF reads them from disk rather than from a copy in memory.
+    Returns (hashes, contents): hashes[i] is the sha256 of uploaded_pdfs[i] (None if unreadable)
+    and contents maps each hash to its (text, title, author, year, sections) tuple, where sections
+    is the segment_sections index of text.
+    """
+    pdf_hashes = []
+    pending = {}
+    contents = {}
+    spooled_paths = []
+
+    try:
+        for pdf in uploaded_pdfs:
+            if pdf is None:
+                pdf_hashes.append(None)
+                continue
+            try:
+                pdf_hash = _hash_upload(pdf)
+                if pdf_hash not in pending and pdf_hash not in contents:
+                    cached = pdf_text_cache.get(_pdf_cache_key(pdf_hash, enable_ocr))
+                    if cached:
+                        if len(cached) == 4:
+                            cached.append(segment_sections(cached[0]))
+                        contents[pdf_hash] = tuple(cached)
+                    else:
+                        pdf_source = _spool_upload(pdf)
+                        if isinstance(pdf_source, str):
+                            spooled_paths.append(pdf_source)
+                        pending[pdf_hash] = pdf_source
+            except Exception as e:
+                update_terminal_log(f"File read error for {pdf.name}: {str(e)}", "ERROR")
+                pdf_hashes.append(None)
+                continue
+            pdf_hashes.append(pdf_hash)
+
+        if contents:
+            try:
+                update_terminal_log(f"Reusing cached text for {len(contents)} previously parsed PDF(s).", "INFO")
+            except:
+                pass
+
+        unique_hashes = list(pending)
+        extracted = extract_pdf_batch([pending[h] for h in unique_hashes], enable_ocr=enable_ocr, max_workers=max_workers)
+        del pending
+
+        for pdf_hash, content in zip(unique_hashes, extracted):
+            content = tuple(content) + (segment_sections(content[0]),)
+            contents[pdf_hash] = content
+            if content[0].strip():
+                pdf_text_cache.set(_pdf_cache_key(pdf_hash, enable_ocr), list(content))
+    finally:
+        for path in spooled_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    return pdf_hashes, contents
+
 def to_docx(df):
     from docx import Document
     from docx.shared import Inches, Pt, RGBColor
@@ -744,39 +1280,304 @@ def to_excel(df):
 
 
 
+# Provider SDK clients are shared process-wide so their keep-alive connection pools survive across
+# papers, reruns and sessions. Clients unused for LLM_CLIENT_IDLE_TIMEOUT seconds leave the registry;
+# they are not closed there, since a caller (e.g. a batch job being polled) may still hold one, and are
+# closed by garbage collection once nothing references them.
+LLM_CLIENT_IDLE_TIMEOUT = float(os.getenv("LLM_CLIENT_IDLE_TIMEOUT", "900") or 900)
+
+# How many LLM requests query_llm_many keeps in flight at once
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8") or 8)
+
+# Responses to calls at or below LLM_CACHE_MAX_TEMPERATURE are kept on disk and served again for the
+# identical (provider, model, temperature, max_tokens, prompt). LLM_CACHE_MAX_MB=0 turns this off.
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", "128") or 0)
+LLM_CACHE_TTL_DAYS = float(os.getenv("LLM_CACHE_TTL_DAYS", "30") or 30)
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.3") or 0)
+
+# Read replies as a stream and stop as soon as a complete JSON object has arrived, instead of waiting
+# for any commentary the model adds after it. Progress is logged every LLM_STREAM_LOG_INTERVAL seconds.
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1").strip().lower() not in ("0", "false", "no")
+LLM_STREAM_LOG_INTERVAL = 5.0
+
+# Short papers (at most LLM_PACK_MAX_PAPER_TOKENS after fitting) are screened up to LLM_PACK_MAX_PAPERS per call
+LLM_PACK_PAPERS = os.getenv("LLM_PACK_PAPERS", "1").strip().lower() not in ("0", "false", "no")
+LLM_PACK_MAX_PAPER_TOKENS = int(os.getenv("LLM_PACK_MAX_PAPER_TOKENS", "3000") or 3000)
+LLM_PACK_MAX_PAPERS = int(os.getenv("LLM_PACK_MAX_PAPERS", "8") or 8)
+
+# Batch mode (see batch.py): providers with a batch API, the upload limit in batch mode, and a directory that
+# turns on the file-based stand-in endpoint (answered through query_llm) for offline runs.
+BATCH_PROVIDERS = ("OpenAI", "Anthropic")
+LLM_BATCH_MAX_PAPERS = int(os.getenv("LLM_BATCH_MAX_PAPERS", "2000") or 2000)
+LLM_BATCH_LOCAL_DIR = os.getenv("LLM_BATCH_LOCAL_DIR", "").strip()
+
+# Local Ollama serving: how long a model stays loaded after a request, how many requests the server runs
+# at once (match the server's own OLLAMA_NUM_PARALLEL), and the largest num_ctx ReviewAid will ask for.
+# num_ctx only grows in OLLAMA_NUM_CTX_STEP steps, since every change makes Ollama reload the model.
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m").strip() or "30m"
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4") or 4)
+OLLAMA_MAX_NUM_CTX = int(os.getenv("OLLAMA_MAX_NUM_CTX", "32768") or 32768)
+OLLAMA_NUM_CTX_STEP = 4096
+
+# Ask providers for schema-constrained JSON (see schemas.py) and size max_tokens to the schema
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "1").strip().lower() not in ("0", "false", "no")
+
+# A call still unanswered after its provider/model's LLM_HEDGE_PERCENTILE latency gets a duplicate ("hedged")
+# request, and whichever answers first wins. LLM_HEDGE_PERCENTILE=0 turns hedging off. A call gives up when
+# nothing arrives for LLM_REQUEST_TIMEOUT seconds: the first token, the next streamed chunk, or a whole
+# non-streamed reply (0 = no limit). A local Ollama server may be slow on CPU, so it only has a limit
+# when OLLAMA_REQUEST_TIMEOUT is set.
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95") or 0)
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "300") or 0)
+OLLAMA_REQUEST_TIMEOUT = float(os.getenv("OLLAMA_REQUEST_TIMEOUT", "0") or 0)
+
+# Hedges go to this provider/model instead of repeating the call, and it also takes over at once when a
+# call fails. LLM_FAILOVER_BASE_URL is only used for Ollama.
+LLM_FAILOVER_PROVIDER = os.getenv("LLM_FAILOVER_PROVIDER", "").strip()
+LLM_FAILOVER_MODEL = os.getenv("LLM_FAILOVER_MODEL", "").strip()
+LLM_FAILOVER_API_KEY = os.getenv("LLM_FAILOVER_API_KEY", "").strip()
+LLM_FAILOVER_BASE_URL = os.getenv("LLM_FAILOVER_BASE_URL", "").strip()
+
+# Submitted batch ids, so rerunning the same job resumes polling instead of paying for it twice
+llm_batch_jobs = DiskCache("llm_batches", max_bytes=1024 * 1024, ttl=2 * 86400)
+
+llm_response_cache = DiskCache("llm_responses", max_bytes=LLM_CACHE_MAX_MB * 1024 * 1024, ttl=LLM_CACHE_TTL_DAYS * 86400)
+
+_client_registry = {}
+_client_registry_lock = threading.Lock()
+
+# Async SDK clients are bound to the event loop they were first used on, so all async LLM traffic
+# runs on one long-lived loop in a background thread.
+_llm_loop = None
+_llm_loop_thread = None
+_llm_loop_lock = threading.Lock()
+# Log lines of the calls a query_llm_many started, so they end up in that session's terminal only
+_llm_log_sink = contextvars.ContextVar("llm_log_sink", default=None)
+
+def _key_fingerprint(api_key):
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+def _close_client(client):
+    for target in (client, getattr(client, "_client", None)):
+        close = getattr(target, "close", None)
+        if callable(close):
+            try:
+                closing = close()
+                if asyncio.iscoroutine(closing):
+                    _run_on_llm_loop(closing)
+            except Exception:
+                pass
+            return
+
+def _drop_idle_clients(now):
+    idle = [key for key, (_, last_used) in _client_registry.items() if now - last_used > LLM_CLIENT_IDLE_TIMEOUT]
+    for key in idle:
+        del _client_registry[key]
+
+def get_shared_client(kind, api_key, base_url, factory):
+    """
+    Returns the process-wide SDK client for (kind, API key fingerprint, base_url),
+    creating it with factory() on first use. The key itself is never stored in the registry key.
+    """
+    registry_key = (kind, _key_fingerprint(api_key), base_url or "")
+    now = time.time()
+    with _client_registry_lock:
+        _drop_idle_clients(now)
+        entry = _client_registry.get(registry_key)
+        if entry is None:
+            entry = [factory(), now]
+            _client_registry[registry_key] = entry
+        else:
+            entry[1] = now
+    return entry[0]
+
+def _get_llm_loop():
+    global _llm_loop, _llm_loop_thread
+    with _llm_loop_lock:
+        if _llm_loop is None or _llm_loop.is_closed():
+            _llm_loop = asyncio.new_event_loop()
+            _llm_loop_thread = threading.Thread(target=_llm_loop.run_forever, name="reviewaid-llm", daemon=True)
+            _llm_loop_thread.start()
+        return _llm_loop
+
+def _run_on_llm_loop(coro):
+    """Runs a cleanup coroutine (e.g. an async client's close) on the LLM loop, or drops it if the loop is gone."""
+    if _llm_loop is None or _llm_loop.is_closed() or not _llm_loop.is_running():
+        coro.close()
+    elif threading.current_thread() is _llm_loop_thread:
+        _llm_loop.create_task(coro)
+    else:
+        try:
+            asyncio.run_coroutine_threadsafe(coro, _llm_loop).result(timeout=5)
+        except Exception:
+            pass
+
+def shutdown_llm_clients():
+    global _llm_loop, _llm_loop_thread
+    with _client_registry_lock:
+        clients = [client for client, _ in _client_registry.values()]
+        _client_registry.clear()
+    for client in clients:
+        _close_client(client)
+
+    with _llm_loop_lock:
+        if _llm_loop is not None and not _llm_loop.is_closed():
+            _llm_loop.call_soon_threadsafe(_llm_loop.stop)
+            _llm_loop_thread.join(timeout=5)
+            if not _llm_loop.is_running():
+                _llm_loop.close()
+        _llm_loop = None
+        _llm_loop_thread = None
+
+atexit.register(shutdown_llm_clients)
+
+def _usage_value(response, *path):
+    """Follows attribute names (or dict keys) through an SDK response; None if any step is missing."""
+    value = response
+    for name in path:
+        if value is None:
+            return None
+        value = value.get(name) if isinstance(value, dict) else getattr(value, name, None)
+    return value if isinstance(value, int) else None
+
+def _stream_headers(stream):
+    # SDK streams keep the underlying HTTP response
+    return getattr(getattr(stream, "response", None), "headers", None)
+
+def _first_int(*values):
+    return next((value for value in values if isinstance(value, int)), None)
+
 class BaseLLMProvider(ABC):
     """Abstract base class for LLM providers."""
     def __init__(self, api_key: str, model_name: str, **kwargs):
         self.api_key = api_key
         self.model_name = model_name
         self.extra_params = kwargs
+        # Prompt tokens billed for the last call, when the API reports them (used to calibrate budget.count_tokens)
+        self.last_prompt_tokens = None
+        # Prompt tokens served from / written to the provider's prompt cache on the last call
+        self.last_cache_read_tokens = None
+        self.last_cache_write_tokens = None
+        # HTTP headers of the last response, when the SDK exposes them (rate limits are read from these)
+        self.last_response_headers = None
 
     @abstractmethod
-    def generate(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> str:
+    def generate(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int, schema: Dict[str, Any] = None) -> str:
+        """
+        Returns the reply text. With a JSON schema, providers that support it constrain the reply
+        to a JSON object following the schema; the others rely on the prompt alone.
+        """
         pass
 
+    async def agenerate(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int, schema: Dict[str, Any] = None) -> str:
+        """Async counterpart of generate. Providers without an async SDK client run generate in a thread."""
+        return await asyncio.to_thread(self.generate, messages, temperature, max_tokens, schema)
+
+    def stream(self, messages, temperature, max_tokens, schema=None):
+        """Yields the reply as text chunks. Providers without a streaming API yield it in one piece."""
+        yield self.generate(messages, temperature, max_tokens, schema)
+
+    async def astream(self, messages, temperature, max_tokens, schema=None):
+        """Async counterpart of stream. Closing the generator early closes the underlying response."""
+        yield await self.agenerate(messages, temperature, max_tokens, schema)
+
 class OpenAIProvider(BaseLLMProvider):
     def __init__(self, api_key, model_name="gpt-4o", base_url=None):
         super().__init__(api_key, model_name)
         if not OpenAI: raise ImportError("OpenAI library not installed. Run: pip install openai")
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self.base_url = base_url
+        self.client = get_shared_client("openai", api_key, base_url, lambda: OpenAI(api_key=api_key, base_url=base_url))
+
+    def _record_usage(self, response):
+        # Prefix caching is automatic: OpenAI reports cached_tokens, DeepSeek prompt_cache_hit/miss_tokens
+        self.last_prompt_tokens = _usage_value(response, "usage", "prompt_tokens")
+        self.last_cache_read_tokens = _first_int(
+            _usage_value(response, "usage", "prompt_tokens_details", "cached_tokens"),
+            _usage_value(response, "usage", "prompt_cache_hit_tokens")
+        )
+        self.last_cache_write_tokens = None
 
-    def generate(self, messages, temperature, max_tokens):
-        response = self.client.chat.completions.create(
+    def _response_format(self, schema):
+        return schemas.openai_response_format(schema)
+
+    def _create_args(self, messages, temperature, max_tokens, schema=None):
+        args = dict(
             model=self.model_name,
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens
         )
+        if schema is not None:
+            args["response_format"] = self._response_format(schema)
+        return args
+
+    def generate(self, messages, temperature, max_tokens, schema=None):
+        raw = self.client.chat.completions.with_raw_response.create(**self._create_args(messages, temperature, max_tokens, schema))
+        self.last_response_headers = raw.headers
+        response = raw.parse()
+        self._record_usage(response)
+        return response.choices[0].message.content
+
+    async def agenerate(self, messages, temperature, max_tokens, schema=None):
+        client = get_shared_client("openai-async", self.api_key, self.base_url, lambda: AsyncOpenAI(api_key=self.api_key, base_url=self.base_url))
+        raw = await client.chat.completions.with_raw_response.create(**self._create_args(messages, temperature, max_tokens, schema))
+        self.last_response_headers = raw.headers
+        response = raw.parse()
+        self._record_usage(response)
         return response.choices[0].message.content
 
+    def _stream_args(self, messages, temperature, max_tokens, schema=None):
+        return dict(
+            self._create_args(messages, temperature, max_tokens, schema),
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+    def _chunk_text(self, chunk):
+        # Usage arrives on a final chunk without choices
+        if getattr(chunk, "usage", None) is not None:
+            self._record_usage(chunk)
+        if not chunk.choices:
+            return ""
+        return chunk.choices[0].delta.content or ""
+
+    def stream(self, messages, temperature, max_tokens, schema=None):
+        self.last_prompt_tokens = None
+        response = self.client.chat.completions.create(**self._stream_args(messages, temperature, max_tokens, schema))
+        self.last_response_headers = _stream_headers(response)
+        try:
+            for chunk in response:
+                yield self._chunk_text(chunk)
+        finally:
+            response.close()
+
+    async def astream(self, messages, temperature, max_tokens, schema=None):
+        self.last_prompt_tokens = None
+        client = get_shared_client("openai-async", self.api_key, self.base_url, lambda: AsyncOpenAI(api_key=self.api_key, base_url=self.base_url))
+        response = await client.chat.completions.create(**self._stream_args(messages, temperature, max_tokens, schema))
+        self.last_response_headers = _stream_headers(response)
+        try:
+            async for chunk in response:
+                yield self._chunk_text(chunk)
+        finally:
+            await response.close()
+
+def anthropic_system_blocks(system_content):
+    """
+    The system prompt as a text block marked with an ephemeral cache_control breakpoint, so the shared
+    instructions are cached across calls (prompts below the model's minimum cacheable length just aren't cached).
+    """
+    if not system_content:
+        return []
+    return [{"type": "text", "text": system_content, "cache_control": {"type": "ephemeral"}}]
+
 class AnthropicProvider(BaseLLMProvider):
     def __init__(self, api_key, model_name="claude-sonnet-4-20250514"):
         super().__init__(api_key, model_name)
         if not Anthropic: raise ImportError("Anthropic library not installed. Run: pip install anthropic")
-        self.client = Anthropic(api_key=api_key)
+        self.client = get_shared_client("anthropic", api_key, None, lambda: Anthropic(api_key=api_key))
 
-    def generate(self, messages, temperature, max_tokens):
+    def _split_system(self, messages):
         system_content = ""
         user_messages = []
         
@@ -785,25 +1586,90 @@ class AnthropicProvider(BaseLLMProvider):
                 system_content = msg['content']
             else:
                 user_messages.append(msg)
-        
-        response = self.client.messages.create(
+        return anthropic_system_blocks(system_content), user_messages
+
+    def _record_usage(self, message):
+        # input_tokens only counts the uncached part of the prompt
+        input_tokens = _usage_value(message, "usage", "input_tokens")
+        self.last_cache_read_tokens = _usage_value(message, "usage", "cache_read_input_tokens")
+        self.last_cache_write_tokens = _usage_value(message, "usage", "cache_creation_input_tokens")
+        if input_tokens is None:
+            self.last_prompt_tokens = None
+        else:
+            self.last_prompt_tokens = input_tokens + (self.last_cache_read_tokens or 0) + (self.last_cache_write_tokens or 0)
+
+    def _create_args(self, messages, temperature, max_tokens, schema=None):
+        system_content, user_messages = self._split_system(messages)
+        args = dict(
             model=self.model_name,
             system=system_content,
             messages=user_messages,
             temperature=temperature,
             max_tokens=max_tokens
         )
-        return response.content[0].text
+        if schema is not None:
+            # Structured answers come back as the input of a tool the model is made to call
+            args["tools"] = [schemas.anthropic_tool(schema)]
+            args["tool_choice"] = {"type": "tool", "name": schemas.SCHEMA_NAME}
+        return args
+
+    def generate(self, messages, temperature, max_tokens, schema=None):
+        raw = self.client.messages.with_raw_response.create(**self._create_args(messages, temperature, max_tokens, schema))
+        self.last_response_headers = raw.headers
+        response = raw.parse()
+        self._record_usage(response)
+        return schemas.anthropic_reply_text(response)
+
+    async def agenerate(self, messages, temperature, max_tokens, schema=None):
+        client = get_shared_client("anthropic-async", self.api_key, None, lambda: AsyncAnthropic(api_key=self.api_key))
+        raw = await client.messages.with_raw_response.create(**self._create_args(messages, temperature, max_tokens, schema))
+        self.last_response_headers = raw.headers
+        response = raw.parse()
+        self._record_usage(response)
+        return schemas.anthropic_reply_text(response)
+
+    def _event_text(self, event):
+        if event.type == "message_start":
+            self._record_usage(event.message)
+        elif event.type == "content_block_delta":
+            delta_type = getattr(event.delta, "type", None)
+            if delta_type == "text_delta":
+                return event.delta.text
+            if delta_type == "input_json_delta":
+                return event.delta.partial_json
+        return ""
+
+    def stream(self, messages, temperature, max_tokens, schema=None):
+        self.last_prompt_tokens = None
+        response = self.client.messages.create(**self._create_args(messages, temperature, max_tokens, schema), stream=True)
+        self.last_response_headers = _stream_headers(response)
+        try:
+            for event in response:
+                yield self._event_text(event)
+        finally:
+            response.close()
+
+    async def astream(self, messages, temperature, max_tokens, schema=None):
+        self.last_prompt_tokens = None
+        client = get_shared_client("anthropic-async", self.api_key, None, lambda: AsyncAnthropic(api_key=self.api_key))
+        response = await client.messages.create(**self._create_args(messages, temperature, max_tokens, schema), stream=True)
+        self.last_response_headers = _stream_headers(response)
+        try:
+            async for event in response:
+                yield self._event_text(event)
+        finally:
+            await response.close()
 
 class CohereProvider(BaseLLMProvider):
     def __init__(self, api_key, model_name="command-a-03-2025"):
         super().__init__(api_key, model_name)
         if not cohere: raise ImportError("Cohere library not installed. Run: pip install cohere")
-        self.client = cohere.Client(api_key=api_key)
+        self.client = get_shared_client("cohere", api_key, None, lambda: cohere.Client(api_key=api_key))
 
-    def generate(self, messages, temperature, max_tokens):
+    def _chat_args(self, messages, temperature, max_tokens, schema=None):
         chat_history = []
         message_content = ""
+        preamble = ""
         
         for msg in messages:
             if msg['role'] == 'user':
@@ -811,41 +1677,70 @@ class CohereProvider(BaseLLMProvider):
             elif msg['role'] == 'assistant':
                 chat_history.append({"role": "CHATBOT", "message": msg['content']})
             elif msg['role'] == 'system':
-                message_content = msg['content'] + "\n\n" + message_content
+                # Cohere takes system instructions as the preamble, separate from the user's message
+                preamble = msg['content'] if not preamble else preamble + "\n\n" + msg['content']
 
-        response = self.client.chat(
+        args = dict(
             message=message_content,
             chat_history=chat_history,
             temperature=temperature,
             max_tokens=max_tokens,
             model=self.model_name
         )
+        if preamble:
+            args["preamble"] = preamble
+        if schema is not None:
+            args["response_format"] = {"type": "json_object", "schema": schema}
+        return args
+
+    def generate(self, messages, temperature, max_tokens, schema=None):
+        response = self.client.chat(**self._chat_args(messages, temperature, max_tokens, schema))
+        self.last_prompt_tokens = _usage_value(response, "meta", "billed_units", "input_tokens")
+        return response.text
+
+    async def agenerate(self, messages, temperature, max_tokens, schema=None):
+        client = get_shared_client("cohere-async", self.api_key, None, lambda: cohere.AsyncClient(api_key=self.api_key))
+        response = await client.chat(**self._chat_args(messages, temperature, max_tokens, schema))
+        self.last_prompt_tokens = _usage_value(response, "meta", "billed_units", "input_tokens")
         return response.text
 
-class DeepSeekProvider(BaseLLMProvider):
+    def _event_text(self, event):
+        event_type = getattr(event, "event_type", None)
+        if event_type == "text-generation":
+            return event.text
+        if event_type == "stream-end":
+            self.last_prompt_tokens = _usage_value(event, "response", "meta", "billed_units", "input_tokens")
+        return ""
+
+    def stream(self, messages, temperature, max_tokens, schema=None):
+        self.last_prompt_tokens = None
+        for event in self.client.chat_stream(**self._chat_args(messages, temperature, max_tokens, schema)):
+            yield self._event_text(event)
+
+    async def astream(self, messages, temperature, max_tokens, schema=None):
+        self.last_prompt_tokens = None
+        client = get_shared_client("cohere-async", self.api_key, None, lambda: cohere.AsyncClient(api_key=self.api_key))
+        async for event in client.chat_stream(**self._chat_args(messages, temperature, max_tokens, schema)):
+            yield self._event_text(event)
+
+class DeepSeekProvider(OpenAIProvider):
     """DeepSeek is largely OpenAI compatible"""
     def __init__(self, api_key, model_name="deepseek-chat"):
-        super().__init__(api_key, model_name)
         if not OpenAI: raise ImportError("OpenAI library required for DeepSeek. Run: pip install openai")
-        self.client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
+        super().__init__(api_key, model_name, base_url="https://api.deepseek.com")
 
-    def generate(self, messages, temperature, max_tokens):
-        response = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        return response.choices[0].message.content
+    def _response_format(self, schema):
+        # DeepSeek has JSON mode but no schema enforcement; the prompt carries the format
+        return {"type": "json_object"}
 
 class GLMProvider(BaseLLMProvider):
-    """Z.ai (GLM) provider using existing ZaiClient logic"""
+    """Z.ai (GLM) provider using existing ZaiClient logic. Schemas are not sent; the prompt carries the format."""
     def __init__(self, api_key, model_name="GLM-4.6V-Flash"):
         super().__init__(api_key, model_name)
         if not ZaiClient: raise ImportError("Zai library not found.")
-        self.client = ZaiClient(api_key=api_key)
+        self.client = get_shared_client("zai", api_key, None, lambda: ZaiClient(api_key=api_key))
 
-    def generate(self, messages, temperature, max_tokens):
+    def generate(self, messages, temperature, max_tokens, schema=None):
         prompt = ""
         for msg in messages:
             role = msg['role'].upper()
@@ -858,25 +1753,123 @@ class GLMProvider(BaseLLMProvider):
             temperature=temperature,
             max_tokens=max_tokens
         )
+        self.last_prompt_tokens = _usage_value(response, "usage", "prompt_tokens")
         return response.choices[0].message.content
 
 class OllamaProvider(BaseLLMProvider):
     def __init__(self, api_key, model_name="llama3", base_url="http://localhost:11434"):
         super().__init__(api_key, model_name, base_url=base_url)
         if not ollama: raise ImportError("Ollama library not installed. Run: pip install ollama")
-        self.client = ollama.Client(host=base_url)
-
-    def generate(self, messages, temperature, max_tokens):
-        response = self.client.chat(
+        self.base_url = base_url
+        self.client = get_shared_client("ollama", api_key, base_url, lambda: ollama.Client(host=base_url))
+
+    def _chat_args(self, messages, temperature, max_tokens, schema=None):
+        # Without num_ctx the server's small default context silently cuts the paper short
+        needed_tokens = budget.count_tokens("".join(m['content'] for m in messages), "Ollama (Local)", self.model_name)
+        needed_tokens += max_tokens + budget.SAFETY_MARGIN_TOKENS
+        args = dict(
             model=self.model_name,
             messages=messages,
             options={
                 'temperature': temperature,
-                'num_predict': max_tokens
-            }
+                'num_predict': max_tokens,
+                'num_ctx': ollama_num_ctx(self.base_url, self.model_name, needed_tokens)
+            },
+            keep_alive=OLLAMA_KEEP_ALIVE
         )
+        if schema is not None:
+            args['format'] = schema
+        return args
+
+    def generate(self, messages, temperature, max_tokens, schema=None):
+        response = self.client.chat(**self._chat_args(messages, temperature, max_tokens, schema))
+        self.last_prompt_tokens = _usage_value(response, "prompt_eval_count")
         return response['message']['content']
 
+    async def agenerate(self, messages, temperature, max_tokens, schema=None):
+        client = get_shared_client("ollama-async", self.api_key, self.base_url, lambda: ollama.AsyncClient(host=self.base_url))
+        response = await client.chat(**self._chat_args(messages, temperature, max_tokens, schema))
+        self.last_prompt_tokens = _usage_value(response, "prompt_eval_count")
+        return response['message']['content']
+
+    def _part_text(self, part):
+        # prompt_eval_count is only filled in on the final part
+        if part.get('done'):
+            self.last_prompt_tokens = _usage_value(part, "prompt_eval_count")
+        return part['message']['content'] or ""
+
+    def stream(self, messages, temperature, max_tokens, schema=None):
+        self.last_prompt_tokens = None
+        parts = self.client.chat(**self._chat_args(messages, temperature, max_tokens, schema), stream=True)
+        try:
+            for part in parts:
+                yield self._part_text(part)
+        finally:
+            parts.close()
+
+    async def astream(self, messages, temperature, max_tokens, schema=None):
+        self.last_prompt_tokens = None
+        client = get_shared_client("ollama-async", self.api_key, self.base_url, lambda: ollama.AsyncClient(host=self.base_url))
+        parts = await client.chat(**self._chat_args(messages, temperature, max_tokens, schema), stream=True)
+        try:
+            async for part in parts:
+                yield self._part_text(part)
+        finally:
+            await parts.aclose()
+
+_ollama_num_ctx = {}
+_ollama_num_ctx_lock = threading.Lock()
+
+def ollama_num_ctx(base_url, model_name, needed_tokens):
+    """
+    num_ctx for an Ollama request needing needed_tokens: rounded up to OLLAMA_NUM_CTX_STEP, never below what
+    the model was last given (so it isn't reloaded back and forth) and capped at its context window.
+    """
+    window = budget.get_context_window("Ollama (Local)", model_name)
+    wanted = min(window, -(-needed_tokens // OLLAMA_NUM_CTX_STEP) * OLLAMA_NUM_CTX_STEP)
+    with _ollama_num_ctx_lock:
+        num_ctx = min(window, max(wanted, _ollama_num_ctx.get((base_url, model_name), 0)))
+        _ollama_num_ctx[(base_url, model_name)] = num_ctx
+    return num_ctx
+
+def _ollama_context_length(client, model_name):
+    """The model's trained context length from Ollama's model info, or None."""
+    info = client.show(model_name)
+    return next((value for key, value in (info.modelinfo or {}).items() if key.endswith(".context_length")), None)
+
+def warm_up_ollama(model_name, base_url="http://localhost:11434"):
+    """
+    Gets a local model ready at the start of a run. Its context length is read first, so prompts are fitted
+    to it (up to OLLAMA_MAX_NUM_CTX); the model is then loaded in the background with that num_ctx and pinned
+    with keep_alive, so the load overlaps PDF reading and the model stays resident between papers.
+    """
+    if not ollama:
+        return
+    client = get_shared_client("ollama", "", base_url, lambda: ollama.Client(host=base_url))
+    try:
+        context_length = _ollama_context_length(client, model_name)
+        if isinstance(context_length, int) and context_length > 0:
+            budget.set_context_window("Ollama (Local)", model_name, min(context_length, OLLAMA_MAX_NUM_CTX))
+    except Exception as e:
+        try: update_terminal_log(f"Could not read {model_name} details from Ollama: {str(e)}", "WARN")
+        except: pass
+
+    num_ctx = ollama_num_ctx(base_url, model_name, budget.get_context_window("Ollama (Local)", model_name))
+    try:
+        update_terminal_log(f"Loading {model_name} in Ollama (num_ctx {num_ctx}, keep_alive {OLLAMA_KEEP_ALIVE}, {OLLAMA_NUM_PARALLEL} parallel requests)...", "INFO")
+    except:
+        pass
+
+    def load():
+        try:
+            # An empty prompt only loads the model
+            client.generate(model=model_name, prompt="", keep_alive=OLLAMA_KEEP_ALIVE, options={'num_ctx': num_ctx})
+        except Exception as e:
+            try: update_terminal_log(f"Ollama warm-up failed for {model_name}: {str(e)}", "WARN")
+            except: pass
+
+    threading.Thread(target=load, daemon=True).start()
+
 def get_provider_instance(provider_name: str, api_key: str, model_name: str, **kwargs):
     """Factory function to get the provider instance."""
     provider_map = {
@@ -894,17 +1887,347 @@ def get_provider_instance(provider_name: str, api_key: str, model_name: str, **k
     
     return provider_class(api_key=api_key, model_name=model_name, **kwargs)
 
-def query_llm(prompt, provider_name, api_key, model_name, temperature=0.1, max_tokens=8192):
+def _provider_extra_args(provider_name):
+    extra_args = {}
+    if provider_name == "Ollama (Local)":
+        extra_args['base_url'] = st.session_state.get('ollama_base_url', 'http://localhost:11434')
+    return extra_args
+
+def _is_rate_limit_error(e):
+    if getattr(e, "status_code", None) == 429:
+        return True
+    rate_keywords = ["429", "rate limit", "too many requests", "quota", "overload", "rate_limit_exceeded"]
+    return any(k in str(e).lower() for k in rate_keywords)
+
+def _llm_cache_key(prompt, provider_name, model_name, temperature, max_tokens, system_prompt=None, response_schema=None):
+    """Response cache key for a call, or None when the call is too random (or caching is off) to reuse."""
+    if not LLM_CACHE_MAX_MB or temperature > LLM_CACHE_MAX_TEMPERATURE:
+        return None
+    parts = [provider_name, model_name, temperature, max_tokens, system_prompt or "", prompt]
+    if response_schema is not None:
+        parts.append(schemas.schema_key(response_schema))
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+def _get_cached_response(cache_key):
+    return llm_response_cache.get(cache_key) if cache_key is not None else None
+
+def _log_cache_hit(provider_name):
+    stats = llm_response_cache.stats()
+    try:
+        update_terminal_log(f"Reusing cached {provider_name} response (cache hits {stats['hits']}, misses {stats['misses']}).", "INFO")
+    except:
+        pass
+
+def _is_complete_json(result_content):
+    """Whether a reply holds a whole JSON answer (not a stream cut off mid-object, nor prose)."""
+    scanner = JsonObjectScanner()
+    if not scanner.feed(result_content):
+        return False
+    try:
+        json5.loads(scanner.text())
+    except Exception:
+        return False
+    return True
+
+def _store_response(cache_key, result_content):
+    # Empty, truncated or unparseable replies go through the retry/repair ladder; caching them would
+    # replay the broken answer on every rerun
+    if cache_key is not None and result_content and result_content.strip() and _is_complete_json(result_content):
+        llm_response_cache.set(cache_key, result_content)
+
+def _log_stream_progress(provider_name, scanner, started):
+    try:
+        update_terminal_log(f"Receiving {provider_name} response... {scanner.length:,} chars in {time.monotonic() - started:.0f}s", "DEBUG")
+    except:
+        pass
+
+def _finish_stream(provider_name, scanner):
+    if scanner.complete:
+        try:
+            update_terminal_log(f"Complete JSON received after {scanner.end:,} chars; closing the {provider_name} stream.", "DEBUG")
+        except:
+            pass
+    return scanner.text()
+
+def _read_stream(provider, provider_name, messages, temperature, max_tokens, schema=None):
+    """Collects a streamed reply, stopping at the end of the first complete JSON object (or array of objects)."""
+    scanner = JsonObjectScanner()
+    started = last_log = time.monotonic()
+    chunks = provider.stream(messages, temperature, max_tokens, schema)
+    try:
+        for chunk in chunks:
+            if scanner.feed(chunk):
+                break
+            if time.monotonic() - last_log >= LLM_STREAM_LOG_INTERVAL:
+                last_log = time.monotonic()
+                _log_stream_progress(provider_name, scanner, started)
+    finally:
+        chunks.close()
+    return _finish_stream(provider_name, scanner)
+
+def _request_timeout(provider_name):
+    """Seconds a call may go without receiving anything, or None for no limit."""
+    timeout = OLLAMA_REQUEST_TIMEOUT if provider_name == "Ollama (Local)" else LLM_REQUEST_TIMEOUT
+    return timeout or None
+
+async def _aread_stream(provider, provider_name, messages, temperature, max_tokens, schema=None, idle_timeout=None):
+    """
+    Async counterpart of _read_stream. With idle_timeout, TimeoutError is raised when no chunk arrives for
+    that long; a reply that keeps streaming is never cut off.
+    """
+    scanner = JsonObjectScanner()
+    started = last_log = time.monotonic()
+    chunks = provider.astream(messages, temperature, max_tokens, schema)
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), idle_timeout)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"No data from {provider_name} for {idle_timeout:.0f}s") from None
+            if scanner.feed(chunk):
+                break
+            if time.monotonic() - last_log >= LLM_STREAM_LOG_INTERVAL:
+                last_log = time.monotonic()
+                _log_stream_progress(provider_name, scanner, started)
+    finally:
+        await chunks.aclose()
+    return _finish_stream(provider_name, scanner)
+
+def build_messages(prompt, system_prompt=None):
+    """
+    Chat messages for a call. Instructions shared by every paper go first in a system message so
+    providers can cache them as a prompt prefix; the paper-specific prompt follows as the user turn.
+    """
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+def _log_prompt_cache(provider_name, provider):
+    read_tokens = getattr(provider, "last_cache_read_tokens", None)
+    write_tokens = getattr(provider, "last_cache_write_tokens", None)
+    if not isinstance(read_tokens, int) and not isinstance(write_tokens, int):
+        return
+    try:
+        update_terminal_log(f"{provider_name} prompt cache: {read_tokens or 0} tokens read, {write_tokens or 0} written.", "DEBUG")
+    except:
+        pass
+
+def _is_overload_error(e):
+    """Errors that mean "send less": rate limits plus overloaded/unavailable/timed-out servers."""
+    if _is_rate_limit_error(e) or getattr(e, "status_code", None) in (502, 503, 504, 529):
+        return True
+    overload_keywords = ["overloaded", "service unavailable", "529", "503", "timed out", "timeout"]
+    return any(k in str(e).lower() for k in overload_keywords)
+
+# Provider/models that rejected a response schema; they are asked for JSON through the prompt only
+_schema_unsupported = set()
+
+def _is_schema_rejected(e):
+    """A 400 about the structured-output parameters, e.g. from a model without JSON schema support."""
+    if getattr(e, "status_code", None) != 400 and "400" not in str(e):
+        return False
+    schema_keywords = ["response_format", "json_schema", "tool_choice", "tools", "format", "schema"]
+    return any(k in str(e).lower() for k in schema_keywords)
+
+def _is_breaker_failure(e):
+    """
+    Whether a failed call counts towards the circuit breaker. Rate limits are waited out by the
+    backoff and a rejected schema is retried without it, so neither counts, unless the quota is used up.
+    Only provider-side trouble trips it: 5xx, timeouts, connection errors and 401/403; other 4xx are per request.
+    """
+    if _is_schema_rejected(e):
+        return False
+    message = str(e).lower()
+    if _is_rate_limit_error(e):
+        quota_keywords = ["insufficient_quota", "exceeded your current quota", "quota exhausted", "billing"]
+        return any(k in message for k in quota_keywords)
+    status = _error_status_code(e)
+    if status in (401, 403):
+        return True
+    if status is not None and 400 <= status < 500:
+        # Context length, content policy, bad request: that one request is wrong, the provider is fine
+        return False
+    request_keywords = ["context length", "context_length_exceeded", "maximum context", "content policy", "content_filter", "invalid_request_error"]
+    if status is None and any(k in message for k in request_keywords):
+        return False
+    # 5xx, timeouts and connection errors
+    return True
+
+def _error_status_code(e):
+    """HTTP status of a provider error, from the exception or an "Error code: NNN" message."""
+    status = getattr(e, "status_code", None)
+    if isinstance(status, int):
+        return status
+    match = re.search(r"error code:?\s*(\d{3})", str(e), re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+def _drop_response_schema(provider_name, model_name):
+    _schema_unsupported.add((provider_name, model_name))
+    try:
+        update_terminal_log(f"{provider_name} ({model_name}) does not accept a response schema. Asking for JSON in the prompt only.", "WARN")
+    except:
+        pass
+
+def _log_circuit_change(provider_name, model_name):
+    def log(old_state, new_state):
+        if new_state == resilience.OPEN:
+            message, level = f"{provider_name} ({model_name}) keeps failing; pausing calls for {resilience.LLM_BREAKER_RESET_SECONDS:.0f}s.", "ERROR"
+        elif new_state == resilience.HALF_OPEN:
+            message, level = f"Probing {provider_name} ({model_name}) with a single call...", "INFO"
+        else:
+            message, level = f"{provider_name} ({model_name}) is answering again.", "SUCCESS"
+        try:
+            update_terminal_log(message, level)
+        except:
+            pass
+    return log
+
+def get_circuit_breaker(provider_name, model_name, api_key):
+    """The circuit breaker of a provider/model/key, shared by every session in this process."""
+    return resilience.get_breaker(provider_name, model_name, api_key, on_change=_log_circuit_change(provider_name, model_name))
+
+def _failover_target():
+    """(provider, api_key, model, extra_args) of the configured failover provider, or None (also while its circuit is open)."""
+    if not LLM_FAILOVER_PROVIDER or not LLM_FAILOVER_MODEL:
+        return None
+    if get_circuit_breaker(LLM_FAILOVER_PROVIDER, LLM_FAILOVER_MODEL, LLM_FAILOVER_API_KEY).state == resilience.OPEN:
+        return None
+    extra_args = {"base_url": LLM_FAILOVER_BASE_URL} if LLM_FAILOVER_PROVIDER == "Ollama (Local)" and LLM_FAILOVER_BASE_URL else {}
+    return LLM_FAILOVER_PROVIDER, LLM_FAILOVER_API_KEY, LLM_FAILOVER_MODEL, extra_args
+
+async def _acall_provider(provider, provider_name, model_name, messages, temperature, max_tokens, breaker, limiter, schema=None):
+    """
+    One provider call, timed into the provider/model's latency histogram and reported to its circuit breaker.
+    Returns (text, provider, provider_name, model_name).
+    """
+    histogram = resilience.get_histogram(provider_name, model_name)
+    started = time.monotonic()
+    try:
+        idle_timeout = _request_timeout(provider_name)
+        if LLM_STREAMING:
+            result_content = await _aread_stream(provider, provider_name, messages, temperature, max_tokens, schema, idle_timeout)
+        else:
+            try:
+                result_content = await asyncio.wait_for(provider.agenerate(messages, temperature, max_tokens, schema), idle_timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"No reply from {provider_name} within {idle_timeout:.0f}s") from None
+    except asyncio.CancelledError:
+        # A hedged-away call took at least this long; counting it keeps the threshold honest when a provider slows down
+        histogram.record(time.monotonic() - started)
+        raise
+    except Exception as e:
+        if _is_breaker_failure(e):
+            breaker.record_failure()
+        raise
+    histogram.record(time.monotonic() - started)
+    breaker.record_success()
+    ratelimit.learn_limits_from_headers(limiter, provider.last_response_headers)
+    return result_content, provider, provider_name, model_name
+
+def _hedge_call(provider_name, api_key, model_name, extra_args, messages, temperature, max_tokens, estimated_tokens, schema=None):
+    """
+    The duplicate request for a slow or failed call: to the failover provider if configured, else the same
+    provider. Hedges are paced and take a slot of the target's concurrency window like any other call.
+    """
+    target = _failover_target() or (provider_name, api_key, model_name, extra_args or {})
+    hedge_provider_name, hedge_api_key, hedge_model_name, hedge_extra_args = target
+    controller = get_concurrency_controller(hedge_provider_name, hedge_model_name, hedge_api_key)
+    limiter = ratelimit.get_limiter(hedge_provider_name, hedge_model_name, hedge_api_key)
+    if target[:3] == (provider_name, api_key, model_name):
+        if provider_name == "Ollama (Local)":
+            # A duplicate on the same local server would only take a parallel slot from another paper
+            return None, hedge_provider_name, hedge_model_name
+        if controller.limit < controller.maximum:
+            # A shrunk window means the provider is already overloaded; duplicates would only add to it
+            return None, hedge_provider_name, hedge_model_name
+
+    async def call():
+        wait_time = limiter.reserve(estimated_tokens)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        hedge_provider = get_provider_instance(hedge_provider_name, hedge_api_key, hedge_model_name, **hedge_extra_args)
+        breaker = get_circuit_breaker(hedge_provider_name, hedge_model_name, hedge_api_key)
+        hedge_schema = None if (hedge_provider_name, hedge_model_name) in _schema_unsupported else schema
+        await controller.aacquire()
+        started = time.monotonic()
+        try:
+            result = await _acall_provider(hedge_provider, hedge_provider_name, hedge_model_name, messages, temperature, max_tokens, breaker, limiter, hedge_schema)
+        except Exception as e:
+            controller.record(time.monotonic() - started, ok=False, overloaded=_is_overload_error(e))
+            raise
+        else:
+            controller.record(time.monotonic() - started)
+        finally:
+            controller.release()
+        return result
+    return call, hedge_provider_name, hedge_model_name
+
+def _circuit_fallback(provider_name, model_name):
+    """Where a call goes while its circuit is open: the failover provider's target, or None for the regex fallback."""
+    target = _failover_target()
+    if target is None or (target[0], target[2]) == (provider_name, model_name):
+        try: update_terminal_log(f"{provider_name} ({model_name}) is paused after repeated failures; skipping the call.", "WARN")
+        except: pass
+        return None
+    try: update_terminal_log(f"{provider_name} ({model_name}) is paused after repeated failures; sending the call to {target[0]} ({target[2]}).", "WARN")
+    except: pass
+    return target
+
+def _log_hedge(provider_name, model_name, hedge_provider_name, hedge_model_name, reason):
+    if reason == "failed":
+        message = f"{provider_name} call failed; failing over to {hedge_provider_name} ({hedge_model_name})..."
+    else:
+        message = (f"{provider_name} call is slower than its p{LLM_HEDGE_PERCENTILE:g} latency "
+                   f"({resilience.hedge_delay(provider_name, model_name, LLM_HEDGE_PERCENTILE):.1f}s); "
+                   f"sending a hedged request to {hedge_provider_name} ({hedge_model_name})...")
+    try:
+        update_terminal_log(message, "WARN")
+    except:
+        pass
+
+def _log_concurrency_change(old_limit, new_limit, reason):
+    level = "INFO" if new_limit > old_limit else "WARN"
+    try:
+        update_terminal_log(f"LLM concurrency window {old_limit} -> {new_limit} ({reason})", level)
+    except:
+        pass
+
+def get_concurrency_controller(provider_name, model_name, api_key=""):
+    """
+    The AIMD window of in-flight calls for a provider/model/key, capped at LLM_MAX_CONCURRENCY. A local Ollama
+    server has a known number of parallel slots, so its window starts with all OLLAMA_NUM_PARALLEL of them.
+    """
+    if provider_name == "Ollama (Local)":
+        return ratelimit.get_controller(provider_name, model_name, OLLAMA_NUM_PARALLEL, on_change=_log_concurrency_change, initial=OLLAMA_NUM_PARALLEL, api_key=api_key)
+    return ratelimit.get_controller(provider_name, model_name, LLM_MAX_CONCURRENCY, on_change=_log_concurrency_change, api_key=api_key)
+
+def query_llm(prompt, provider_name, api_key, model_name, temperature=0.1, max_tokens=8192, system_prompt=None, response_schema=None):
     """
     Generic query function replacing query_zai.
     Handles retries and delegates to specific providers.
+    With response_schema (see schemas.py) the reply is constrained to JSON following it where the provider supports that.
     """
     if not api_key and provider_name != "Ollama (Local)":
         return None
+
+    cache_key = _llm_cache_key(prompt, provider_name, model_name, temperature, max_tokens, system_prompt, response_schema)
+    cached = _get_cached_response(cache_key)
+    if cached is not None:
+        _log_cache_hit(provider_name)
+        return cached
     
-    extra_args = {}
-    if provider_name == "Ollama (Local)":
-        extra_args['base_url'] = st.session_state.get('ollama_base_url', 'http://localhost:11434')
+    breaker = get_circuit_breaker(provider_name, model_name, api_key)
+    if not breaker.allow():
+        target = _circuit_fallback(provider_name, model_name)
+        if target is None:
+            return None
+        return query_llm(prompt, target[0], target[1], target[2], temperature, max_tokens, system_prompt, response_schema)
+
+    extra_args = _provider_extra_args(provider_name)
+    if (provider_name, model_name) in _schema_unsupported:
+        response_schema = None
 
     try:
         update_terminal_log(f"Initializing {provider_name} Client...", "DEBUG")
@@ -912,6 +2235,10 @@ def query_llm(prompt, provider_name, api_key, model_name, temperature=0.1, max_t
 
     max_retries = 10 
     provider = None
+    limiter = ratelimit.get_limiter(provider_name, model_name, api_key)
+    controller = get_concurrency_controller(provider_name, model_name, api_key)
+    # Charged against the TPM budget before sending: the prompt plus the most the reply may use
+    estimated_tokens = budget.count_tokens((system_prompt or "") + prompt, provider_name, model_name) + max_tokens
 
     for attempt in range(max_retries):
         try:
@@ -920,33 +2247,66 @@ def query_llm(prompt, provider_name, api_key, model_name, temperature=0.1, max_t
             except: pass
             
           
-            provider = get_provider_instance(provider_name, api_key, model_name, **extra_args)
+            if provider is None:
+                provider = get_provider_instance(provider_name, api_key, model_name, **extra_args)
             
-            messages = [{"role": "user", "content": prompt}]
+            messages = build_messages(prompt, system_prompt)
             
-            result_content = provider.generate(messages, temperature, max_tokens)
+            wait_time = limiter.reserve(estimated_tokens)
+            if wait_time > 0:
+                try: update_terminal_log(f"Pacing requests to stay within {provider_name} rate limits. Waiting {wait_time:.1f}s...", "INFO")
+                except: pass
+                time.sleep(wait_time)
+
+            controller.acquire()
+            started = time.monotonic()
+            try:
+                if LLM_STREAMING:
+                    result_content = _read_stream(provider, provider_name, messages, temperature, max_tokens, response_schema)
+                else:
+                    result_content = provider.generate(messages, temperature, max_tokens, response_schema)
+            except Exception as e:
+                controller.record(time.monotonic() - started, ok=False, overloaded=_is_overload_error(e))
+                if _is_breaker_failure(e):
+                    breaker.record_failure()
+                raise
+            else:
+                controller.record(time.monotonic() - started)
+                resilience.get_histogram(provider_name, model_name).record(time.monotonic() - started)
+                breaker.record_success()
+                ratelimit.learn_limits_from_headers(limiter, provider.last_response_headers)
+            finally:
+                controller.release()
+            budget.calibrate(provider_name, model_name, len(prompt) + len(system_prompt or ""), provider.last_prompt_tokens)
+            _log_prompt_cache(provider_name, provider)
+            _store_response(cache_key, result_content)
             
-            del provider 
             try: update_terminal_log("Response received successfully.", "SUCCESS")
             except: pass
             return result_content
             
         except Exception as e:
             error_str = str(e)
-            is_rate_limit = False
-            
-        
-            rate_keywords = ["429", "rate limit", "too many requests", "quota", "overload", "rate_limit_exceeded"]
-            if any(k in error_str.lower() for k in rate_keywords):
-                is_rate_limit = True
+            is_rate_limit = _is_rate_limit_error(e)
+
+            if response_schema is not None and _is_schema_rejected(e):
+                _drop_response_schema(provider_name, model_name)
+                response_schema = None
+                continue
+
+            if not breaker.allow():
+                target = _circuit_fallback(provider_name, model_name)
+                if target is None:
+                    return None
+                return query_llm(prompt, target[0], target[1], target[2], temperature, max_tokens, system_prompt, response_schema)
             
             if is_rate_limit:
                 try: update_terminal_log(f"Rate Limit / Quota Exceeded detected.", "WARN")
                 except: pass
                 
-                wait_time = 15 * (2 ** attempt)
+                wait_time = ratelimit.backoff_delay(limiter, e, attempt)
                 if attempt < max_retries - 1:
-                    try: update_terminal_log(f"Rate limit hit. Waiting {wait_time} seconds before retry...", "WARN")
+                    try: update_terminal_log(f"Rate limit hit. Waiting {wait_time:.1f} seconds before retry...", "WARN")
                     except: pass
                     time.sleep(wait_time)
                     try: update_terminal_log(f"Resuming retry...", "INFO")
@@ -961,4 +2321,350 @@ def query_llm(prompt, provider_name, api_key, model_name, temperature=0.1, max_t
                 if attempt < 3: time.sleep(2)
                 else: return None
     
-    return None
\ No newline at end of file
+    return None
+
+async def aquery_llm(prompt, provider_name, api_key, model_name, temperature=0.1, max_tokens=8192, extra_args=None, system_prompt=None, response_schema=None):
+    """
+    Async counterpart of query_llm with the same retry policy, built on provider.agenerate.
+    extra_args (e.g. the Ollama base_url) must be resolved by the caller, since session state
+    is not available off the Streamlit script thread.
+    """
+    if not api_key and provider_name != "Ollama (Local)":
+        return None
+
+    # SQLite lookups run off the event loop so they never stall the other calls in flight
+    cache_key = _llm_cache_key(prompt, provider_name, model_name, temperature, max_tokens, system_prompt, response_schema)
+    cached = await asyncio.to_thread(_get_cached_response, cache_key)
+    if cached is not None:
+        _log_cache_hit(provider_name)
+        return cached
+
+    breaker = get_circuit_breaker(provider_name, model_name, api_key)
+    if not breaker.allow():
+        return await _aquery_circuit_fallback(prompt, provider_name, model_name, temperature, max_tokens, system_prompt, response_schema)
+
+    if (provider_name, model_name) in _schema_unsupported:
+        response_schema = None
+    max_retries = 10
+    provider = None
+    limiter = ratelimit.get_limiter(provider_name, model_name, api_key)
+    controller = get_concurrency_controller(provider_name, model_name, api_key)
+    estimated_tokens = budget.count_tokens((system_prompt or "") + prompt, provider_name, model_name) + max_tokens
+
+    for attempt in range(max_retries):
+        try:
+            if provider is None:
+                provider = get_provider_instance(provider_name, api_key, model_name, **(extra_args or {}))
+
+            messages = build_messages(prompt, system_prompt)
+
+            wait_time = limiter.reserve(estimated_tokens)
+            if wait_time > 0:
+                try: update_terminal_log(f"Pacing requests to stay within {provider_name} rate limits. Waiting {wait_time:.1f}s...", "INFO")
+                except: pass
+                await asyncio.sleep(wait_time)
+
+            hedge, hedge_provider_name, hedge_model_name = _hedge_call(
+                provider_name, api_key, model_name, extra_args, messages, temperature, max_tokens, estimated_tokens, response_schema
+            )
+            await controller.aacquire()
+            started = time.monotonic()
+            try:
+                (result_content, answered_by, answered_name, answered_model), hedged = await resilience.hedged_call(
+                    lambda: _acall_provider(provider, provider_name, model_name, messages, temperature, max_tokens, breaker, limiter, response_schema),
+                    hedge=hedge,
+                    hedge_after=resilience.hedge_delay(provider_name, model_name, LLM_HEDGE_PERCENTILE),
+                    failover_on_error=_failover_target() is not None,
+                    on_hedge=lambda reason: _log_hedge(provider_name, model_name, hedge_provider_name, hedge_model_name, reason)
+                )
+            except Exception as e:
+                controller.record(time.monotonic() - started, ok=False, overloaded=_is_overload_error(e))
+                raise
+            else:
+                controller.record(time.monotonic() - started)
+            finally:
+                controller.release()
+            if hedged:
+                try: update_terminal_log(f"Hedged request to {answered_name} answered first.", "INFO")
+                except: pass
+            budget.calibrate(answered_name, answered_model, len(prompt) + len(system_prompt or ""), answered_by.last_prompt_tokens)
+            _log_prompt_cache(answered_name, answered_by)
+            await asyncio.to_thread(_store_response, cache_key, result_content)
+            return result_content
+
+        except Exception as e:
+            error_str = str(e)
+
+            if response_schema is not None and _is_schema_rejected(e):
+                _drop_response_schema(provider_name, model_name)
+                response_schema = None
+                continue
+
+            if not breaker.allow():
+                return await _aquery_circuit_fallback(prompt, provider_name, model_name, temperature, max_tokens, system_prompt, response_schema)
+
+            if _is_rate_limit_error(e):
+                wait_time = ratelimit.backoff_delay(limiter, e, attempt)
+                if attempt < max_retries - 1:
+                    try: update_terminal_log(f"Rate limit hit. Waiting {wait_time:.1f} seconds before retry...", "WARN")
+                    except: pass
+                    await asyncio.sleep(wait_time)
+                else:
+                    try: update_terminal_log("Max retries reached for rate limit.", "ERROR")
+                    except: pass
+                    return None
+            else:
+                try: update_terminal_log(f"API Error: {error_str}", "ERROR")
+                except: pass
+                if attempt < 3: await asyncio.sleep(2)
+                else: return None
+
+    return None
+
+async def _aquery_circuit_fallback(prompt, provider_name, model_name, temperature, max_tokens, system_prompt, response_schema=None):
+    target = _circuit_fallback(provider_name, model_name)
+    if target is None:
+        return None
+    failover_name, failover_key, failover_model, failover_extra_args = target
+    return await aquery_llm(
+        prompt, failover_name, failover_key, failover_model, temperature, max_tokens,
+        extra_args=failover_extra_args, system_prompt=system_prompt, response_schema=response_schema
+    )
+
+async def _aquery_until_answered(request, semaphore, max_api_attempts, retries_per_api_attempt):
+    """
+    The screener/extractor retry ladder for one paper: up to max_api_attempts rounds of
+    retries_per_api_attempt calls, stopping at the first non-empty response.
+    """
+    async with semaphore:
+        raw_result = None
+        for api_attempt in range(max_api_attempts):
+            if api_attempt > 0:
+                try:
+                    update_terminal_log("Previous attempt failed after retries. Initiating NEW API call for this paper...", "WARN")
+                except:
+                    pass
+
+            for retry_idx in range(retries_per_api_attempt):
+                raw_result = await aquery_llm(**request)
+
+                if raw_result is None:
+                    try:
+                        update_terminal_log("API returned None after exhaustive retries. Falling back to Regex.", "ERROR")
+                    except:
+                        pass
+                    break
+
+                if raw_result.strip():
+                    return raw_result
+
+                if retry_idx < retries_per_api_attempt - 1:
+                    try:
+                        update_terminal_log(f"API returned empty response. Retry {retry_idx + 2}/{retries_per_api_attempt}...", "ERROR")
+                    except:
+                        pass
+                    await asyncio.sleep(2)
+        return raw_result
+
+async def _with_log_sink(sink, coro):
+    # Runs in its own task, so the sink is seen by this call (and its hedges) alone
+    _llm_log_sink.set(sink)
+    return await coro
+
+def _flush_llm_logs(sink):
+    while True:
+        try:
+            msg, level = sink.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            update_terminal_log(msg, level)
+        except:
+            pass
+
+def query_llm_many(requests, max_concurrency=None, max_api_attempts=3, retries_per_api_attempt=3, on_result=None):
+    """
+    Sends many prompts concurrently, at most max_concurrency (LLM_MAX_CONCURRENCY) in flight. Within that
+    cap the number of calls actually sent at once follows each provider/model's adaptive concurrency window.
+    Each request is a dict of query_llm keyword arguments (prompt, provider_name, api_key, model_name,
+    temperature, max_tokens) and gets the same retry ladder the run loops use.
+    Blocks until all are answered and returns the raw responses (None on failure) in request order.
+    on_result(index, raw_result) is called on the calling thread as each one finishes, so it may update the UI.
+    """
+    if not requests:
+        return []
+
+    loop = _get_llm_loop()
+    semaphore = asyncio.Semaphore(max_concurrency or LLM_MAX_CONCURRENCY)
+    log_sink = queue.SimpleQueue()
+    futures = {}
+    for i, request in enumerate(requests):
+        request = dict(request)
+        request.setdefault("extra_args", _provider_extra_args(request["provider_name"]))
+        coro = _aquery_until_answered(request, semaphore, max_api_attempts, retries_per_api_attempt)
+        futures[asyncio.run_coroutine_threadsafe(_with_log_sink(log_sink, coro), loop)] = i
+
+    results = [None] * len(requests)
+    pending = set(futures)
+    while pending:
+        done, pending = concurrent.futures.wait(pending, timeout=0.25, return_when=concurrent.futures.FIRST_COMPLETED)
+        _flush_llm_logs(log_sink)
+        for future in done:
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                try:
+                    update_terminal_log(f"API Error: {str(e)}", "ERROR")
+                except:
+                    pass
+            if on_result is not None:
+                on_result(i, results[i])
+
+    _flush_llm_logs(log_sink)
+    for provider_name, model_name, api_key in {(r["provider_name"], r["model_name"], r["api_key"]) for r in requests}:
+        try:
+            update_terminal_log(
+                f"{provider_name} concurrency: {get_concurrency_controller(provider_name, model_name, api_key).describe()}; "
+                f"latency: {resilience.get_histogram(provider_name, model_name).describe()}", "DEBUG"
+            )
+        except:
+            pass
+    return results
+
+def batch_mode_available(provider_name):
+    return bool(LLM_BATCH_LOCAL_DIR) or provider_name in BATCH_PROVIDERS
+
+def get_batch_backend(provider_name, api_key, model_name):
+    """The batch endpoint for a provider, or None when it has no batch API."""
+    if LLM_BATCH_LOCAL_DIR:
+        def respond(body):
+            system_prompt = next((m["content"] for m in body["messages"] if m["role"] == "system"), None)
+            return query_llm(
+                body["messages"][-1]["content"], provider_name, api_key, model_name,
+                temperature=body["temperature"], max_tokens=body["max_tokens"], system_prompt=system_prompt,
+                response_schema=schemas.schema_from_openai_body(body)
+            )
+        return batch.LocalBatchBackend(LLM_BATCH_LOCAL_DIR, model_name, responder=respond)
+    if provider_name == "OpenAI" and OpenAI:
+        client = get_shared_client("openai", api_key, None, lambda: OpenAI(api_key=api_key))
+        return batch.OpenAIBatchBackend(client, model_name)
+    if provider_name == "Anthropic" and Anthropic:
+        client = get_shared_client("anthropic", api_key, None, lambda: Anthropic(api_key=api_key))
+        return batch.AnthropicBatchBackend(client, model_name, system_blocks=anthropic_system_blocks)
+    return None
+
+def query_llm_batch(requests, custom_ids, on_status=None):
+    """
+    Sends query_llm-style requests (all for one provider, model and key) as a single provider batch job,
+    waits for it and returns the raw responses (None on failure) in request order. custom_ids (e.g. paper
+    hashes) map replies back to requests. Cached responses are reused and fresh ones cached. Providers
+    without a batch API fall back to query_llm_many. on_status(status) is called on every poll.
+    """
+    if not requests:
+        return []
+
+    provider_name, api_key, model_name = requests[0]["provider_name"], requests[0]["api_key"], requests[0]["model_name"]
+    backend = get_batch_backend(provider_name, api_key, model_name)
+    if backend is None:
+        try:
+            update_terminal_log(f"{provider_name} has no batch API. Sending papers individually instead.", "WARN")
+        except:
+            pass
+        return query_llm_many(requests)
+
+    results = [None] * len(requests)
+    cache_keys = []
+    indices_by_id = {}
+    lines = []
+    for i, (request, custom_id) in enumerate(zip(requests, custom_ids)):
+        temperature = request.get("temperature", 0.1)
+        max_tokens = request.get("max_tokens", 8192)
+        cache_keys.append(_llm_cache_key(
+            request["prompt"], provider_name, model_name, temperature, max_tokens,
+            request.get("system_prompt"), request.get("response_schema")
+        ))
+        cached = _get_cached_response(cache_keys[i])
+        if cached is not None:
+            results[i] = cached
+            continue
+        if custom_id not in indices_by_id:
+            indices_by_id[custom_id] = []
+            lines.append({
+                "custom_id": custom_id,
+                "messages": build_messages(request["prompt"], request.get("system_prompt")),
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "schema": request.get("response_schema"),
+            })
+        indices_by_id[custom_id].append(i)
+
+    if len(lines) < len(requests):
+        try:
+            update_terminal_log(f"Reusing {len(requests) - sum(map(len, indices_by_id.values()))} cached response(s); {len(lines)} paper(s) go into the batch job.", "INFO")
+        except:
+            pass
+    if not lines:
+        return results
+
+    job_key = hashlib.sha256(json.dumps([provider_name, model_name, lines]).encode("utf-8")).hexdigest()
+    batch_id = llm_batch_jobs.get(job_key)
+    def log_status(status):
+        try:
+            update_terminal_log(f"Batch job {batch_id}: {status['state']} ({status['done']}/{status['total']} done)", "DEBUG")
+        except:
+            pass
+        if on_status is not None:
+            on_status(status)
+
+    try:
+        if batch_id:
+            try:
+                update_terminal_log(f"Resuming {provider_name} batch job {batch_id}...", "INFO")
+            except:
+                pass
+        else:
+            batch_id = backend.submit(lines)
+            llm_batch_jobs.set(job_key, batch_id)
+            try:
+                update_terminal_log(f"Submitted {provider_name} batch job {batch_id} with {len(lines)} request(s).", "INFO")
+            except:
+                pass
+        replies = batch.wait_for_batch(backend, batch_id, on_status=log_status)
+        if replies is None:
+            try:
+                update_terminal_log(f"Batch job {batch_id} failed or timed out.", "ERROR")
+            except:
+                pass
+    except Exception as e:
+        try:
+            update_terminal_log(f"Batch API Error: {str(e)}", "ERROR")
+        except:
+            pass
+        replies = None
+
+    if replies is None:
+        # Forget the job so the next run submits a fresh one
+        llm_batch_jobs.set(job_key, "")
+        replies = {}
+
+    for custom_id, indices in indices_by_id.items():
+        reply = replies.get(custom_id)
+        if reply:
+            for i in indices:
+                results[i] = reply
+                _store_response(cache_keys[i], reply)
+
+    # Lines the job never answered (errored, expired, cancelled, or the whole job lost) are sent individually
+    unanswered = [indices for custom_id, indices in indices_by_id.items() if not replies.get(custom_id)]
+    try:
+        update_terminal_log(f"Batch job {batch_id} finished: {len(lines) - len(unanswered)}/{len(lines)} request(s) answered.", "WARN" if unanswered else "SUCCESS")
+        if unanswered:
+            update_terminal_log(f"Sending {len(unanswered)} unanswered paper(s) individually instead.", "WARN")
+    except:
+        pass
+    if unanswered:
+        for indices, reply in zip(unanswered, query_llm_many([requests[indices[0]] for indices in unanswered])):
+            for i in indices:
+                results[i] = reply
+    return results